@@ -0,0 +1,79 @@
+"""Measures potassium's per-request overhead for a no-op handler.
+
+Usage:
+    python benchmarks/request_overhead.py [--requests N] [--json]
+
+Reports the time spent in the request/response objects alone (construction,
+header lookup, lazy JSON decode/encode and the pickle round trip used by process
+workers), and the end to end time of a no-op handler through the test client.
+"""
+import argparse
+import json
+import pickle
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+import potassium
+from potassium.types import RequestHeaders
+
+PAYLOAD = json.dumps({"prompt": "Hello I am a [MASK] model.", "max_tokens": 16}).encode("utf-8")
+HEADERS = [
+    ("Host", "localhost:8000"),
+    ("User-Agent", "curl/8.0"),
+    ("Accept", "*/*"),
+    ("Content-Type", "application/json"),
+    ("Content-Length", str(len(PAYLOAD))),
+]
+
+app = potassium.Potassium("overhead_benchmark")
+
+@app.init
+def init():
+    return {}
+
+@app.handler()
+def noop(context: dict, request: potassium.Request) -> potassium.Response:
+    return potassium.Response(json={}, status=200)
+
+def _per_op_us(func, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        func()
+    return (time.perf_counter() - start) / n * 1e6
+
+def objects_round_trip():
+    headers = RequestHeaders(list(HEADERS))
+    req = potassium.Request.from_json_body("id", headers, PAYLOAD)
+    req = pickle.loads(pickle.dumps(req))
+    req.headers.get("content-type")
+    req.json
+    resp = potassium.Response(json={"outputs": []}, status=200)
+    pickle.loads(pickle.dumps(resp))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--json", action="store_true", help="print results as json")
+    args = parser.parse_args()
+
+    client = app.test_client()
+    # warm up imports and caches
+    for _ in range(50):
+        client.post("/", json={})
+
+    results = {
+        "objects_us": _per_op_us(objects_round_trip, args.requests),
+        "noop_handler_us": _per_op_us(lambda: client.post("/", data=PAYLOAD, content_type="application/json"), args.requests),
+        "json_backend": potassium.types.get_json_backend().name,
+    }
+
+    if args.json:
+        print(json.dumps(results))
+    else:
+        for key, value in results.items():
+            print(f"{key}: {value:.1f}" if isinstance(value, float) else f"{key}: {value}")
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,7 @@
 from .potassium import *
 from .hooks import *
+from .compression import Compression
+from .batching import BatchSequence
+from .websocket import WebSocket
 from .store import Store, RedisConfig
-from .types import Request, Response
+from .types import Request, Response, JSONBackend, set_json_backend
@@ -0,0 +1,16 @@
+import sys
+
+COMMANDS = ["bench"]
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in COMMANDS:
+        print(f"usage: potassium {{{','.join(COMMANDS)}}} ...")
+        sys.exit(1)
+
+    command, argv = sys.argv[1], sys.argv[2:]
+    if command == "bench":
+        from .bench import main as bench_main
+        bench_main(argv)
+
+if __name__ == "__main__":
+    main()
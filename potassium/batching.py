@@ -0,0 +1,89 @@
+from dataclasses import dataclass, field
+import threading
+import traceback
+from queue import Queue as ThreadQueue, Empty
+from typing import Any, Callable, Dict, List, Optional
+from termcolor import colored
+
+from .types import Request
+
+@dataclass
+class BatchConfig():
+    max_batch_size: int
+    # headers of every sequence's streamed response
+    headers: Dict[str, str] = field(default_factory=dict)
+
+class BatchSequence():
+    """BatchSequence is one request in the running batch of a continuously batched route.
+    The route's step function advances every sequence in the batch by one step, calling emit()
+    with each sequence's new output, which is streamed to its client right away, and finish()
+    once a sequence is complete. state is kept between steps, e.g. for the tokens generated so far.
+    """
+    def __init__(self, request: Request, on_chunk: Callable[[bytes], None], on_end: Callable[[Optional[str]], None]):
+        self.request = request
+        self.state: Dict[str, Any] = {}
+        # how many steps this sequence has been through, 0 in its first step
+        self.steps = 0
+        self.finished = False
+        self._on_chunk = on_chunk
+        self._on_end = on_end
+
+    def emit(self, chunk: bytes):
+        if self.finished:
+            raise Exception("sequence is already finished")
+        if type(chunk) != bytes:
+            raise Exception("BatchSequence chunks must be bytes", type(chunk))
+        self._on_chunk(chunk)
+
+    def finish(self):
+        if not self.finished:
+            self.finished = True
+            self._on_end(None)
+
+    def _fail(self, error: str):
+        if not self.finished:
+            self.finished = True
+            self._on_end(error)
+
+class ContinuousBatcher():
+    """ContinuousBatcher runs a route's step function in a loop on its own thread, over the sequences
+    currently in the batch. Sequences are admitted between steps, so a new request starts with the
+    next step instead of waiting for the whole batch to finish, and leave the batch once finished.
+    If step raises, every sequence in the batch fails with the traceback.
+    """
+    def __init__(self, step: Callable[[Any, List[BatchSequence]], None], context: Any, max_batch_size: int):
+        self._step = step
+        self._context = context
+        self._max_batch_size = max_batch_size
+        self._pending: "ThreadQueue[BatchSequence]" = ThreadQueue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def admit(self, sequence: BatchSequence):
+        self._pending.put(sequence)
+
+    def _run(self):
+        batch: List[BatchSequence] = []
+        while True:
+            if len(batch) == 0:
+                # idle until a request arrives
+                batch.append(self._pending.get())
+            while len(batch) < self._max_batch_size:
+                try:
+                    batch.append(self._pending.get(block=False))
+                except Empty:
+                    break
+
+            try:
+                self._step(self._context, batch)
+            except Exception:
+                tb_str = traceback.format_exc()
+                print(colored(tb_str, "red"))
+                for sequence in batch:
+                    sequence._fail(tb_str)
+
+            for sequence in batch:
+                sequence.steps += 1
+            batch = [sequence for sequence in batch if not sequence.finished]
@@ -0,0 +1,310 @@
+import argparse
+import http.client
+import importlib.machinery
+import importlib.util
+import json
+import logging
+import math
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from werkzeug.serving import make_server
+
+from .potassium import Potassium
+from .tracing import STAGES, parse_server_timing
+
+MODES = ["closed", "open"]
+PAYLOADS = ["json", "binary"]
+
+@dataclass
+class BenchConfig():
+    route: str = "/"
+    mode: str = "closed"
+    # closed loop: number of clients, each sending its next request as soon as the previous one completes
+    concurrency: int = 1
+    # open loop: requests per second, arriving as a poisson process regardless of completions
+    rate: float = 10
+    duration: float = 10
+    warmup: float = 1
+    payload: str = "json"
+    json_body: str = "{}"
+    binary_size: int = 1024
+    timeout: float = 60
+
+@dataclass
+class Sample():
+    status: int
+    # seconds spent waiting to be sent, only non-zero in open loop mode when the client falls behind
+    queued: float
+    first_chunk: float
+    latency: float
+    num_bytes: int
+    # per stage durations reported by the server in the Server-Timing header, in milliseconds
+    server_stages: Dict[str, float] = field(default_factory=dict)
+
+@dataclass
+class BenchResult():
+    samples: List[Sample] = field(default_factory=list)
+    errors: int = 0
+    elapsed: float = 0
+
+def percentile(values: List[float], p: float) -> float:
+    "percentile returns the nearest-rank p-th percentile of values"
+    if len(values) == 0:
+        return 0
+    ordered = sorted(values)
+    rank = math.ceil(p / 100 * len(ordered)) - 1
+    return ordered[min(max(rank, 0), len(ordered) - 1)]
+
+def _distribution(values: List[float]) -> Dict[str, float]:
+    return {
+        "mean": sum(values) / len(values) if values else 0,
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else 0,
+    }
+
+def load_app(target: str) -> Potassium:
+    """load_app imports a Potassium app from "path/to/app.py", "path/to/app.py:attr", "module" or "module:attr".
+    Without an attribute name, the first Potassium instance in the module is used.
+    """
+    path, _, attr = target.partition(":")
+    if path.endswith(".py") or os.path.sep in path:
+        path = os.path.abspath(path)
+        name = os.path.splitext(os.path.basename(path))[0]
+        # process workers unpickle handlers by module name, so the module must be importable
+        sys.path.insert(0, os.path.dirname(path))
+        spec = importlib.util.spec_from_file_location(name, path)
+        assert spec is not None and isinstance(spec.loader, importlib.machinery.SourceFileLoader), f"could not load {path}"
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+    else:
+        module = importlib.import_module(path)
+
+    if attr:
+        app = getattr(module, attr)
+        if not isinstance(app, Potassium):
+            raise ValueError(f"{target} is not a Potassium app")
+        return app
+
+    for value in vars(module).values():
+        if isinstance(value, Potassium):
+            return value
+    raise ValueError(f"no Potassium app found in {target}")
+
+class _Client():
+    def __init__(self, port: int, config: BenchConfig):
+        self._port = port
+        self._config = config
+        self._conn = None
+
+        if config.payload == "json":
+            self._body = config.json_body.encode("utf-8")
+            self._headers = {"Content-Type": "application/json"}
+        else:
+            self._body = os.urandom(config.binary_size)
+            self._headers = {"Content-Type": "application/octet-stream"}
+
+    def send(self, scheduled: Optional[float] = None) -> Sample:
+        start = time.monotonic()
+        queued = start - scheduled if scheduled is not None else 0
+        if self._conn is None:
+            self._conn = http.client.HTTPConnection("127.0.0.1", self._port, timeout=self._config.timeout)
+
+        try:
+            self._conn.request("POST", self._config.route, body=self._body, headers=self._headers)
+            resp = self._conn.getresponse()
+            first = resp.read1(65536)
+            first_chunk = time.monotonic()
+            num_bytes = len(first) + len(resp.read())
+            server_timing = resp.getheader("Server-Timing")
+        except Exception:
+            self._conn.close()
+            self._conn = None
+            raise
+        end = time.monotonic()
+
+        if resp.will_close:
+            self._conn.close()
+            self._conn = None
+
+        return Sample(
+            status=resp.status,
+            queued=queued,
+            first_chunk=queued + first_chunk - start,
+            latency=queued + end - start,
+            num_bytes=num_bytes,
+            server_stages=parse_server_timing(server_timing) if server_timing else {}
+        )
+
+def _run_closed_loop(port: int, config: BenchConfig, deadline: float, result: BenchResult, lock: threading.Lock):
+    def client_loop():
+        client = _Client(port, config)
+        while time.monotonic() < deadline:
+            try:
+                sample = client.send()
+            except Exception:
+                with lock:
+                    result.errors += 1
+                continue
+            with lock:
+                result.samples.append(sample)
+
+    threads = [threading.Thread(target=client_loop, daemon=True) for _ in range(config.concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+def _run_open_loop(port: int, config: BenchConfig, deadline: float, result: BenchResult, lock: threading.Lock):
+    local = threading.local()
+
+    def send(scheduled):
+        if not hasattr(local, "client"):
+            local.client = _Client(port, config)
+        try:
+            sample = local.client.send(scheduled)
+        except Exception:
+            with lock:
+                result.errors += 1
+            return
+        with lock:
+            result.samples.append(sample)
+
+    # latency is measured from the scheduled arrival time, so a backed up server is not hidden
+    # by the load generator slowing down (coordinated omission)
+    with ThreadPoolExecutor(max_workers=max(config.concurrency, 64)) as executor:
+        next_arrival = time.monotonic()
+        while next_arrival < deadline:
+            delay = next_arrival - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(send, next_arrival)
+            next_arrival += random.expovariate(config.rate)
+
+def run_load(port: int, config: BenchConfig) -> BenchResult:
+    "run_load drives a running server on localhost:port and collects per-request samples"
+    if config.mode not in MODES:
+        raise ValueError("bench mode must be one of the following:", MODES)
+    if config.payload not in PAYLOADS:
+        raise ValueError("bench payload must be one of the following:", PAYLOADS)
+
+    run = _run_closed_loop if config.mode == "closed" else _run_open_loop
+    lock = threading.Lock()
+
+    if config.warmup > 0:
+        run(port, config, time.monotonic() + config.warmup, BenchResult(), lock)
+
+    result = BenchResult()
+    start = time.monotonic()
+    run(port, config, start + config.duration, result, lock)
+    result.elapsed = time.monotonic() - start
+    return result
+
+def summarize(result: BenchResult, config: BenchConfig) -> dict:
+    ok = [s for s in result.samples if s.status < 400]
+    return {
+        "route": config.route,
+        "mode": config.mode,
+        "concurrency": config.concurrency if config.mode == "closed" else None,
+        "rate": config.rate if config.mode == "open" else None,
+        "payload": config.payload,
+        "requests": len(result.samples),
+        "errors": result.errors + len(result.samples) - len(ok),
+        "elapsed": result.elapsed,
+        "rps": len(ok) / result.elapsed if result.elapsed > 0 else 0,
+        "latency_ms": _distribution([s.latency * 1000 for s in ok]),
+        "first_chunk_ms": _distribution([s.first_chunk * 1000 for s in ok]),
+        "stages_ms": {
+            "queued": _distribution([s.queued * 1000 for s in ok]),
+            "first_chunk": _distribution([(s.first_chunk - s.queued) * 1000 for s in ok]),
+            "transfer": _distribution([(s.latency - s.first_chunk) * 1000 for s in ok]),
+        },
+        "server_stages_ms": {
+            stage: _distribution([s.server_stages[stage] for s in ok if stage in s.server_stages])
+            for stage in STAGES
+            if any(stage in s.server_stages for s in ok)
+        },
+        "bytes_per_response": sum(s.num_bytes for s in ok) / len(ok) if ok else 0,
+    }
+
+def start_app(app: Potassium, num_workers: Optional[int] = None):
+    "start_app boots app on a free localhost port in a background thread, returning the server"
+    if num_workers is not None:
+        app._configure_workers(num_workers)
+    # per request logs would dominate the output, and the time, of a benchmark
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    # report the server side stage breakdown of every request
+    app._server_timing = True
+    app._init_server()
+    server = make_server("127.0.0.1", 0, app._flask_app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def run_benchmark(app: Potassium, config: BenchConfig, num_workers: Optional[int] = None) -> dict:
+    server = start_app(app, num_workers)
+    try:
+        result = run_load(server.server_port, config)
+    finally:
+        server.shutdown()
+    return summarize(result, config)
+
+def _print_summary(summary: dict):
+    print(f"route {summary['route']} ({summary['mode']} loop, {summary['payload']} payload)")
+    print(f"  requests: {summary['requests']}, errors: {summary['errors']}, rps: {summary['rps']:.1f}")
+    for name, key in [("latency", "latency_ms"), ("first chunk", "first_chunk_ms")]:
+        d = summary[key]
+        print(f"  {name} ms: p50 {d['p50']:.2f}  p95 {d['p95']:.2f}  p99 {d['p99']:.2f}  max {d['max']:.2f}")
+    print("  client stage means ms: " + "  ".join(f"{stage} {d['mean']:.2f}" for stage, d in summary["stages_ms"].items()))
+    if summary["server_stages_ms"]:
+        print("  server stage means ms: " + "  ".join(f"{stage} {d['mean']:.2f}" for stage, d in summary["server_stages_ms"].items()))
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(prog="potassium bench", description="load test a potassium app")
+    parser.add_argument("app", help='app to load, e.g. "app.py", "app.py:app" or "my_module:app"')
+    parser.add_argument("--workers", type=int, default=None, help="override the app's experimental_num_workers")
+    parser.add_argument("--route", action="append", help="route to load, may be repeated (default /)")
+    parser.add_argument("--mode", choices=MODES, default="closed")
+    parser.add_argument("--concurrency", type=int, default=1, help="closed loop clients")
+    parser.add_argument("--rate", type=float, default=10, help="open loop requests per second")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to measure each route for")
+    parser.add_argument("--warmup", type=float, default=1, help="seconds of unmeasured load before each route")
+    parser.add_argument("--payload", choices=PAYLOADS, default="json")
+    parser.add_argument("--data", default="{}", help="json body to send")
+    parser.add_argument("--binary-size", type=int, default=1024, help="bytes to send with --payload binary")
+    parser.add_argument("--json", action="store_true", help="print results as a single line of json, after any app output")
+    args = parser.parse_args(argv)
+
+    app = load_app(args.app)
+    server = start_app(app, args.workers)
+    summaries = []
+    try:
+        for route in args.route or ["/"]:
+            config = BenchConfig(
+                route=route,
+                mode=args.mode,
+                concurrency=args.concurrency,
+                rate=args.rate,
+                duration=args.duration,
+                warmup=args.warmup,
+                payload=args.payload,
+                json_body=args.data,
+                binary_size=args.binary_size,
+            )
+            summaries.append(summarize(run_load(server.server_port, config), config))
+    finally:
+        server.shutdown()
+
+    if args.json:
+        print(json.dumps({"workers": app._num_workers, "results": summaries}))
+    else:
+        for summary in summaries:
+            _print_summary(summary)
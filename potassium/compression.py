@@ -0,0 +1,208 @@
+from types import AsyncGeneratorType, GeneratorType
+from typing import Any, AsyncGenerator, AsyncIterator, Dict, Generator, Iterator, List, Optional
+import zlib
+
+from .types import Response
+
+# optional backends, without type stubs
+try:
+    import brotli  # type: ignore[import]
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard  # type: ignore[import]
+except ImportError:
+    zstandard = None
+
+GZIP = "gzip"
+BROTLI = "br"
+ZSTD = "zstd"
+
+# in order of preference when the client accepts several encodings equally
+AVAILABLE_ENCODINGS: List[str] = [e for e, available in [
+    (ZSTD, zstandard is not None),
+    (BROTLI, brotli is not None),
+    (GZIP, True),
+] if available]
+
+# fast levels by default, compression runs on the worker's critical path
+DEFAULT_LEVELS: Dict[str, int] = {
+    GZIP: 5,
+    BROTLI: 4,
+    ZSTD: 3,
+}
+
+# media types that are worth compressing, everything else (images, audio, octet-stream tensors)
+# is usually already compressed or compresses poorly
+COMPRESSIBLE_TYPES = [
+    "application/json",
+    "application/x-ndjson",
+    "application/javascript",
+    "application/xml",
+]
+
+class Compression():
+    def __init__(self, level: Optional[int] = None, min_size: int = 1024, streams: bool = True, encodings: Optional[List[str]] = None):
+        """Compression configures response compression for a route.
+        - level overrides the compression level for every encoding, defaults to a fast level per encoding
+        - responses with bodies smaller than min_size bytes are sent uncompressed
+        - streams controls whether streamed (generator) bodies are compressed incrementally
+        - encodings restricts the encodings offered, defaults to all installed ones (gzip, plus br and zstd
+          if the brotli and zstandard packages are installed)
+        """
+        if encodings is None:
+            encodings = AVAILABLE_ENCODINGS
+        for encoding in encodings:
+            if encoding not in AVAILABLE_ENCODINGS:
+                raise ValueError("compression encodings must be installed and one of the following:", AVAILABLE_ENCODINGS)
+
+        self.level = level
+        self.min_size = min_size
+        self.streams = streams
+        self.encodings = encodings
+
+    def level_for(self, encoding: str) -> int:
+        return self.level if self.level is not None else DEFAULT_LEVELS[encoding]
+
+def negotiate_encoding(accept_encoding: Optional[str], encodings: List[str]) -> Optional[str]:
+    "negotiate_encoding picks the best of encodings allowed by an Accept-Encoding header, or None"
+    if not accept_encoding:
+        return None
+
+    qualities = {}
+    for part in accept_encoding.split(","):
+        params = part.strip().split(";")
+        name = params[0].strip().lower()
+        if name == "":
+            continue
+        q = 1.0
+        for param in params[1:]:
+            key, _, value = param.strip().partition("=")
+            if key.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qualities[name] = q
+
+    best = None
+    best_q = 0.0
+    for encoding in encodings:
+        q = qualities.get(encoding, qualities.get("*", 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+def is_compressible(content_type: Optional[str]) -> bool:
+    if content_type is None:
+        return False
+    media_type = content_type.split(";")[0].strip().lower()
+    return (
+        media_type.startswith("text/")
+        or media_type.endswith("+json")
+        or media_type in COMPRESSIBLE_TYPES
+    )
+
+class StreamCompressor():
+    "StreamCompressor compresses a body incrementally, flushing after every chunk so clients receive data as it's produced"
+    def __init__(self, encoding: str, level: int):
+        self.encoding = encoding
+        # one of these is set, the three compressors have different interfaces
+        self._gzip = None
+        self._brotli: Any = None
+        self._zstd: Any = None
+        if encoding == GZIP:
+            # wbits 31 produces a gzip container
+            self._gzip = zlib.compressobj(level, zlib.DEFLATED, 31)
+        elif encoding == BROTLI:
+            assert brotli is not None
+            self._brotli = brotli.Compressor(quality=level)
+        elif encoding == ZSTD:
+            assert zstandard is not None
+            self._zstd = zstandard.ZstdCompressor(level=level).compressobj()
+        else:
+            raise ValueError(f"unsupported encoding {encoding}")
+
+    def compress(self, chunk: bytes) -> bytes:
+        if self._gzip is not None:
+            return self._gzip.compress(chunk) + self._gzip.flush(zlib.Z_SYNC_FLUSH)
+        if self._brotli is not None:
+            return self._brotli.process(chunk) + self._brotli.flush()
+        assert zstandard is not None
+        return self._zstd.compress(chunk) + self._zstd.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self) -> bytes:
+        if self._gzip is not None:
+            return self._gzip.flush(zlib.Z_FINISH)
+        if self._brotli is not None:
+            return self._brotli.finish()
+        return self._zstd.flush()
+
+def compress(body: bytes, encoding: str, level: int) -> bytes:
+    if encoding == GZIP:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        return compressor.compress(body) + compressor.flush()
+    if encoding == BROTLI:
+        assert brotli is not None
+        return brotli.compress(body, quality=level)
+    if encoding == ZSTD:
+        assert zstandard is not None
+        return zstandard.ZstdCompressor(level=level).compress(body)
+    raise ValueError(f"unsupported encoding {encoding}")
+
+def compress_stream(chunks: Iterator[bytes], encoding: str, level: int) -> Generator[bytes, None, None]:
+    compressor = StreamCompressor(encoding, level)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.finish()
+
+async def compress_async_stream(chunks: AsyncIterator[bytes], encoding: str, level: int) -> AsyncGenerator[bytes, None]:
+    compressor = StreamCompressor(encoding, level)
+    async for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.finish()
+
+def _get_header(headers: dict, name: str) -> Optional[str]:
+    name = name.lower()
+    for key, value in headers.items():
+        if key.lower() == name:
+            return value
+    return None
+
+def compress_response(resp: Response, accept_encoding: Optional[str], config: Compression) -> Response:
+    "compress_response compresses resp in place if the client accepts it and the body is worth compressing"
+    if resp.status in (204, 304) or _get_header(resp.headers, "Content-Encoding") is not None:
+        return resp
+    if not is_compressible(_get_header(resp.headers, "Content-Type")):
+        return resp
+
+    body = resp.body
+    if isinstance(body, (GeneratorType, AsyncGeneratorType)):
+        if not config.streams:
+            return resp
+    elif not isinstance(body, bytes) or len(body) < config.min_size:
+        return resp
+
+    encoding = negotiate_encoding(accept_encoding, config.encodings)
+    if encoding is None:
+        return resp
+
+    level = config.level_for(encoding)
+    if isinstance(body, AsyncGeneratorType):
+        resp.body = compress_async_stream(body, encoding, level)
+    elif isinstance(body, GeneratorType):
+        resp.body = compress_stream(body, encoding, level)
+    else:
+        resp.body = compress(body, encoding, level)
+    resp.headers["Content-Encoding"] = encoding
+    resp.headers["Vary"] = "Accept-Encoding"
+    return resp
@@ -8,3 +8,6 @@ class RouteAlreadyInUseException(Exception):
         super().__init__("Route already in use")
 
 
+class RouteNotFoundException(Exception):
+    def __init__(self, route):
+        super().__init__(f"No handler for route {route}")
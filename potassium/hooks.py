@@ -1,6 +1,6 @@
-import requests
-
 def send_webhook(url: str, json: dict):
+    # requests is slow to import, most apps never send a webhook
+    import requests
     try:
         requests.post(url, json=json)
     except requests.exceptions.ConnectionError:
@@ -0,0 +1,318 @@
+from dataclasses import dataclass
+from enum import Enum
+import os
+import pickle
+import sqlite3
+import tempfile
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Condition, Lock, Thread
+from typing import Any, Callable, List, Optional, Set, Tuple, TYPE_CHECKING
+from termcolor import colored
+
+from .types import Request
+
+if TYPE_CHECKING:
+    from .store import Store
+
+# a job whose worker died this many times is marked failed instead of being retried
+MAX_ATTEMPTS = 3
+# finished jobs are kept this long, in seconds, so their status can still be looked up
+DEFAULT_RETENTION = 24 * 60 * 60
+# the longest a client can long-poll a job for, in seconds
+MAX_JOB_WAIT = 60
+
+class JobStatus(Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+@dataclass
+class Job():
+    id: str
+    route: str
+    request: Request
+    attempts: int
+
+class JobJournal():
+    """JobJournal is a SQLite table of background jobs. Requests are written to disk on submission and
+    only loaded back into memory when they are about to run, so a burst of jobs costs disk, not RAM.
+    """
+    def __init__(self, path: str, retention: float = DEFAULT_RETENTION):
+        self.path = path
+        self._retention = retention
+        self._lock = Lock()
+        # autocommit, every statement is its own transaction unless one is opened explicitly
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    id TEXT UNIQUE NOT NULL,
+                    route TEXT NOT NULL,
+                    request BLOB,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    error TEXT,
+                    created REAL NOT NULL,
+                    updated REAL NOT NULL
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, seq)")
+
+    def add(self, job_id: str, route: str, request: Request):
+        # background requests aren't traced
+        request._trace = None
+        now = time.time()
+        blob = pickle.dumps(request, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO jobs (id, route, request, status, created, updated) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, route, blob, JobStatus.QUEUED.value, now, now)
+            )
+
+    def recover(self) -> int:
+        "recover requeues jobs left running by a previous server process, returning how many there were"
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status = ?, updated = ? WHERE status = ?",
+                (JobStatus.QUEUED.value, time.time(), JobStatus.RUNNING.value)
+            )
+            return cursor.rowcount
+
+    def claim(self, limit: int) -> List[Job]:
+        "claim marks up to limit of the oldest queued jobs as running and returns them"
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._conn.execute(
+                    "SELECT id, route, request, attempts FROM jobs WHERE status = ? ORDER BY seq LIMIT ?",
+                    (JobStatus.QUEUED.value, limit)
+                ).fetchall()
+                self._conn.executemany(
+                    "UPDATE jobs SET status = ?, attempts = attempts + 1, updated = ? WHERE id = ?",
+                    [(JobStatus.RUNNING.value, time.time(), row[0]) for row in rows]
+                )
+                self._conn.execute("COMMIT")
+            except:
+                self._conn.execute("ROLLBACK")
+                raise
+        return [Job(id, route, pickle.loads(blob), attempts + 1) for id, route, blob, attempts in rows]
+
+    def requeue(self, job_id: str):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, updated = ? WHERE id = ?",
+                (JobStatus.QUEUED.value, time.time(), job_id)
+            )
+
+    def finish(self, job_id: str, status: JobStatus, error: Optional[str] = None):
+        now = time.time()
+        with self._lock:
+            # the request isn't needed anymore, only the job's status is kept
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, request = NULL, updated = ? WHERE id = ?",
+                (status.value, error, now, job_id)
+            )
+            self._conn.execute(
+                "DELETE FROM jobs WHERE status IN (?, ?) AND updated < ?",
+                (JobStatus.DONE.value, JobStatus.FAILED.value, now - self._retention)
+            )
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, route, status, attempts, error, created, updated FROM jobs WHERE id = ?",
+                (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(["id", "route", "status", "attempts", "error", "created", "updated"], row))
+
+    def count(self, status: JobStatus) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (status.value,)).fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+class ResultStore():
+    """ResultStore keeps the results of finished background jobs in memory for ttl seconds, evicting
+    the oldest beyond max_entries. With a Store, results are also persisted there, so they can
+    outlive eviction and be read by other replicas. Writes to the Store happen on a thread of their own,
+    put is called as jobs finish, on the thread delivering every request's response.
+    """
+    def __init__(self, max_entries: int = 1000, ttl: int = 3600, store: Optional["Store"] = None, key_prefix: str = "potassium-job-result:"):
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._store = store
+        self._key_prefix = key_prefix
+        self._lock = Lock()
+        # job id -> (expiry, result), oldest first
+        self._results: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._writer = ThreadPoolExecutor(1, thread_name_prefix="potassium-results") if store is not None else None
+
+    def put(self, job_id: str, result: Any):
+        now = time.monotonic()
+        with self._lock:
+            self._results[job_id] = (now + self._ttl, result)
+            while len(self._results) > self._max_entries:
+                self._results.popitem(last=False)
+            # entries are in expiry order, drop the expired ones from the front
+            while len(self._results) > 0:
+                oldest = next(iter(self._results.values()))
+                if oldest[0] > now:
+                    break
+                self._results.popitem(last=False)
+        if self._writer is not None:
+            self._writer.submit(self._persist, job_id, result)
+
+    def _persist(self, job_id: str, result: Any):
+        assert self._store is not None
+        try:
+            self._store.set(self._key_prefix + job_id, {"result": result}, ttl=self._ttl)
+        except Exception:
+            # the result is still kept in memory, only other replicas miss out
+            print(colored(f"Failed to persist the result of background job {job_id}", "red"))
+            print(colored(traceback.format_exc(), "red"))
+
+    def flush(self):
+        "flush waits for results being written to the Store"
+        if self._writer is not None:
+            self._writer.submit(lambda: None).result()
+
+    def get(self, job_id: str) -> Tuple[bool, Any]:
+        "get returns whether a result was found for job_id, and the result"
+        with self._lock:
+            entry = self._results.get(job_id)
+        if entry is not None and entry[0] > time.monotonic():
+            return True, entry[1]
+        if self._store is not None:
+            stored = self._store.get(self._key_prefix + job_id)
+            if stored is not None:
+                return True, stored["result"]
+        return False, None
+
+class BackgroundQueue():
+    """BackgroundQueue runs background jobs from a JobJournal, at most concurrency at a time, so that
+    background work can't fill the worker pool's queue ahead of handler requests.
+
+    Execution is at least once: jobs that were running when the server stopped, or whose worker
+    died, are run again, up to MAX_ATTEMPTS times.
+    dispatch starts a job on the worker pool, the caller then reports back with complete() or retry().
+    """
+    def __init__(self, journal_path: Optional[str], concurrency: int, dispatch: Callable[[Job], None], results: Optional[ResultStore] = None):
+        # without a journal path jobs are still spooled to disk, but only for the life of this process
+        self.durable = journal_path is not None
+        if journal_path is None:
+            fd, journal_path = tempfile.mkstemp(prefix="potassium-jobs-", suffix=".sqlite")
+            os.close(fd)
+        self._journal = JobJournal(journal_path)
+        self._concurrency = concurrency
+        self._dispatch = dispatch
+        self.results = results if results is not None else ResultStore()
+        self._cond = Condition()
+        self._running: Set[str] = set()
+        self._has_queued = True
+        self._stopped = False
+        self._closed = False
+
+        recovered = self._journal.recover()
+        if recovered > 0:
+            print(f"Requeued {recovered} background jobs interrupted by the last shutdown")
+
+    def start(self):
+        t = Thread(target=self._dispatch_loop, daemon=True)
+        t.start()
+
+    def stop(self):
+        "stop stops starting jobs, queued jobs stay in the journal"
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def close(self):
+        self.stop()
+        with self._cond:
+            self._closed = True
+            self._journal.close()
+        if not self.durable:
+            os.remove(self._journal.path)
+
+    def submit(self, job_id: str, route: str, request: Request):
+        self._journal.add(job_id, route, request)
+        with self._cond:
+            self._has_queued = True
+            self._cond.notify_all()
+
+    def complete(self, job_id: str, error: Optional[str] = None, result: Any = None):
+        if error is None and result is not None:
+            self.results.put(job_id, result)
+        with self._cond:
+            # jobs still running at shutdown are left as running, and recovered on the next start
+            if self._closed:
+                return
+            self._journal.finish(job_id, JobStatus.FAILED if error is not None else JobStatus.DONE, error)
+            self._running.discard(job_id)
+            self._cond.notify_all()
+
+    def retry(self, job: Job, reason: str):
+        "retry requeues a job that was interrupted, e.g. by its worker dying, unless it's out of attempts"
+        if job.attempts >= MAX_ATTEMPTS:
+            self.complete(job.id, f"{reason} ({job.attempts} attempts)")
+            return
+        with self._cond:
+            if self._closed:
+                return
+            self._journal.requeue(job.id)
+            self._running.discard(job.id)
+            self._has_queued = True
+            self._cond.notify_all()
+
+    def get(self, job_id: str) -> Optional[dict]:
+        return self._journal.get(job_id)
+
+    def wait(self, job_id: str, timeout: float) -> Optional[dict]:
+        "wait returns the job once it's done or failed, or as it is after timeout seconds"
+        deadline = time.monotonic() + min(timeout, MAX_JOB_WAIT)
+        with self._cond:
+            while True:
+                job = self._journal.get(job_id)
+                remaining = deadline - time.monotonic()
+                if job is None or job["status"] in (JobStatus.DONE.value, JobStatus.FAILED.value) or remaining <= 0:
+                    return job
+                self._cond.wait(remaining)
+
+    def num_queued(self) -> int:
+        return self._journal.count(JobStatus.QUEUED)
+
+    def num_running(self) -> int:
+        with self._cond:
+            return len(self._running)
+
+    def _dispatch_loop(self):
+        while True:
+            with self._cond:
+                while not self._stopped and (len(self._running) >= self._concurrency or not self._has_queued):
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                limit = self._concurrency - len(self._running)
+                # cleared before claiming, so a job submitted meanwhile sets it again
+                self._has_queued = False
+
+            jobs = self._journal.claim(limit)
+            with self._cond:
+                if len(jobs) == limit:
+                    # there may be more
+                    self._has_queued = True
+                self._running.update(job.id for job in jobs)
+
+            for job in jobs:
+                self._dispatch(job)
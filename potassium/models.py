@@ -0,0 +1,91 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from threading import RLock
+from typing import Any, Callable, Dict, Optional
+
+@dataclass
+class Model():
+    name: str
+    loader: Callable[[], Any]
+    # estimated memory the loaded model takes, in bytes
+    size: int
+    # called with the model when it's evicted, e.g. to free GPU memory
+    unload: Optional[Callable[[Any], None]] = None
+
+class LazyContext(dict):
+    """LazyContext is the context passed to handlers when the app declares models. It holds what
+    init() returned, plus the declared models, each loaded by its loader the first time a handler
+    reads it. With a memory_budget (in bytes), the least recently used models are evicted to make
+    room for a model that doesn't fit, and loaded again when next used.
+
+    A model evicted while another request on the same worker still holds it stays in memory until
+    that request drops it, so the budget can be exceeded briefly with concurrent routes.
+    on_change is called with the number of loads, evictions and bytes loaded after each change.
+    """
+    def __init__(self, context: dict, models: Dict[str, Model], memory_budget: Optional[int] = None, on_change: Optional[Callable[[int, int, int], None]] = None):
+        super().__init__(context)
+        for name in models:
+            if dict.__contains__(self, name):
+                raise Exception(f"init() returned {name}, which is also the name of a model")
+        self._models = models
+        self._memory_budget = memory_budget
+        self._on_change = on_change
+        self._lock = RLock()
+        # names of the loaded models, least recently used first
+        self._loaded: "OrderedDict[str, None]" = OrderedDict()
+        self.loaded_bytes = 0
+        self.num_loads = 0
+        self.num_evictions = 0
+
+    def __getitem__(self, key):
+        model = self._models.get(key)
+        if model is None:
+            return dict.__getitem__(self, key)
+        with self._lock:
+            if key in self._loaded:
+                self._loaded.move_to_end(key)
+                return dict.__getitem__(self, key)
+            self._make_room(model.size)
+            value = model.loader()
+            dict.__setitem__(self, key, value)
+            self._loaded[key] = None
+            self.loaded_bytes += model.size
+            self.num_loads += 1
+            self._changed()
+            return value
+
+    def get(self, key, default=None):
+        if key in self._models:
+            return self[key]
+        return dict.get(self, key, default)
+
+    def __contains__(self, key):
+        return key in self._models or dict.__contains__(self, key)
+
+    def is_loaded(self, key) -> bool:
+        with self._lock:
+            return key in self._loaded
+
+    def evict(self, key):
+        "evict unloads a model, it's loaded again the next time it's used"
+        with self._lock:
+            if key not in self._loaded:
+                return
+            del self._loaded[key]
+            model = self._models[key]
+            value = dict.pop(self, key)
+            self.loaded_bytes -= model.size
+            self.num_evictions += 1
+            if model.unload is not None:
+                model.unload(value)
+            self._changed()
+
+    def _make_room(self, size: int):
+        if self._memory_budget is None:
+            return
+        while len(self._loaded) > 0 and self.loaded_bytes + size > self._memory_budget:
+            self.evict(next(iter(self._loaded)))
+
+    def _changed(self):
+        if self._on_change is not None:
+            self._on_change(self.num_loads, self.num_evictions, self.loaded_bytes)
@@ -1,37 +1,88 @@
 from enum import Enum
 import time
 import os
-from types import GeneratorType
-from typing import Callable
+from types import AsyncGeneratorType, GeneratorType
+from typing import Any, Callable, Dict, Generator, Optional, Set, Tuple, Union, cast
 from dataclasses import dataclass
-from flask import Flask, request, make_response, abort, Response as FlaskResponse
 import uuid
-from werkzeug.serving import make_server
-from threading import Thread, Lock
-from queue import Queue as ThreadQueue
+import threading
+from threading import BoundedSemaphore, Thread, Lock
+from concurrent.futures import Future, ThreadPoolExecutor
+from queue import Queue as ThreadQueue, Empty
+import copy
 import functools
+import json
+import inspect
+import hmac
+import signal
+import itertools
+import traceback
 from termcolor import colored
-from multiprocessing import Pool as ProcessPool, Queue as ProcessQueue
-from multiprocessing.pool import ThreadPool
-from .status import PotassiumStatus, StatusEvent
-from .worker import run_worker, init_worker
-from .exceptions import RouteAlreadyInUseException, InvalidEndpointTypeException
-from .types import Request, RequestHeaders, Response
+from multiprocessing import Queue as ProcessQueue
+from .status import PotassiumStatus, ServerCounters, StatusEvent, StatusWatcher, read_status
+from .worker import run_worker, init_worker, current_worker, run_inline, iterate_body, ControlCommand, Reply, _error_response
+from .profiling import MAX_PROFILE_DURATION
+from .supervisor import WorkerSupervisor, WorkerTable, RecyclePolicy, IDLE
+from .jobs import BackgroundQueue, Job, ResultStore
+from .models import Model
+from .batching import BatchConfig
+from .streams import StreamBuffers, DEFAULT_HIGH_WATERMARK, DEFAULT_LOW_WATERMARK
+from .websocket import WebSocketConnection, is_upgrade, CLOSE_NORMAL, CLOSE_GOING_AWAY, CLOSE_INTERNAL_ERROR
+from .compression import Compression, compress_response
+from .tracing import Trace, TraceStats, OTLPFileExporter
+from .exceptions import RouteAlreadyInUseException, InvalidEndpointTypeException, RouteNotFoundException
+from .types import Request, RequestHeaders, RequestFile, Response, json_loads, DEFAULT_SPOOL_THRESHOLD
 import logging
 
+# the longest /_k/warmup waits for workers to warm up, in seconds
+WARMUP_TIMEOUT = 600
+# seconds between keepalive comments on an idle status stream
+STATUS_STREAM_KEEPALIVE = 15
+
 class HandlerType(Enum):
     HANDLER = "HANDLER"
     BACKGROUND = "BACKGROUND"
+    WEBSOCKET = "WEBSOCKET"
+
+# how long a websocket client gets to answer the server's close frame before the connection is dropped
+WEBSOCKET_CLOSE_TIMEOUT = 5
 
 @dataclass
 class Endpoint():
     type: HandlerType
     func: Callable
+    # how many requests to this endpoint a worker runs at once
+    concurrency: int = 1
+    # staged handlers run these on the server's stage pool, before and after func runs on a worker
+    preprocess: Optional[Callable] = None
+    postprocess: Optional[Callable] = None
+    # set for continuously batched routes, whose func is their step function
+    batch: Optional[BatchConfig] = None
+
+def _stream_chunks(body, on_close: Optional[Callable]) -> Generator[bytes, None, None]:
+    "_stream_chunks iterates a response body from the mailbox, calling on_close once it's done or abandoned"
+    try:
+        if isinstance(body, GeneratorType):
+            yield from body
+        elif body:
+            yield body
+    finally:
+        if on_close is not None:
+            on_close()
+
+def _run_callback(callback, payload):
+    # callbacks run on the mailbox's thread, one that raises mustn't stop responses from being delivered
+    try:
+        callback(payload)
+    except Exception:
+        print(colored(traceback.format_exc(), "red"))
 
 class ResponseMailbox():
     def __init__(self, response_queue):
         self._response_queue = response_queue
         self._mailbox = {}
+        # payloads for these ids are passed to a callback instead of waiting in the mailbox
+        self._callbacks = {}
         self._lock = Lock()
 
         t = Thread(target=self._response_handler, daemon=True)
@@ -42,28 +93,87 @@ class ResponseMailbox():
             while True:
                 request_id, payload = self._response_queue.get()
                 with self._lock:
-                    if request_id not in self._mailbox:
-                        self._mailbox[request_id] = ThreadQueue()
-                    self._mailbox[request_id].put(payload)
+                    callback = self._callbacks.pop(request_id, None)
+                    if callback is None:
+                        if request_id not in self._mailbox:
+                            self._mailbox[request_id] = ThreadQueue()
+                        self._mailbox[request_id].put(payload)
+                if callback is not None:
+                    _run_callback(callback, payload)
         except EOFError:
             # queue closed, this happens when the server is shutting down
             pass
 
-    def get_response(self, request_id):
+    def on_response(self, request_id, callback):
+        "on_response calls callback with the payload sent to request_id, or with an Exception if it fails"
+        with self._lock:
+            self._callbacks[request_id] = callback
+
+    def get(self, request_id, timeout=None):
+        "get waits for a single payload sent to request_id, raising queue.Empty on timeout"
         with self._lock:
             if request_id not in self._mailbox:
                 self._mailbox[request_id] = ThreadQueue()
-        result, stream_id = self._mailbox[request_id].get()
+        try:
+            return self._mailbox[request_id].get(timeout=timeout)
+        finally:
+            with self._lock:
+                del self._mailbox[request_id]
 
-        if stream_id is not None:
-            result.body = self._stream_body(stream_id)
+    def get_response(self, request_id, streams: Optional[StreamBuffers] = None):
+        """get_response waits for the response to request_id, and its trace. A streamed body is returned as a
+        generator, whose reads are credited to streams for flow control, along with a function to call once
+        the response is closed."""
+        with self._lock:
+            if request_id not in self._mailbox:
+                self._mailbox[request_id] = ThreadQueue()
+        result, stream, trace = self._mailbox[request_id].get()
 
+        on_close = None
         with self._lock:
+            if stream is not None:
+                stream_id, running_index = stream
+                # create the stream's queue right away, so that fail() can reach the stream
+                # before the client starts reading it
+                if stream_id not in self._mailbox:
+                    self._mailbox[stream_id] = ThreadQueue()
+                on_read = None
+                if streams is not None:
+                    on_read = functools.partial(streams.read_chunk, running_index, request_id)
+                    on_close = functools.partial(streams.abandon, running_index, request_id)
+                result.body = self._stream_body(stream_id, on_read)
             del self._mailbox[request_id]
 
-        return result
+        return result, trace, on_close
 
-    def _stream_body(self, stream_id):
+    def fail(self, request_id, message):
+        "fail answers a request, or aborts its stream, that will never get a response from its worker"
+        stream_id = 'stream-' + request_id
+        with self._lock:
+            callback = self._callbacks.pop(request_id, None)
+            if callback is not None:
+                pass
+            elif stream_id in self._mailbox:
+                self._mailbox[stream_id].put(Exception(message))
+            elif request_id in self._mailbox:
+                response = Response(
+                    status=500,
+                    body=message.encode("utf-8"),
+                    headers={"Content-Type": "text/plain"}
+                )
+                self._mailbox[request_id].put((response, None, None))
+        if callback is not None:
+            _run_callback(callback, Exception(message))
+
+    def stream(self, stream_id, on_read: Optional[Callable[[int], None]] = None):
+        "stream returns a generator of the chunks sent to stream_id, until the stream ends"
+        # create the stream's queue right away, so that fail() can reach it before it's read
+        with self._lock:
+            if stream_id not in self._mailbox:
+                self._mailbox[stream_id] = ThreadQueue()
+        return self._stream_body(stream_id, on_read)
+
+    def _stream_body(self, stream_id, on_read: Optional[Callable[[int], None]] = None):
         with self._lock:
             if stream_id not in self._mailbox:
                 self._mailbox[stream_id] = ThreadQueue()
@@ -79,6 +189,8 @@ class ResponseMailbox():
                 elif result == None:
                     break
                 else:
+                    if on_read is not None:
+                        on_read(len(result))
                     yield result
         except GeneratorExit:
             while True:
@@ -86,6 +198,8 @@ class ResponseMailbox():
                 result = queue.get()
                 if result == None:
                     break
+                elif on_read is not None and not isinstance(result, Exception):
+                    on_read(len(result))
                 elif isinstance(result, Exception):
                     with self._lock:
                         del self._mailbox[stream_id]
@@ -97,38 +211,135 @@ class ResponseMailbox():
 class Potassium():
     "Potassium is a simple, stateful, GPU-enabled, and autoscaleable web framework for deploying machine learning models."
 
-    def __init__(self, name, experimental_num_workers=1):
+    def __init__(self, name, experimental_num_workers=1, upload_spool_threshold=DEFAULT_SPOOL_THRESHOLD, server_timing=False, trace_export_path=None, profiling_token=None, experimental_recycle_policy=None, drain_timeout=30, background_journal_path=None, background_concurrency=None, job_results_ttl=3600, job_results_max=1000, job_results_store=None, status_audit_path=None, model_memory_budget=None, stage_workers=None, stage_queue_size=None, stream_high_watermark=DEFAULT_HIGH_WATERMARK, stream_low_watermark=DEFAULT_LOW_WATERMARK):
+        """
+        upload_spool_threshold is the size in bytes above which binary request bodies and multipart
+        files are spooled to a temporary file instead of being held in memory
+        server_timing adds a Server-Timing header with the time spent in each stage of the request to handler responses
+        trace_export_path, if set, is a file that every handler request is appended to as OpenTelemetry spans
+        profiling_token enables the /_k/profile endpoint, for requests with a matching X-Potassium-Profiling-Token header
+        experimental_recycle_policy is a RecyclePolicy to restart process workers after a number of requests, or once their memory grows too large
+        drain_timeout is how long, in seconds, in-flight requests get to finish when the server receives SIGTERM
+        background_journal_path is a SQLite file that background jobs are queued in, so that queued and interrupted
+        jobs survive a restart. Without it jobs are queued in a temporary file for the life of the process
+        background_concurrency is the most background jobs run at once, defaults to one per worker, times the background routes' concurrency
+        job_results_ttl and job_results_max bound how long and how many background job results are kept in memory for /_k/jobs,
+        job_results_store is an optional Store to also persist them in
+        status_audit_path, if set, is a file that every status event (requests received, started and ended, workers
+        started and died) is appended to as a line of JSON. Status itself is read from shared memory either way
+        model_memory_budget is how many bytes of models declared with @app.model each worker keeps loaded,
+        least recently used models are evicted beyond it. Without it, loaded models are never evicted
+        stage_workers is how many threads run the preprocess and postprocess stages of staged handlers, one per CPU by default
+        stage_queue_size is how many requests to staged handlers can be preprocessed ahead of the workers, twice the
+        workers' capacity by default. Beyond it, requests wait to be preprocessed, rather than piling up preprocessed inputs
+        stream_high_watermark and stream_low_watermark bound the bytes of a streamed response buffered in the server for a
+        slow client: beyond the high watermark the handler's generator is paused until the client has caught up to the low one
+        """
         self.name = name
+        self._upload_spool_threshold = upload_spool_threshold
+        self._server_timing = server_timing
+        self._trace_stats = TraceStats()
+        self._trace_exporter = OTLPFileExporter(trace_export_path, name) if trace_export_path is not None else None
+        self._profiling_token = profiling_token
+        self._recycle_policy = experimental_recycle_policy
+        self._drain_timeout = drain_timeout
+        self._background_journal_path = background_journal_path
+        self._background_concurrency = background_concurrency
+        self._background_queue = None
+        self._job_results = ResultStore(job_results_max, job_results_ttl, job_results_store)
+        self._draining = False
+        # responses handed to flask whose body, which may be a stream, hasn't been fully sent yet
+        self._open_responses = 0
+        self._open_responses_lock = Lock()
+        # open websocket connections, closed when the server drains
+        self._websockets: Set[WebSocketConnection] = set()
 
         # default init function, if the user doesn't specify one
         self._init_func = lambda _: {}
+        self._warmup_func = None
+        self._models: Dict[str, Model] = {}
+        self._model_memory_budget = model_memory_budget
+        self._stage_workers = stage_workers
+        self._stage_queue_size = stage_queue_size
+        self._stage_pool = None
+        self._stage_queue = None
+        if stream_low_watermark > stream_high_watermark:
+            raise ValueError("stream_low_watermark must not be above stream_high_watermark")
+        self._stream_high_watermark = stream_high_watermark
+        self._stream_low_watermark = stream_low_watermark
         # dictionary to store unlimited Endpoints, by unique route
         self._endpoints = {}  
         self._context = {}
-        self._flask_app = self._create_flask_app()
-        self._event_queue = ProcessQueue()
+        # internal ids only need to be unique within this server process
+        self._internal_ids = itertools.count()
+        # created once the server starts, so that importing potassium doesn't import flask
+        self._flask_app: Any = None
+        # status is read from shared memory written by workers, plus these counters kept by the server
+        self._counters = ServerCounters()
+        self._status_audit_path = status_audit_path
+        self._event_queue = ProcessQueue() if status_audit_path is not None else None
         self._response_queue = ProcessQueue()
         self._response_mailbox = ResponseMailbox(self._response_queue)
 
         self._num_workers = experimental_num_workers
 
         self._worker_pool = None
+        self._control_queues = []
+        self._supervisor = None
+        self._worker_table = None
+        self._status_watcher = None
+
+        if status_audit_path is not None and self._event_queue is not None:
+            self.event_handler_thread = Thread(target=self._event_handler, args=(status_audit_path, self._event_queue), daemon=True)
+            self.event_handler_thread.start()
+
+    def _configure_workers(self, num_workers):
+        # used by tooling such as `potassium bench` to override experimental_num_workers before serving
+        assert self._worker_pool is None, "workers must be configured before the server starts"
+        self._num_workers = num_workers
 
-        self.event_handler_thread = Thread(target=self._event_handler, daemon=True)
-        self.event_handler_thread.start()
+    @property
+    def _status(self) -> PotassiumStatus:
+        if self._worker_table is None:
+            return PotassiumStatus.initial(self._num_workers)
+        return read_status(self._worker_table, self._counters, self._num_workers)
 
-        self._status = PotassiumStatus.initial(self._num_workers)
+    def _audit(self, event):
+        if self._event_queue is not None:
+            self._event_queue.put(event)
 
-    def _event_handler(self):
+    def _event_handler(self, audit_path: str, event_queue: ProcessQueue):
+        # writes the audit log, events are folded into a status as well so each line shows its effect
+        status = PotassiumStatus.initial(self._num_workers)
         try:
-            while True:
-                event = self._event_queue.get()
-                self._status = self._status.update(event)
+            with open(audit_path, "a") as f:
+                while True:
+                    event = event_queue.get()
+                    status = status.update(event)
+                    f.write(json.dumps({
+                        "time": time.time(),
+                        "event": event[0].value,
+                        "data": [str(data) for data in event[1:]],
+                        "requests_in_progress": status.requests_in_progress,
+                        "num_workers_started": status.num_workers_started,
+                    }) + "\n")
+                    f.flush()
         except EOFError:
             # this happens when the process is shutting down
             pass
 
 
+    def _on_worker_died(self, worker_num, internal_ids, recycled):
+        if recycled:
+            print(colored(f"Worker {worker_num} recycled, restarting it", 'yellow'))
+        else:
+            print(colored(f"Worker {worker_num} died unexpectedly, restarting it", 'red'))
+        for internal_id in internal_ids:
+            self._response_mailbox.fail(internal_id, f"worker {worker_num} died while handling this request")
+            self._audit((StatusEvent.INFERENCE_END, internal_id))
+        self._counters.requests_completed(len(internal_ids))
+        self._audit((StatusEvent.WORKER_DIED, worker_num))
+
     def init(self, func):
         """init runs once on server start, and is used to initialize the app's context.
         You can use this to load models onto the GPU, set up connections, etc.
@@ -141,6 +352,33 @@ class Potassium():
 
         self._init_func = func
         return func
+
+    def warmup(self, func):
+        """warmup runs on every worker after init, before the worker takes requests, and again on every
+        worker when /_k/warmup is called. It's passed the context, use it to run a representative
+        request through your models so that JIT compilation, CUDA graph capture, allocator growth and
+        loading weights into memory happen before the first real request rather than during it.
+        """
+
+        self._warmup_func = func
+        return func
+
+    def model(self, name: str, size: int, unload: Optional[Callable[[Any], None]] = None):
+        """model declares a model that is loaded into the context the first time a handler reads
+        context[name], rather than in init(). The decorated function loads and returns the model.
+        size is an estimate of the memory the loaded model takes, in bytes: with a model_memory_budget,
+        the least recently used models are evicted to stay within it, calling unload with the model if given.
+        Models are loaded per worker, each worker loads the ones its requests use.
+        """
+        if name in self._models:
+            raise ValueError(f"model {name} is already declared")
+        if self._model_memory_budget is not None and size > self._model_memory_budget:
+            raise ValueError(f"model {name} is larger than model_memory_budget")
+
+        def actual_decorator(loader):
+            self._models[name] = Model(name, loader, size, unload)
+            return loader
+        return actual_decorator
     
     @staticmethod
     def _standardize_route(route):
@@ -154,108 +392,597 @@ class Potassium():
         
         return route
 
-    def _base_decorator(self, route: str, handler_type: HandlerType):
+    def _base_decorator(self, route: str, handler_type: HandlerType, compression: Optional[Compression] = None, concurrency: int = 1, preprocess: Optional[Callable] = None, postprocess: Optional[Callable] = None):
         route = self._standardize_route(route)
         if route in self._endpoints:
             raise RouteAlreadyInUseException()
+        if concurrency < 1:
+            raise ValueError("concurrency must be at least 1")
+        staged = preprocess is not None or postprocess is not None
+
+        def check_response(out, request):
+            if type(out) != Response:
+                raise Exception("Potassium Response object not returned")
+            if type(out.body) not in (bytes, GeneratorType, AsyncGeneratorType):
+                raise Exception(
+                    "Potassium Response object body must be bytes", type(out.body))
+            if compression is not None and request._compress:
+                out = compress_response(out, request.headers.get("Accept-Encoding"), compression)
+            return out
+
+        def finish(out, request):
+            if request._trace is not None:
+                request._trace.executed = time.monotonic()
+
+            if handler_type == HandlerType.HANDLER and not staged:
+                # compress here, in the worker, to keep the server thread free
+                out = check_response(out, request)
+
+            return out
 
         def actual_decorator(func):
-            @functools.wraps(func)
-            def wrapper(context, request):
-                # send in app's stateful context if GPU, and the request
-                out = func(context, request)
-
-                if handler_type == HandlerType.HANDLER:
-                    if type(out) != Response:
-                        raise Exception("Potassium Response object not returned")
-                    if type(out.body) != bytes and type(out.body) != GeneratorType:
-                        raise Exception(
-                            "Potassium Response object body must be bytes", type(out.body))
-
-                return out
-
-            
-            self._endpoints[route] = Endpoint(type=handler_type, func=wrapper)
+            if inspect.iscoroutinefunction(func):
+                # async handlers are awaited on the worker's event loop
+                @functools.wraps(func)
+                async def async_wrapper(context, request):
+                    stage_input = request._stage_input if preprocess is not None else request
+                    return finish(await func(context, stage_input), request)
+                wrapper = async_wrapper
+            else:
+                @functools.wraps(func)
+                def wrapper(context, request):
+                    # send in app's stateful context if GPU, and the request, or what preprocess made of it
+                    stage_input = request._stage_input if preprocess is not None else request
+                    return finish(func(context, stage_input), request)
+
+            endpoint = Endpoint(type=handler_type, func=wrapper, concurrency=concurrency)
+            if staged:
+                endpoint.preprocess = preprocess
+
+                def finish_staged(request, output):
+                    # runs on the stage pool, the response is checked and compressed here rather than on the worker
+                    if postprocess is not None:
+                        output = postprocess(request, output)
+                    return check_response(output, request)
+                endpoint.postprocess = finish_staged
+
+            self._endpoints[route] = endpoint
             return wrapper
         return actual_decorator
 
     # handler is a blocking http POST handler
-    def handler(self, route: str = "/"):
-        "handler is a blocking http POST handler"
-        return self._base_decorator(route, HandlerType.HANDLER)
+    def handler(self, route: str = "/", compression: Union[bool, Compression] = True, concurrency: int = 1, preprocess: Optional[Callable[[Request], Any]] = None, postprocess: Optional[Callable[[Request, Any], Response]] = None):
+        """handler is a blocking http POST handler
+        compression can be True (compress large JSON and text responses based on the client's Accept-Encoding),
+        False, or a Compression object to configure the level and size threshold for this route
+        concurrency is how many requests to this route each worker runs at once, on threads sharing the
+        worker's context. Raise it for handlers that mostly wait on I/O (Store, webhooks, remote models)
+        preprocess and postprocess split the handler into stages. preprocess(request) (e.g. tokenizing, decoding
+        images) and postprocess(request, output) (e.g. formatting the Response) run on the server's stage pool,
+        so a worker only runs the handler itself: with preprocess, the handler is passed preprocess's return
+        value instead of the request, and with postprocess, whatever the handler returns is passed on to it
+        """
+        if compression is True:
+            compression = Compression()
+        return self._base_decorator(route, HandlerType.HANDLER, compression or None, concurrency, preprocess, postprocess)
+
+    def continuous_batching(self, route: str = "/", max_batch_size: int = 8, headers: Optional[Dict[str, str]] = None):
+        """continuous_batching is a streaming http POST handler for generative models that run a batch of
+        sequences one step (e.g. one token) at a time. The decorated step function is called in a loop as
+        step(context, batch), with the list of BatchSequences currently running: it advances each by one step,
+        streaming its output with sequence.emit(chunk), and calls sequence.finish() once the sequence is done.
+        New requests join the batch between steps, up to max_batch_size per worker, instead of waiting for the
+        sequences ahead of them to finish. headers are the headers of every sequence's streamed response
+        """
+        route = self._standardize_route(route)
+        if route in self._endpoints:
+            raise RouteAlreadyInUseException()
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1")
+
+        def actual_decorator(step):
+            batch = BatchConfig(max_batch_size, headers if headers is not None else {})
+            self._endpoints[route] = Endpoint(type=HandlerType.HANDLER, func=step, concurrency=max_batch_size, batch=batch)
+            return step
+        return actual_decorator
+
+    def websocket(self, route: str = "/", concurrency: int = 1):
+        """websocket is a websocket handler, for sessions that stream messages both ways, e.g. voice or
+        incremental prompts. It's called as handler(context, ws) once per connection, and the session lasts
+        until it returns: ws.receive() returns the client's next message, str or bytes, or None once the client
+        has closed the connection, and ws.send(message) sends one to the client. The upgrade request is ws.request.
+        A session runs on one worker, with its context, and takes one of the route's concurrency slots for as long
+        as it lasts. Both directions are flow controlled like streamed responses.
+        """
+        route = self._standardize_route(route)
+        if route in self._endpoints:
+            raise RouteAlreadyInUseException()
+        if concurrency < 1:
+            raise ValueError("concurrency must be at least 1")
+
+        def actual_decorator(func):
+            if inspect.iscoroutinefunction(func):
+                raise Exception("websocket handlers must be synchronous functions")
+            self._endpoints[route] = Endpoint(type=HandlerType.WEBSOCKET, func=func, concurrency=concurrency)
+            return func
+        return actual_decorator
 
     # background is a non-blocking http POST handler
-    def background(self, route: str = "/"):    
-        "background is a non-blocking http POST handler"
-        return self._base_decorator(route, HandlerType.BACKGROUND)
+    def background(self, route: str = "/", concurrency: int = 1):
+        "background is a non-blocking http POST handler, concurrency works as for handler"
+        return self._base_decorator(route, HandlerType.BACKGROUND, concurrency=concurrency)
 
     def test_client(self):
         "test_client returns a Flask test client for the app"
         self._init_server()
         return self._flask_app.test_client()
 
+    def _broadcast(self, command: ControlCommand, args: tuple, timeout: float) -> list:
+        "_broadcast sends a control command to every worker and returns each worker's reply, or None if it timed out"
+        reply_ids = []
+        for control_queue in self._control_queues:
+            reply_id = f"control-{next(self._internal_ids)}"
+            reply_ids.append(reply_id)
+            control_queue.put((command, reply_id) + args)
+
+        deadline = time.monotonic() + timeout
+        replies = []
+        for reply_id in reply_ids:
+            try:
+                replies.append(self._response_mailbox.get(reply_id, timeout=max(deadline - time.monotonic(), 0)))
+            except Empty:
+                replies.append(None)
+        return replies
+
+    def get_job(self, job_id: str, wait: float = 0) -> Optional[dict]:
+        """get_job returns the status of a background job by the job_id returned when it was submitted:
+        its route, status (queued, running, done or failed), attempts, error, created and updated times,
+        and the value the handler returned as result, while it's kept.
+        With wait, it waits up to that many seconds (at most 60) for the job to finish.
+        Returns None for unknown jobs, finished jobs are kept for a day.
+        """
+        assert self._background_queue is not None, "server not started"
+        # long-poll: hold the request until the job finishes, instead of clients polling in a loop
+        job = self._background_queue.wait(job_id, wait) if wait > 0 else self._background_queue.get(job_id)
+        if job is not None and job["status"] == "done":
+            found, result = self._job_results.get(job_id)
+            if found:
+                job["result"] = result
+        return job
+
+    def call(self, route: str, request: Any = None) -> Response:
+        """call runs one of the app's handlers and returns its Response, for handlers composed of other routes
+        (ensembles, routers, rerankers) without looping back over http. request is a Request, or the JSON to
+        send as one. Called from a handler, the route runs right there, on the same worker and thread with the
+        same context, and the request and response aren't serialized. Otherwise it's scheduled on a worker like
+        a request from a client. A streamed body is read to the end, call_stream returns it as it's generated.
+        A handler that raises gives a 500 Response, as it would over http
+        """
+        resp = self.call_stream(route, request)
+        if isinstance(resp.body, GeneratorType):
+            resp.body = b"".join(resp.body)
+        return resp
+
+    def call_stream(self, route: str, request: Any = None) -> Response:
+        "call_stream is call, with the Response's body as a generator of its chunks, even if it wasn't streamed"
+        route = self._standardize_route(route)
+        endpoint = self._endpoints.get(route)
+        if endpoint is None:
+            raise RouteNotFoundException(route)
+        if endpoint.type != HandlerType.HANDLER:
+            raise InvalidEndpointTypeException()
+        if isinstance(request, Request):
+            # a copy, so that a handler passing on its own request still has its own response compressed
+            req = copy.copy(request)
+        else:
+            req = Request(id=f"call-{next(self._internal_ids)}", headers=RequestHeaders({}), json=request)
+        # compression is for the http client, a call's response goes back to the caller as is
+        req._compress = False
+
+        worker = current_worker()
+        if worker is not None:
+            try:
+                resp = self._call_inline(worker, endpoint, req)
+            except Exception:
+                resp = _error_response()[0]
+            resp.body = iterate_body(worker, resp.body)
+            return resp
+
+        assert self._worker_pool is not None, "server not started"
+        self._counters.request_received()
+        self._audit((StatusEvent.INFERENCE_REQUEST_RECEIVED,))
+        resp, _, on_close = self._dispatch(endpoint, req, str(next(self._internal_ids)))
+        resp.body = _stream_chunks(resp.body, on_close)
+        return resp
+
+    @staticmethod
+    def _call_inline(worker, endpoint: Endpoint, req: Request) -> Response:
+        "_call_inline runs a route within the handler calling it, stages included"
+        infer_request = req
+        if endpoint.preprocess is not None:
+            infer_request = Request(req.id, req.headers)
+            infer_request._stage_input = endpoint.preprocess(req)
+        output = run_inline(worker, endpoint.func, infer_request, endpoint.batch)
+        if endpoint.postprocess is not None:
+            return endpoint.postprocess(req, output)
+        return output
+
+    def _dispatch(self, endpoint: Endpoint, req: Request, internal_id: str) -> Tuple[Response, Optional[Trace], Optional[Callable]]:
+        """_dispatch runs a request on a worker and waits for its response, returning it with its trace,
+        and for streamed responses a function to call once the stream is closed"""
+        if endpoint.postprocess is not None:
+            resp, trace = self._run_stages(endpoint, req, internal_id)
+            return resp, trace, None
+        assert self._worker_pool is not None and self._worker_table is not None
+        self._worker_pool.apply_async(run_worker, args=(endpoint.func, req, internal_id, Reply.RESPONSE, endpoint.concurrency, endpoint.batch))
+        return self._response_mailbox.get_response(internal_id, self._worker_table.streams)
+
+    def _dispatch_background(self, job: Job):
+        internal_id = str(next(self._internal_ids))
+        endpoint = self._endpoints.get(job.route)
+        if endpoint is None or endpoint.type != HandlerType.BACKGROUND:
+            # the job was queued by a previous version of the app
+            assert self._background_queue is not None
+            self._background_queue.complete(job.id, f"no background handler for {job.route}")
+            return
+        self._response_mailbox.on_response(internal_id, functools.partial(self._on_background_done, job))
+        assert self._worker_pool is not None
+        self._counters.request_received()
+        self._audit((StatusEvent.INFERENCE_REQUEST_RECEIVED,))
+        self._worker_pool.apply_async(run_worker, args=(endpoint.func, job.request, internal_id, Reply.JOB_RESULT, endpoint.concurrency))
+
+    def _on_background_done(self, job: Job, result):
+        assert self._background_queue is not None
+        if isinstance(result, Exception):
+            # the job never finished, e.g. its worker died
+            self._background_queue.retry(job, str(result))
+        else:
+            result, error = result
+            self._background_queue.complete(job.id, error, json_loads(result) if result is not None else None)
+
+    def _run_stages(self, endpoint: Endpoint, req: Request, internal_id: str) -> Tuple[Response, Optional[Trace]]:
+        "_run_stages runs a staged handler: preprocess and postprocess on the stage pool, the handler itself on a worker"
+        stage_pool, stage_queue, worker_pool = self._stage_pool, self._stage_queue, self._worker_pool
+        assert stage_pool is not None and stage_queue is not None and worker_pool is not None
+        postprocess = endpoint.postprocess
+        assert postprocess is not None
+        # the worker only closes the request it's sent, which isn't this one once preprocess has run,
+        # so its spooled uploads are released here once postprocess is done with it
+        try:
+            stage_queue.acquire()
+            try:
+                infer_request = req
+                if endpoint.preprocess is not None:
+                    try:
+                        stage_input = stage_pool.submit(endpoint.preprocess, req).result()
+                    except Exception:
+                        # the request never reaches a worker, so it's completed here
+                        self._counters.requests_completed()
+                        self._audit((StatusEvent.INFERENCE_END, internal_id))
+                        return _error_response()[0], req._trace
+                    # only preprocess's output is sent to the worker, not the raw request
+                    infer_request = Request(req.id, req.headers)
+                    infer_request._trace = req._trace
+                    infer_request._stage_input = stage_input
+                # the worker's reply, or an Exception if it died
+                reply: "Future[Any]" = Future()
+                self._response_mailbox.on_response(internal_id, reply.set_result)
+                worker_pool.apply_async(run_worker, args=(endpoint.func, infer_request, internal_id, Reply.VALUE, endpoint.concurrency))
+                result = reply.result()
+            finally:
+                stage_queue.release()
+
+            if isinstance(result, Exception):
+                return Response(status=500, body=str(result).encode("utf-8"), headers={"Content-Type": "text/plain"}), req._trace
+            output, error, trace = result
+            if trace is None:
+                trace = req._trace
+            if error is not None:
+                return Response(status=500, body=error.encode("utf-8"), headers={"Content-Type": "text/plain"}), trace
+
+            try:
+                return stage_pool.submit(postprocess, req, output).result(), trace
+            except Exception:
+                return _error_response()[0], trace
+        finally:
+            req.close()
+
+    def _serve_websocket(self, conn: WebSocketConnection, endpoint: Endpoint, req: Request, internal_id: str):
+        "_serve_websocket relays an accepted websocket connection's messages to and from its session on a worker"
+        assert self._worker_pool is not None and self._worker_table is not None
+        streams = self._worker_table.streams
+        inbound = self._worker_table.websocket_inbound
+        # the worker replies with where the session runs, or the request fails if it died first
+        opened: "Future[Any]" = Future()
+        def on_opened(result):
+            if not isinstance(result, Exception):
+                # open the session's stream before anything else can fail it
+                _, running_index = result
+                result = (result, self._response_mailbox.stream('stream-' + internal_id, functools.partial(streams.read_chunk, running_index, internal_id)))
+            opened.set_result(result)
+        self._response_mailbox.on_response(internal_id, on_opened)
+        self._worker_pool.apply_async(run_worker, args=(endpoint.func, req, internal_id, Reply.WEBSOCKET, endpoint.concurrency))
+        result = opened.result()
+        if isinstance(result, Exception):
+            conn.close(CLOSE_INTERNAL_ERROR)
+            return
+        (worker_num, running_index), messages = result
+        control_queue = self._control_queues[worker_num]
+        session_ended = threading.Event()
+
+        def write():
+            try:
+                for message in messages:
+                    conn.send(message)
+                conn.close(CLOSE_NORMAL)
+            except OSError:
+                # the client is gone, the session keeps running until its handler notices
+                streams.abandon(running_index, internal_id)
+                for _ in messages:
+                    pass
+            except Exception:
+                # the handler raised, or its worker died
+                conn.close(CLOSE_INTERNAL_ERROR)
+            session_ended.set()
+            # the session can't read anything anymore, don't let the reader wait on it
+            inbound.abandon(running_index, internal_id)
+            # give the client time to answer the close frame, then stop waiting for it
+            if not reader_done.wait(WEBSOCKET_CLOSE_TIMEOUT):
+                conn.shutdown()
+
+        inbound.start(running_index, internal_id)
+        reader_done = threading.Event()
+        writer = Thread(target=write, daemon=True)
+        writer.start()
+
+        while True:
+            message = conn.receive()
+            if message is None or session_ended.is_set():
+                break
+            control_queue.put((ControlCommand.WEBSOCKET_MESSAGE, internal_id, message))
+            if inbound.sent_chunk(running_index, len(message)):
+                # stop reading from the client until the session catches up
+                inbound.wait_for_reader(running_index)
+        reader_done.set()
+        # tell the session the client is gone
+        control_queue.put((ControlCommand.WEBSOCKET_MESSAGE, internal_id, None))
+        writer.join()
+
+    def _finish_trace(self, trace: Trace, route: str, request_id: str, status: int):
+        # runs once the response, including any stream, has been sent
+        trace.sent = time.monotonic()
+        with self._open_responses_lock:
+            self._open_responses -= 1
+        self._trace_stats.record(trace)
+        if self._trace_exporter is not None:
+            self._trace_exporter.export(trace, route, request_id, status)
+
+    def _parse_request(self, request, request_id) -> Request:
+        headers = RequestHeaders(list(request.headers.items()))
+
+        # only JSON requests are decoded, binary uploads are passed through untouched
+        if request.is_json:
+            body = request.get_data()
+            # decode here to reject malformed JSON up front, process workers decode again lazily
+            return Request.from_json_body(request_id, headers, body, json=json_loads(body))
+
+        if request.mimetype == "multipart/form-data":
+            files = {}
+            for name, storage in request.files.items():
+                files[name] = RequestFile.from_stream(
+                    storage.stream,
+                    self._upload_spool_threshold,
+                    filename=storage.filename,
+                    content_type=storage.mimetype
+                )
+            return Request(id=request_id, headers=headers, files=files, form=request.form.to_dict())
+
+        body = RequestFile.from_stream(
+            request.stream,
+            self._upload_spool_threshold,
+            content_type=request.mimetype
+        )
+        return Request(id=request_id, headers=headers, body=body)
+
     def _create_flask_app(self):
+        from flask import Flask, request, make_response, abort, Response as FlaskResponse
+
+        class WebSocketClosedResponse(FlaskResponse):
+            def __call__(self, environ, start_response):
+                raise ConnectionError("websocket closed")
+
         flask_app = Flask(__name__)
 
         # ingest into single endpoint and spread out to multiple downstream funcs
         @flask_app.route('/', defaults={'path': ''}, methods=["POST"])
         @flask_app.route('/<path:path>', methods=["POST"])
         def handle(path):
+            received = time.monotonic()
             route = "/" + path
             if route not in self._endpoints:
-                self._event_queue.put((StatusEvent.BAD_REQUEST_RECEIVED,))
+                self._counters.bad_request_received()
+                self._audit((StatusEvent.BAD_REQUEST_RECEIVED,))
                 abort(404)
 
+            if self._draining:
+                return self._unavailable_response()
+
             endpoint = self._endpoints[route]
+            if endpoint.type == HandlerType.WEBSOCKET:
+                abort(405)
             request_id = request.headers.get("X-Banana-Request-Id", None)
             if request_id is None:
                 request_id = str(uuid.uuid4())
             try:
-                req = Request(
-                    headers=RequestHeaders(dict(request.headers.items())),
-                    json=request.get_json(),
-                    id=request_id
-                )
+                req = self._parse_request(request, request_id)
+                req._trace = Trace(received)
+                req._trace.parsed = time.monotonic()
             except:
                 res = make_response()
                 res.status_code = 400
-                self._event_queue.put((StatusEvent.BAD_REQUEST_RECEIVED,))
+                self._counters.bad_request_received()
+                self._audit((StatusEvent.BAD_REQUEST_RECEIVED,))
                 return res
 
-            self._event_queue.put((StatusEvent.INFERENCE_REQUEST_RECEIVED,))
-
             assert self._worker_pool is not None, "Worker pool not initialized"
-            # use an internal id for critical path to prevent user from accidentally
-            # breaking things by sending multiple requests with the same id
-            internal_id = str(uuid.uuid4())
             if endpoint.type == HandlerType.HANDLER:
-                self._worker_pool.apply_async(run_worker, args=(endpoint.func, req, internal_id, True))
-                resp = self._response_mailbox.get_response(internal_id)
+                self._counters.request_received()
+                self._audit((StatusEvent.INFERENCE_REQUEST_RECEIVED,))
+                # use an internal id for critical path to prevent user from accidentally
+                # breaking things by sending multiple requests with the same id
+                internal_id = str(next(self._internal_ids))
+                with self._open_responses_lock:
+                    self._open_responses += 1
+                resp, trace, on_close = self._dispatch(endpoint, req, internal_id)
+                if trace is None:
+                    # the worker never answered (e.g. it crashed), there's nothing to trace
+                    trace = req._trace
+                trace.delivered = time.monotonic()
 
+                # async generators are iterated on the worker, only bytes or a generator reach the server
                 flask_response = FlaskResponse(
-                    resp.body,
+                    cast(Union[None, bytes, Generator[bytes, None, None]], resp.body),
                     status=resp.status,
                     headers=resp.headers
                 )
+                if self._server_timing:
+                    flask_response.headers["Server-Timing"] = trace.server_timing()
+                flask_response.call_on_close(functools.partial(self._finish_trace, trace, route, req.id, resp.status))
+                if on_close is not None:
+                    # a stream closed before it was read to the end mustn't leave its worker waiting for the client
+                    flask_response.call_on_close(on_close)
             elif endpoint.type == HandlerType.BACKGROUND:
-                self._worker_pool.apply_async(run_worker, args=(endpoint.func, req, internal_id))
+                assert self._background_queue is not None
+                job_id = uuid.uuid4().hex
+                # the job is counted as a request once it's dispatched to a worker
+                self._background_queue.submit(job_id, route, req)
 
-                flask_response = make_response({'started': True})
+                flask_response = make_response({'started': True, 'job_id': job_id})
             else:
                 raise InvalidEndpointTypeException()
 
             return flask_response
 
+        # werkzeug only matches websocket upgrade requests to websocket rules
+        @flask_app.route('/', defaults={'path': ''}, methods=["GET"], websocket=True)
+        @flask_app.route('/<path:path>', methods=["GET"], websocket=True)
+        def handle_websocket(path):
+            route = "/" + path
+            endpoint = self._endpoints.get(route)
+            if endpoint is None:
+                self._counters.bad_request_received()
+                self._audit((StatusEvent.BAD_REQUEST_RECEIVED,))
+                abort(404)
+            if endpoint.type != HandlerType.WEBSOCKET:
+                abort(405)
+            if self._draining:
+                return self._unavailable_response()
+            if not is_upgrade(request.headers):
+                abort(400)
+            # websockets take over the http connection's socket, which only werkzeug's server exposes
+            sock = request.environ.get("werkzeug.socket")
+            if sock is None:
+                abort(501)
+
+            request_id = request.headers.get("X-Banana-Request-Id", None)
+            if request_id is None:
+                request_id = str(uuid.uuid4())
+            req = Request(id=request_id, headers=RequestHeaders(list(request.headers.items())))
+
+            conn = WebSocketConnection(sock)
+            conn.accept(request.headers["Sec-WebSocket-Key"])
+            self._counters.request_received()
+            self._audit((StatusEvent.INFERENCE_REQUEST_RECEIVED,))
+            internal_id = str(next(self._internal_ids))
+            with self._open_responses_lock:
+                self._open_responses += 1
+                self._websockets.add(conn)
+            try:
+                self._serve_websocket(conn, endpoint, req, internal_id)
+            finally:
+                conn.shutdown()
+                with self._open_responses_lock:
+                    self._open_responses -= 1
+                    self._websockets.discard(conn)
+            # the connection was taken over, werkzeug's server treats this as the client having gone
+            return WebSocketClosedResponse()
+
         @flask_app.route('/_k/warmup', methods=["POST"])
         def warm():
+            if self._draining:
+                return self._unavailable_response()
             request_id = str(uuid.uuid4())
 
-            # a bit of a hack but we need to send a start and end event to the event queue
-            # in order to update the status the way the load balancer expects
-            self._event_queue.put((StatusEvent.INFERENCE_REQUEST_RECEIVED,))
-            self._event_queue.put((StatusEvent.INFERENCE_END, request_id))
+            # counted as a request, to update the status the way the load balancer expects
+            self._counters.request_received()
+            self._audit((StatusEvent.INFERENCE_REQUEST_RECEIVED,))
+            body: Dict[str, Any] = {"warm": True}
+            if self._warmup_func is not None:
+                replies = self._broadcast(ControlCommand.WARMUP, (), timeout=WARMUP_TIMEOUT)
+                workers = [reply for reply in replies if reply is not None]
+                body["warm"] = len(workers) == len(replies) and all(reply["error"] is None for reply in workers)
+                body["workers"] = workers
+            self._counters.requests_completed()
+            self._audit((StatusEvent.INFERENCE_END, request_id))
+            res = make_response(body)
+            res.status_code = 200
+            return res
+
+        @flask_app.route('/_k/profile', methods=["POST"])
+        def profile():
+            if self._profiling_token is None:
+                abort(404)
+            token = request.headers.get("X-Potassium-Profiling-Token", "")
+            if not hmac.compare_digest(token, self._profiling_token):
+                abort(403)
+
+            options = request.get_json(silent=True) or {}
+            try:
+                duration = min(float(options.get("duration", 5)), MAX_PROFILE_DURATION)
+                interval = float(options.get("interval", 0.01))
+            except (TypeError, ValueError):
+                abort(400)
+            allocations = bool(options.get("allocations", False))
+
+            replies = self._broadcast(ControlCommand.PROFILE, (duration, interval, allocations), timeout=duration + 10)
             res = make_response({
-                "warm": True,
+                "workers": [reply for reply in replies if reply is not None],
+                "timed_out": len([reply for reply in replies if reply is None]),
+            })
+            res.status_code = 200
+            return res
+
+        @flask_app.route('/_k/jobs/<job_id>', methods=["GET"])
+        def job(job_id):
+            try:
+                wait = float(request.args.get("wait", 0))
+            except ValueError:
+                abort(400)
+
+            job = self.get_job(job_id, wait)
+            if job is None:
+                abort(404)
+            res = make_response(job)
+            res.status_code = 200
+            return res
+
+        @flask_app.route('/_k/metrics', methods=["GET"])
+        def metrics():
+            cur_status = self._status
+            res = make_response({
+                "stages": self._trace_stats.snapshot(),
+                "workers": {
+                    "num_workers": self._num_workers,
+                    "num_workers_started": cur_status.num_workers_started,
+                    "num_restarts": self._supervisor.num_restarts if self._supervisor is not None else 0,
+                    "num_recycles": self._supervisor.num_recycles if self._supervisor is not None else 0,
+                },
+                "models": {
+                    "num_loads": cur_status.num_model_loads,
+                    "num_evictions": cur_status.num_model_evictions,
+                    "loaded_bytes": cur_status.model_bytes,
+                },
+                "streams": self._worker_table.streams.snapshot() if self._worker_table is not None else {},
             })
             res.status_code = 200
             return res
@@ -265,18 +992,129 @@ class Potassium():
         def status():
             cur_status = self._status
 
-            res = make_response({
-                "gpu_available": cur_status.gpu_available,
-                "sequence_number": cur_status.sequence_number,
-                "idle_time": int(cur_status.idle_time*1000),
-                "inference_time": int(cur_status.longest_inference_time*1000),
-            })
+            # long-poll: with wait, hold the request until the status differs from the one the caller last saw
+            wait = request.args.get("wait", None)
+            if wait is not None and self._status_watcher is not None:
+                try:
+                    wait = float(wait)
+                    seen_sequence_number = request.args.get("sequence_number", None, type=int)
+                    seen_gpu_available = request.args.get("gpu_available", None)
+                except ValueError:
+                    abort(400)
+
+                def changed(status):
+                    if seen_sequence_number is not None and status.sequence_number != seen_sequence_number:
+                        return True
+                    if seen_gpu_available is not None and str(status.gpu_available).lower() != seen_gpu_available.lower():
+                        return True
+                    return False
+
+                cur_status = self._status_watcher.wait(changed, wait)
 
+            res = make_response(self._status_payload(cur_status))
             res.status_code = 200
             return res
 
+        @flask_app.route('/_k/status/stream', methods=["GET"])
+        def status_stream():
+            if self._status_watcher is None:
+                abort(503)
+            watcher = self._status_watcher
+
+            def events():
+                # an event on connect, then one per transition, with comments to keep idle connections open
+                version = watcher.version
+                yield f"data: {json.dumps(self._status_payload(self._status))}\n\n"
+                while True:
+                    new_version = watcher.wait_for_transition(version, STATUS_STREAM_KEEPALIVE)
+                    if new_version == version:
+                        yield ": keepalive\n\n"
+                        continue
+                    version = new_version
+                    yield f"data: {json.dumps(self._status_payload(self._status))}\n\n"
+
+            return FlaskResponse(events(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
         return flask_app
     
+    def _status_payload(self, status: PotassiumStatus) -> dict:
+        idle_time = status.idle_time
+        # background jobs waiting in the queue aren't in the status yet, but the app isn't idle
+        if idle_time > 0 and self._background_queue is not None and self._background_queue.num_queued() > 0:
+            idle_time = 0
+
+        return {
+            "gpu_available": status.gpu_available,
+            "sequence_number": status.sequence_number,
+            "idle_time": int(idle_time*1000),
+            "inference_time": int(status.longest_inference_time*1000),
+            "draining": status.draining,
+            "model_loads": status.num_model_loads,
+            "model_evictions": status.num_model_evictions,
+        }
+
+    @staticmethod
+    def _unavailable_response():
+        from flask import make_response
+        res = make_response("server is shutting down", 503)
+        res.headers["Retry-After"] = "1"
+        return res
+
+    def _in_flight(self) -> int:
+        "_in_flight is the number of accepted requests that haven't finished, including queued background tasks and unsent streams"
+        with self._open_responses_lock:
+            open_responses = self._open_responses
+        in_flight = max(self._status.requests_in_progress, open_responses)
+        if self._background_queue is not None and not self._background_queue.durable:
+            # queued jobs would be lost, they have to run before shutting down
+            in_flight += self._background_queue.num_queued()
+        return in_flight
+
+    def drain(self, timeout: Optional[float] = None) -> bool:
+        """drain stops accepting requests, waits up to timeout seconds (drain_timeout by default) for
+        in-flight requests, streams and background tasks to finish, then shuts down the workers.
+        Requests still running at the deadline are answered with a 500.
+        Returns whether all in-flight work finished. serve() drains automatically on SIGTERM.
+        """
+        if timeout is None:
+            timeout = self._drain_timeout
+        self._draining = True
+        self._counters.drain_started()
+        self._audit((StatusEvent.DRAIN_STARTED,))
+        if self._background_queue is not None and self._background_queue.durable:
+            # queued jobs are journaled and run after the restart, only wait for running ones
+            self._background_queue.stop()
+        print(colored(f"Draining, waiting up to {timeout}s for {self._in_flight()} in-flight requests", 'yellow'))
+        # ask websocket clients to leave, their sessions end once they've closed the connection
+        with self._open_responses_lock:
+            websockets = list(self._websockets)
+        for conn in websockets:
+            conn.close(CLOSE_GOING_AWAY)
+
+        deadline = time.monotonic() + timeout
+        while self._in_flight() > 0 and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+        remaining = self._in_flight()
+        if remaining > 0:
+            print(colored(f"Drain timed out with {remaining} requests in flight, shutting down anyway", 'red'))
+            if self._worker_table is not None:
+                for internal_id in self._worker_table.running:
+                    if internal_id != IDLE:
+                        self._response_mailbox.fail(str(internal_id), "server shut down before this request finished")
+
+        if self._supervisor is not None:
+            self._supervisor.stop()
+        if self._worker_pool is not None:
+            self._worker_pool.terminate()
+        if self._background_queue is not None:
+            self._background_queue.close()
+        self._job_results.flush()
+        for control_queue in self._control_queues:
+            control_queue.close()
+        print(colored("Drained, workers stopped", 'green'))
+        return remaining == 0
+
     def _init_server(self):
         # unless the user has already set up logging, set up logging to stdout using
         # a separate fd so that we don't get in the way of request logs
@@ -287,14 +1125,39 @@ class Potassium():
             # redirect flask logs to stdout_copy
             log.addHandler(logging.StreamHandler(os.fdopen(stdout_copy, 'w')))
 
+        from multiprocessing.pool import Pool as ProcessPool, ThreadPool
+
+        self._flask_app = self._create_flask_app()
         self._idle_start_time = time.time()
         index_queue = ProcessQueue()
         for i in range(self._num_workers):
             index_queue.put(i)
+        self._control_queues = [ProcessQueue() for _ in range(self._num_workers)]
+        # a worker runs as many requests at once as the most concurrent route allows
+        slots_per_worker = max([endpoint.concurrency for endpoint in self._endpoints.values()], default=1)
+        worker_table = WorkerTable(self._num_workers, slots_per_worker, self._stream_high_watermark, self._stream_low_watermark)
+        self._counters = ServerCounters(worker_table.status_changed.release)
+        self._worker_table = worker_table
+        if self._status_watcher is not None:
+            self._status_watcher.stop()
+        self._status_watcher = StatusWatcher(lambda: read_status(worker_table, self._counters, self._num_workers), worker_table.status_changed)
+        self._status_watcher.start()
+        if any(endpoint.postprocess is not None for endpoint in self._endpoints.values()):
+            if self._stage_pool is not None:
+                self._stage_pool.shutdown(wait=False)
+            self._stage_pool = ThreadPoolExecutor(self._stage_workers or os.cpu_count() or 1, thread_name_prefix="potassium-stage")
+            self._stage_queue = BoundedSemaphore(self._stage_queue_size or 2 * self._num_workers * slots_per_worker)
+        recycle_policy = self._recycle_policy
         if self._num_workers == 1:
             Pool = ThreadPool
+            if recycle_policy is not None:
+                print(colored("Worker recycling requires experimental_num_workers > 1, ignoring experimental_recycle_policy", 'yellow'))
+                recycle_policy = None
         else:
             Pool = ProcessPool
+            # worker threads can't die on their own, but worker processes can
+            self._supervisor = WorkerSupervisor(worker_table, index_queue, self._on_worker_died)
+            self._supervisor.start()
         self._worker_pool = Pool(
             self._num_workers,
             init_worker, 
@@ -303,21 +1166,49 @@ class Potassium():
                 self._event_queue,
                 self._response_queue, 
                 self._init_func,
-                self._num_workers
+                self._num_workers,
+                self._control_queues,
+                worker_table,
+                recycle_policy,
+                slots_per_worker,
+                self._warmup_func,
+                self._models,
+                self._model_memory_budget
             )
         )
 
         while True:
             if self._status.num_workers_started == self._num_workers:
                 break
+            time.sleep(0.01)
         print(colored(f"Started {self._num_workers} workers", 'green'))
 
+        concurrency = self._background_concurrency
+        if concurrency is None:
+            background_slots = max([e.concurrency for e in self._endpoints.values() if e.type == HandlerType.BACKGROUND], default=1)
+            concurrency = self._num_workers * background_slots
+        self._background_queue = BackgroundQueue(self._background_journal_path, concurrency, self._dispatch_background, self._job_results)
+        self._background_queue.start()
+
     # serve runs the http server
     def serve(self, host="0.0.0.0", port=8000):
         print(colored("------\nStarting Potassium Server 🍌", 'yellow'))
         self._init_server()
+        from werkzeug.serving import make_server
         server = make_server(host, port, self._flask_app, threaded=True)
         print(colored(f"Serving at http://{host}:{port}\n------", 'green'))
 
+        def drain_and_stop():
+            self.drain()
+            server.shutdown()
+
+        def on_sigterm(signum, frame):
+            # keep serving status and in-flight streams while draining, the handler must return quickly
+            if not self._draining:
+                Thread(target=drain_and_stop, daemon=True).start()
+
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, on_sigterm)
+
         server.serve_forever()
 
@@ -0,0 +1,81 @@
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Dict, Iterable, List
+
+MAX_PROFILE_DURATION = 60
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    # semicolons separate frames in the collapsed stack format
+    return f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})".replace(";", ":")
+
+def sample_stacks(duration: float, interval: float, thread_ids: Iterable[int]) -> Dict[str, int]:
+    """sample_stacks samples the stacks of the given threads every interval seconds, for duration seconds.
+    Returns a count per stack, in the collapsed format used by flamegraph tools (root first, frames
+    separated by semicolons)."""
+    stacks = {}
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        frames = sys._current_frames()
+        for thread_id in list(thread_ids):
+            frame = frames.get(thread_id)
+            labels = []
+            while frame is not None:
+                labels.append(_frame_label(frame))
+                frame = frame.f_back
+            if len(labels) == 0:
+                continue
+            stack = ";".join(reversed(labels))
+            stacks[stack] = stacks.get(stack, 0) + 1
+        time.sleep(interval)
+    return stacks
+
+def _top_allocations(snapshot: tracemalloc.Snapshot, limit: int) -> List[dict]:
+    return [
+        {
+            "location": str(stat.traceback[0]) if len(stat.traceback) else "unknown",
+            "size": stat.size,
+            "count": stat.count,
+        }
+        for stat in snapshot.statistics("lineno")[:limit]
+    ]
+
+def profile(duration: float, interval: float, thread_ids: Iterable[int], allocations: bool = False, allocation_limit: int = 50) -> dict:
+    """profile runs a time boxed sampling profile of thread_ids, and optionally traces allocations made
+    while it runs. Nothing is installed in the interpreter outside of a profile, so there's no overhead
+    when it's not running."""
+    duration = min(max(duration, 0), MAX_PROFILE_DURATION)
+
+    # tracemalloc may already have been started by the user, leave it running if so
+    started_tracemalloc = False
+    if allocations and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        started_tracemalloc = True
+
+    stacks = sample_stacks(duration, interval, thread_ids)
+
+    result = {
+        "duration": duration,
+        "interval": interval,
+        "samples": sum(stacks.values()),
+        "stacks": stacks,
+        "collapsed": "\n".join(f"{stack} {count}" for stack, count in sorted(stacks.items())),
+    }
+
+    if allocations:
+        result["allocations"] = _top_allocations(tracemalloc.take_snapshot(), allocation_limit)
+        if started_tracemalloc:
+            tracemalloc.stop()
+
+    return result
+
+def start_profile_thread(duration: float, interval: float, thread_ids: Iterable[int], allocations: bool, on_done) -> threading.Thread:
+    "start_profile_thread runs profile on a daemon thread and passes its result to on_done"
+    def run():
+        on_done(profile(duration, interval, thread_ids, allocations))
+
+    t = threading.Thread(target=run, daemon=True)
+    t.start()
+    return t
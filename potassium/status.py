@@ -1,9 +1,11 @@
 from enum import Enum
 import time
-from typing import List, Tuple
+from threading import Condition, Lock, Thread
+from typing import Callable, List, Optional, Tuple
 from dataclasses import dataclass
 
 from .types import RequestID
+from .supervisor import WorkerTable, IDLE
 
 class InvalidStatusEvent(Exception):
     pass
@@ -13,7 +15,9 @@ class StatusEvent(Enum):
     INFERENCE_START = "INFERENCE_START"
     INFERENCE_END = "INFERENCE_END"
     WORKER_STARTED = "WORKER_STARTED"
+    WORKER_DIED = "WORKER_DIED"
     BAD_REQUEST_RECEIVED = "BAD_REQUEST_RECEIVED"
+    DRAIN_STARTED = "DRAIN_STARTED"
 
 @dataclass
 class PotassiumStatus():
@@ -25,9 +29,17 @@ class PotassiumStatus():
     num_workers_started: int
     idle_start_timestamp: float
     in_flight_request_start_times: List[Tuple[RequestID, float]]
+    # set once the app stops accepting requests to shut down
+    draining: bool = False
+    # how many requests each worker can run at once
+    slots_per_worker: int = 1
+    # lazily loaded models, summed over workers
+    num_model_loads: int = 0
+    num_model_evictions: int = 0
+    model_bytes: int = 0
 
     @staticmethod
-    def initial(num_workers: int) -> "PotassiumStatus":
+    def initial(num_workers: int, slots_per_worker: int = 1) -> "PotassiumStatus":
         return PotassiumStatus(
             num_started_inference_requests=0,
             num_completed_inference_requests=0,
@@ -35,7 +47,8 @@ class PotassiumStatus():
             num_workers=num_workers,
             num_workers_started=0,
             idle_start_timestamp=time.time(),
-            in_flight_request_start_times=[]
+            in_flight_request_start_times=[],
+            slots_per_worker=slots_per_worker
         )
 
     @property
@@ -44,9 +57,11 @@ class PotassiumStatus():
 
     @property
     def gpu_available(self):
+        if self.draining:
+            return False
         if self.num_workers_started < self.num_workers:
             return False
-        return self.num_workers - self.requests_in_progress > 0
+        return self.num_workers * self.slots_per_worker - self.requests_in_progress > 0
 
     @property
     def sequence_number(self):
@@ -85,7 +100,12 @@ class PotassiumStatus():
             self.num_workers,
             self.num_workers_started,
             self.idle_start_timestamp,
-            self.in_flight_request_start_times
+            self.in_flight_request_start_times,
+            self.draining,
+            self.slots_per_worker,
+            self.num_model_loads,
+            self.num_model_evictions,
+            self.model_bytes
         )
 
 def handle_start_inference(status: PotassiumStatus, request_id: RequestID):
@@ -109,16 +129,153 @@ def handle_worker_started(status: PotassiumStatus):
     status.num_workers_started += 1
     return status
 
+def handle_worker_died(status: PotassiumStatus, worker_num: int):
+    status.num_workers_started -= 1
+    return status
+
 def handle_bad_request_received(status: PotassiumStatus):
     status.num_bad_requests += 1
     return status
 
+def handle_drain_started(status: PotassiumStatus):
+    status.draining = True
+    return status
+
 event_handlers = {
     StatusEvent.INFERENCE_REQUEST_RECEIVED: handle_inference_request_received,
     StatusEvent.INFERENCE_START: handle_start_inference,
     StatusEvent.INFERENCE_END: handle_end_inference,
     StatusEvent.WORKER_STARTED: handle_worker_started,
-    StatusEvent.BAD_REQUEST_RECEIVED: handle_bad_request_received
+    StatusEvent.WORKER_DIED: handle_worker_died,
+    StatusEvent.BAD_REQUEST_RECEIVED: handle_bad_request_received,
+    StatusEvent.DRAIN_STARTED: handle_drain_started
 }
 
+class ServerCounters():
+    """ServerCounters are the parts of the status only the server process writes: requests received,
+    bad requests, requests completed on a worker's behalf (e.g. failed when it died), and draining.
+    The rest of the status is read from the WorkerTable. on_change is called after every change."""
+    def __init__(self, on_change: Optional[Callable[[], None]] = None):
+        self._on_change = on_change
+        self._lock = Lock()
+        self.num_received = 0
+        self.num_bad_requests = 0
+        self.num_completed = 0
+        self.draining = False
+        self.idle_start_timestamp = time.time()
+
+    def _changed(self):
+        if self._on_change is not None:
+            self._on_change()
+
+    def request_received(self):
+        with self._lock:
+            self.num_received += 1
+        self._changed()
+
+    def bad_request_received(self):
+        with self._lock:
+            self.num_bad_requests += 1
+        self._changed()
+
+    def requests_completed(self, count: int = 1):
+        with self._lock:
+            self.num_completed += count
+            self.idle_start_timestamp = time.time()
+        self._changed()
+
+    def drain_started(self):
+        self.draining = True
+        self._changed()
+
+def read_status(table: WorkerTable, counters: ServerCounters, num_workers: int) -> PotassiumStatus:
+    "read_status builds the app's current status from shared memory, without waiting on any worker"
+    num_completed = counters.num_completed
+    idle_start_timestamp = counters.idle_start_timestamp
+    in_flight = []
+    for i in range(len(table.running)):
+        num_completed += table.completed[i]
+        idle_start_timestamp = max(idle_start_timestamp, table.ended_at[i])
+        internal_id = table.running[i]
+        if internal_id != IDLE:
+            in_flight.append((str(internal_id), table.started_at[i]))
+
+    num_workers_started = 0
+    for worker_num, pid in enumerate(table.pids):
+        if pid != 0:
+            num_workers_started += 1
+            idle_start_timestamp = max(idle_start_timestamp, table.worker_started_at[worker_num])
+
+    return PotassiumStatus(
+        num_started_inference_requests=counters.num_received,
+        num_completed_inference_requests=num_completed,
+        num_bad_requests=counters.num_bad_requests,
+        num_workers=num_workers,
+        num_workers_started=num_workers_started,
+        idle_start_timestamp=idle_start_timestamp,
+        in_flight_request_start_times=in_flight,
+        draining=counters.draining,
+        slots_per_worker=table.slots_per_worker,
+        num_model_loads=sum(table.model_loads),
+        num_model_evictions=sum(table.model_evictions),
+        model_bytes=sum(table.model_bytes)
+    )
+
+# the longest a status long-poll can wait for, in seconds
+MAX_STATUS_WAIT = 60
+
+class StatusWatcher():
+    """StatusWatcher wakes long-polls and status streams when the status changes. Workers signal the
+    WorkerTable's status_changed semaphore as requests end and workers start, and the server does
+    for the changes it counts itself, so a transition is seen within milliseconds without polling.
+    Signals that arrive while the status is being read are coalesced into one read."""
+    def __init__(self, read: Callable[[], PotassiumStatus], status_changed, refresh_interval: float = 1.0):
+        self._read = read
+        self._status_changed = status_changed
+        self._refresh_interval = refresh_interval
+        self._cond = Condition()
+        self._stopped = False
+        self.status = read()
+        # incremented on every transition
+        self.version = 0
+        self._key = self._transition_key(self.status)
+
+    @staticmethod
+    def _transition_key(status: PotassiumStatus):
+        # idle and inference times change continuously, they don't make a transition
+        return (status.gpu_available, status.sequence_number, status.requests_in_progress, status.num_workers_started, status.draining)
+
+    def start(self):
+        t = Thread(target=self._watch, daemon=True)
+        t.start()
+
+    def stop(self):
+        self._stopped = True
+
+    def _watch(self):
+        while not self._stopped:
+            # refresh now and then regardless, e.g. after a worker is killed without signalling
+            self._status_changed.acquire(timeout=self._refresh_interval)
+            while self._status_changed.acquire(block=False):
+                pass
+
+            status = self._read()
+            key = self._transition_key(status)
+            with self._cond:
+                self.status = status
+                if key != self._key:
+                    self._key = key
+                    self.version += 1
+                    self._cond.notify_all()
+
+    def wait(self, predicate: Callable[[PotassiumStatus], bool], timeout: float) -> PotassiumStatus:
+        "wait blocks until predicate is true of the status, or timeout seconds, returning the latest status"
+        with self._cond:
+            self._cond.wait_for(lambda: predicate(self.status), min(timeout, MAX_STATUS_WAIT))
+        return self._read()
 
+    def wait_for_transition(self, version: int, timeout: Optional[float]) -> int:
+        "wait_for_transition blocks until the status changes after version, or timeout seconds, returning the current version"
+        with self._cond:
+            self._cond.wait_for(lambda: self.version != version, timeout)
+            return self.version
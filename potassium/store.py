@@ -1,9 +1,13 @@
-from typing import Optional, Union, cast
-import redis
-import boto3
+from typing import Optional, Union, cast, TYPE_CHECKING
+from threading import Lock
+import os
 import pickle
 import json
 
+# redis and boto3 are slow to import, they're only imported once a store uses them
+if TYPE_CHECKING:
+    import redis
+
 
 class Entry():
     def __init__(self, value, expiration):
@@ -13,12 +17,39 @@ class Entry():
 VALID_ENCODINGS = ["json", "pickle"]
 
 class RedisConfig():
-    def __init__(self, host: str, port: str, username: Optional[str] = None, password: Optional[str] = None, db: int = 0, encoding: str = "json"):
-        "encoding can be 'json' or 'pickle'. JSON is default.\nPickle has better support for arbitrary python types, but using pickle with a remote redis introduces a large security risk, see https://stackoverflow.com/questions/2259270/pickle-or-json/2259351#2259351"
+    def __init__(
+        self,
+        host: str,
+        port: str,
+        username: Optional[str] = None,
+        password: Optional[str] = None,
+        db: int = 0,
+        encoding: str = "json",
+        max_connections: Optional[int] = None,
+        pool_timeout: Optional[float] = 20,
+        socket_timeout: Optional[float] = None,
+        socket_connect_timeout: Optional[float] = None,
+        socket_keepalive: bool = False,
+        health_check_interval: int = 0,
+        unix_socket_path: Optional[str] = None
+    ):
+        """encoding can be 'json' or 'pickle'. JSON is default.
+        Pickle has better support for arbitrary python types, but using pickle with a remote redis introduces a large security risk, see https://stackoverflow.com/questions/2259270/pickle-or-json/2259351#2259351
+
+        Connection pooling:
+        - max_connections caps the connections each worker process may open. When set, callers
+          wait up to pool_timeout seconds for a free connection instead of opening a new one
+        - socket_timeout, socket_connect_timeout, socket_keepalive and health_check_interval are
+          passed through to every pooled connection
+        - unix_socket_path connects over a unix socket instead of host and port, which is
+          noticeably faster for a redis running on the same machine
+        """
         # validate args
         if encoding not in VALID_ENCODINGS:
             raise ValueError(
                 "redis config encoding must be one of the following:", VALID_ENCODINGS)
+        if max_connections is not None and max_connections < 1:
+            raise ValueError("redis config max_connections must be at least 1")
 
         self.host = host
         self.port = port
@@ -26,6 +57,40 @@ class RedisConfig():
         self.password = password
         self.db = db
         self.encoding = encoding
+        self.max_connections = max_connections
+        self.pool_timeout = pool_timeout
+        self.socket_timeout = socket_timeout
+        self.socket_connect_timeout = socket_connect_timeout
+        self.socket_keepalive = socket_keepalive
+        self.health_check_interval = health_check_interval
+        self.unix_socket_path = unix_socket_path
+
+    def _create_connection_pool(self) -> "redis.ConnectionPool":
+        import redis
+        kwargs = {
+            "username": self.username,
+            "password": self.password,
+            "db": self.db,
+            "socket_timeout": self.socket_timeout,
+            "health_check_interval": self.health_check_interval,
+        }
+        if self.unix_socket_path is not None:
+            kwargs["connection_class"] = redis.UnixDomainSocketConnection
+            kwargs["path"] = self.unix_socket_path
+        else:
+            kwargs["host"] = self.host
+            kwargs["port"] = int(self.port)
+            kwargs["socket_connect_timeout"] = self.socket_connect_timeout
+            kwargs["socket_keepalive"] = self.socket_keepalive
+
+        if self.max_connections is None:
+            return redis.ConnectionPool(**kwargs)
+        return redis.BlockingConnectionPool(
+            max_connections=self.max_connections,
+            # redis types timeout as int, but takes fractional seconds, and None to wait forever
+            timeout=cast(int, self.pool_timeout),
+            **kwargs
+        )
 
 
 class S3Config():
@@ -61,17 +126,15 @@ class Store():
         if self.backend == "redis":
             if not isinstance(config, RedisConfig):
                 raise ValueError("redis backends require users to bring their own redis, and configure the potassium store to use it with the config argument. For example, to use a local redis, create store with:\n\nfrom potassium.store import Store, RedisConfig\nstore = Store(backend = 'redis', config = RedisConfig(host = 'localhost', port = 6379))")
-            self._redis_client = redis.Redis(
-                host=config.host,
-                port=int(config.port),
-                username=config.username,
-                password=config.password,
-                db=config.db,
-            )
+            self._redis_lock = Lock()
+            self._redis_pid = None
+            self._redis_pool = None
+            self._redis = None
 
         if self.backend == "s3":
             if not isinstance(config, S3Config):
                 raise ValueError("s3 backends require users to bring their own s3 bucket, and configure the potassium store to use it with the config argument. For example, create store with:\n\nfrom potassium.store import Store, S3Config\nstore = Store(backend = 's3', config = S3Config(access_key, secret_access_key, bucket)")
+            import boto3
             session = boto3.Session(
                 aws_access_key_id=config.access_key,
                 aws_secret_access_key=config.secret_access_key
@@ -82,6 +145,44 @@ class Store():
         assert config is not None
         self.config = config
 
+    @property
+    def _redis_client(self) -> "redis.Redis":
+        # connection pools must never be shared between processes, so each worker
+        # forked by the process pool lazily creates its own pool on first use
+        pid = os.getpid()
+        if self._redis_pid != pid:
+            with self._redis_lock:
+                if self._redis_pid != pid:
+                    config = cast(RedisConfig, self.config)
+                    import redis
+                    self._redis_pool = config._create_connection_pool()
+                    self._redis = redis.Redis(connection_pool=self._redis_pool)
+                    self._redis_pid = pid
+        return cast("redis.Redis", self._redis)
+
+    def pool_stats(self) -> dict:
+        "pool_stats reports connection pool utilization for the current process (redis backend only)"
+        if self.backend != "redis":
+            raise ValueError("pool_stats is only available for the redis backend")
+
+        import redis
+        pool = self._redis_client.connection_pool
+        if isinstance(pool, redis.BlockingConnectionPool):
+            created = len(pool._connections)
+            available = len([c for c in pool.pool.queue if c is not None])
+        else:
+            created = pool._created_connections
+            available = len(pool._available_connections)
+
+        config = cast(RedisConfig, self.config)
+        return {
+            "pid": self._redis_pid,
+            "max_connections": config.max_connections,
+            "created_connections": created,
+            "in_use_connections": created - available,
+            "available_connections": available,
+        }
+
     def get(self, key: str):
         if self.backend == "redis":
             encoded = cast(bytes, self._redis_client.get(key))
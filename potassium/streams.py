@@ -0,0 +1,95 @@
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+from typing import Dict
+
+# a stream's worker is paused once this many bytes are buffered in the server, waiting for a slow client
+DEFAULT_HIGH_WATERMARK = 4 * 2**20
+# and resumed once the client has read enough that only this many are left
+DEFAULT_LOW_WATERMARK = 1 * 2**20
+
+# credited to a stream whose client went away, so its worker never waits on it again
+_ABANDONED = 2**62
+
+NO_STREAM = -1
+
+class StreamBuffers():
+    """StreamBuffers is flow control for streamed responses, in shared memory alongside the WorkerTable.
+    For the stream running in each worker slot, the worker counts the bytes it sent and the server the
+    bytes it passed on to the client, the difference being what's buffered in the server. A worker
+    whose stream has more than high_watermark bytes buffered stops iterating the response body until
+    the client catches up to low_watermark, so a slow client can't make the server's memory grow
+    without bound.
+    Every counter has a single writer, the worker (sent) or the server (read), so no locks are needed.
+    Messages a websocket client sends to a worker are flow controlled the same way, with the roles swapped.
+    """
+    def __init__(self, num_slots: int, high_watermark: int = DEFAULT_HIGH_WATERMARK, low_watermark: int = DEFAULT_LOW_WATERMARK):
+        if low_watermark > high_watermark:
+            raise ValueError("low_watermark must not be above high_watermark")
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        # internal id of the stream each slot is running, which the server's reads are credited to
+        self.owner = RawArray('q', [NO_STREAM] * num_slots)
+        self.sent = RawArray('q', num_slots)
+        self.read = RawArray('q', num_slots)
+        self.paused = RawArray('b', num_slots)
+        # times each slot's worker was paused
+        self.pauses = RawArray('q', num_slots)
+        # set by the server once a paused slot's client has caught up
+        self.resume = [multiprocessing.Event() for _ in range(num_slots)]
+
+    def buffered(self, index: int) -> int:
+        return max(self.sent[index] - self.read[index], 0)
+
+    # written by workers
+
+    def start(self, index: int, internal_id: str):
+        # counters are never reset, the stream starts with nothing buffered
+        self.sent[index] = self.read[index]
+        self.owner[index] = int(internal_id)
+
+    def sent_chunk(self, index: int, size: int) -> bool:
+        "sent_chunk counts a chunk sent to the server, returning whether the worker should wait_for_reader"
+        self.sent[index] += size
+        return self.sent[index] - self.read[index] > self.high_watermark
+
+    def wait_for_reader(self, index: int):
+        "wait_for_reader blocks until the stream in slot index is down to low_watermark bytes buffered"
+        self.pauses[index] += 1
+        self.paused[index] = 1
+        while self.sent[index] - self.read[index] > self.low_watermark:
+            self.resume[index].clear()
+            # the server may have caught up before the event was cleared
+            if self.sent[index] - self.read[index] <= self.low_watermark:
+                break
+            # the timeout guards against a wakeup lost between the two
+            self.resume[index].wait(1)
+        self.paused[index] = 0
+
+    # written by the server
+
+    def read_chunk(self, index: int, internal_id: str, size: int):
+        if self.owner[index] != int(internal_id):
+            return
+        self.read[index] += size
+        if self.paused[index] == 1 and self.sent[index] - self.read[index] <= self.low_watermark:
+            self.resume[index].set()
+
+    def abandon(self, index: int, internal_id: str):
+        "abandon releases the worker of a stream that won't be read to the end, e.g. because its client disconnected"
+        if self.owner[index] != int(internal_id):
+            return
+        self.read[index] = _ABANDONED
+        self.resume[index].set()
+
+    def snapshot(self) -> Dict:
+        "snapshot returns the bytes buffered for each running stream, by internal id, and pause counts"
+        buffered = {}
+        for index, owner in enumerate(self.owner):
+            if owner != NO_STREAM and self.sent[index] > self.read[index]:
+                buffered[str(owner)] = self.sent[index] - self.read[index]
+        return {
+            "buffered_bytes": buffered,
+            "total_buffered_bytes": sum(buffered.values()),
+            "num_paused": sum(self.paused),
+            "num_pauses": sum(self.pauses),
+        }
@@ -0,0 +1,150 @@
+import multiprocessing
+import os
+import resource
+import sys
+import time
+from multiprocessing.sharedctypes import RawArray
+from threading import Thread
+from typing import Callable, List, Optional
+
+from .streams import StreamBuffers, DEFAULT_HIGH_WATERMARK, DEFAULT_LOW_WATERMARK
+
+# marks a worker slot with no running request
+IDLE = -1
+
+def current_rss() -> int:
+    "current_rss returns the resident set size of this process in bytes"
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # no procfs (e.g. macOS), fall back to the peak rss
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+class RecyclePolicy():
+    def __init__(self, max_requests: Optional[int] = None, max_memory: Optional[int] = None, memory_probe: Optional[Callable[[], int]] = None):
+        """RecyclePolicy restarts process workers that have handled max_requests requests, or whose memory
+        use has grown past max_memory bytes, once they finish their current request.
+        Memory is the worker's resident set size unless memory_probe is given, e.g. to watch GPU memory:
+
+            RecyclePolicy(max_memory=20 * 2**30, memory_probe=torch.cuda.memory_reserved)
+
+        Only one worker is recycled at a time, so at most one worker's capacity is lost while its
+        replacement runs init().
+        """
+        if max_requests is not None and max_requests < 1:
+            raise ValueError("max_requests must be at least 1")
+
+        self.max_requests = max_requests
+        self.max_memory = max_memory
+        self.memory_probe = memory_probe if memory_probe is not None else current_rss
+
+    def should_recycle(self, num_requests: int) -> bool:
+        if self.max_requests is not None and num_requests >= self.max_requests:
+            return True
+        if self.max_memory is not None and self.memory_probe() > self.max_memory:
+            return True
+        return False
+
+class WorkerTable():
+    """WorkerTable is shared memory written directly by workers: each worker's pid, the internal ids
+    of the requests running in each of its slots, and the counters the app's status is read from.
+    Unlike messages on a queue, which a worker's queue feeder thread may not have flushed when the
+    process is killed, these writes are visible immediately, and cost no IPC.
+    Every entry has a single writer (a worker, or one slot of a worker), so no locks are needed."""
+    def __init__(self, num_workers: int, slots_per_worker: int = 1, stream_high_watermark: int = DEFAULT_HIGH_WATERMARK, stream_low_watermark: int = DEFAULT_LOW_WATERMARK):
+        self.slots_per_worker = slots_per_worker
+        self.pids = RawArray('q', num_workers)
+        # wall clock time each worker finished init()
+        self.worker_started_at = RawArray('d', num_workers)
+        # slot s of worker w is at w * slots_per_worker + s
+        num_slots = num_workers * slots_per_worker
+        self.running = RawArray('q', [IDLE] * num_slots)
+        # wall clock time the running request started, and the last one ended
+        self.started_at = RawArray('d', num_slots)
+        self.ended_at = RawArray('d', num_slots)
+        self.completed = RawArray('q', num_slots)
+        # requests a worker with several slots has taken but not started yet, waiting for a slot or for their
+        # route's concurrency, at most one per slot. Written by the worker's threads under its own lock
+        self.admitted = RawArray('q', [IDLE] * num_slots)
+        # flow control for the response streamed from each slot
+        self.streams = StreamBuffers(num_slots, stream_high_watermark, stream_low_watermark)
+        # and for messages from websocket clients to the session running in each slot, sent by the server
+        self.websocket_inbound = StreamBuffers(num_slots, stream_high_watermark, stream_low_watermark)
+        # lazily loaded models: how many times each worker loaded and evicted one, and the bytes loaded now
+        self.model_loads = RawArray('q', num_workers)
+        self.model_evictions = RawArray('q', num_workers)
+        self.model_bytes = RawArray('q', num_workers)
+        # released whenever the status changes, to wake the server's status watcher
+        self.status_changed = multiprocessing.Semaphore(0)
+        # set by a worker that is exiting to be recycled, cleared by its replacement once started
+        self.recycling = RawArray('b', num_workers)
+        # held from the moment a worker decides to recycle until its replacement has started
+        self.recycle_permit = multiprocessing.BoundedSemaphore(1)
+
+class WorkerSupervisor():
+    """WorkerSupervisor watches process workers for unexpected exits (segfaults, OOM kills).
+
+    multiprocessing.Pool replaces dead processes on its own, but the replacement runs init_worker
+    without a worker number, and whatever request the dead worker was running is never answered.
+    When a worker dies the supervisor returns its number to the index queue, so the replacement
+    initializes as that worker, and hands the requests that were in flight on it to on_worker_died.
+    Workers exiting to be recycled are restarted the same way, but aren't counted as crashes.
+    """
+    def __init__(self, table: WorkerTable, index_queue, on_worker_died: Callable[[int, List[str], bool], None], poll_interval: float = 0.1):
+        self._table = table
+        self._index_queue = index_queue
+        self._on_worker_died = on_worker_died
+        self._poll_interval = poll_interval
+        self._stopped = False
+        self.num_restarts = 0
+        self.num_recycles = 0
+
+    def start(self):
+        t = Thread(target=self._supervise, daemon=True)
+        t.start()
+
+    def stop(self):
+        "stop stops restarting workers, call it before shutting the pool down"
+        self._stopped = True
+
+    @staticmethod
+    def _is_alive(pid: int) -> bool:
+        # the pool reaps its exited workers, after which the pid no longer exists
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def _supervise(self):
+        while not self._stopped:
+            time.sleep(self._poll_interval)
+            for worker_num, pid in enumerate(self._table.pids):
+                if pid == 0 or self._is_alive(pid) or self._stopped:
+                    continue
+
+                slots = self._table.slots_per_worker
+                running = []
+                for index in range(worker_num * slots, (worker_num + 1) * slots):
+                    if self._table.running[index] != IDLE:
+                        running.append(str(self._table.running[index]))
+                        self._table.running[index] = IDLE
+                for index in range(worker_num * slots, (worker_num + 1) * slots):
+                    # a request is briefly in both while it starts
+                    if self._table.admitted[index] != IDLE and str(self._table.admitted[index]) not in running:
+                        running.append(str(self._table.admitted[index]))
+                    self._table.admitted[index] = IDLE
+                self._table.pids[worker_num] = 0
+                recycled = self._table.recycling[worker_num] == 1
+                if recycled:
+                    self.num_recycles += 1
+                else:
+                    self.num_restarts += 1
+
+                # the pool has already started a replacement process, which is waiting on this
+                self._index_queue.put(worker_num)
+                self._on_worker_died(worker_num, running, recycled)
@@ -0,0 +1,171 @@
+import json
+import os
+import time
+from queue import Queue as ThreadQueue
+from threading import Lock, Thread
+from typing import Dict, List, Optional
+
+# stages of a request, in order:
+# - parse: decoding the http request into a potassium Request
+# - queue: waiting in the worker pool until a worker picks the request up
+# - execute: running the handler
+# - serialize: validating, encoding and compressing the handler's Response
+# - dispatch: sending the response back from the worker to the server thread
+# - send: writing the response (or the whole stream) to the client
+STAGES = ["parse", "queue", "execute", "serialize", "dispatch", "send"]
+
+class Trace():
+    """Trace holds monotonic timestamps for one request. time.monotonic is system wide on the
+    platforms potassium runs on, so stamps taken in process workers are comparable."""
+    __slots__ = ("received", "parsed", "worker_start", "executed", "serialized", "delivered", "sent")
+
+    def __init__(self, received: float):
+        self.received = received
+        self.parsed: Optional[float] = None
+        self.worker_start: Optional[float] = None
+        self.executed: Optional[float] = None
+        self.serialized: Optional[float] = None
+        self.delivered: Optional[float] = None
+        self.sent: Optional[float] = None
+
+    def __reduce__(self):
+        return (_restore_trace, (self.received, self.parsed, self.worker_start, self.executed, self.serialized))
+
+    def stage_durations(self) -> Dict[str, float]:
+        "stage_durations returns the duration in seconds of each stage that has completed"
+        stamps = [self.received, self.parsed, self.worker_start, self.executed, self.serialized, self.delivered, self.sent]
+        durations = {}
+        for stage, start, end in zip(STAGES, stamps, stamps[1:]):
+            if start is None or end is None:
+                break
+            durations[stage] = end - start
+        return durations
+
+    def server_timing(self) -> str:
+        "server_timing formats the completed stages as a Server-Timing header value, in milliseconds"
+        durations = self.stage_durations()
+        parts = [f"{stage};dur={duration * 1000:.3f}" for stage, duration in durations.items()]
+        end = self.sent or self.delivered
+        if end is not None:
+            parts.append(f"total;dur={(end - self.received) * 1000:.3f}")
+        return ", ".join(parts)
+
+def _restore_trace(received, parsed, worker_start, executed, serialized):
+    trace = Trace(received)
+    trace.parsed = parsed
+    trace.worker_start = worker_start
+    trace.executed = executed
+    trace.serialized = serialized
+    return trace
+
+def parse_server_timing(header: str) -> Dict[str, float]:
+    "parse_server_timing returns the durations, in milliseconds, from a Server-Timing header"
+    durations = {}
+    for metric in header.split(","):
+        params = metric.strip().split(";")
+        for param in params[1:]:
+            key, _, value = param.strip().partition("=")
+            if key == "dur":
+                try:
+                    durations[params[0].strip()] = float(value)
+                except ValueError:
+                    pass
+    return durations
+
+class TraceStats():
+    "TraceStats aggregates completed traces into per stage counts, means and maxima"
+    def __init__(self):
+        self._lock = Lock()
+        self._count = {stage: 0 for stage in STAGES}
+        self._total = {stage: 0.0 for stage in STAGES}
+        self._max = {stage: 0.0 for stage in STAGES}
+
+    def record(self, trace: Trace):
+        durations = trace.stage_durations()
+        with self._lock:
+            for stage, duration in durations.items():
+                self._count[stage] += 1
+                self._total[stage] += duration
+                if duration > self._max[stage]:
+                    self._max[stage] = duration
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            return {
+                stage: {
+                    "count": self._count[stage],
+                    "mean_ms": self._total[stage] / self._count[stage] * 1000 if self._count[stage] else 0,
+                    "max_ms": self._max[stage] * 1000,
+                }
+                for stage in STAGES
+            }
+
+def _attribute(key: str, value: str) -> dict:
+    return {"key": key, "value": {"stringValue": value}}
+
+class OTLPFileExporter():
+    """OTLPFileExporter appends traces to a local file as OpenTelemetry (OTLP/JSON) spans, one export
+    request per line, in the format of the OpenTelemetry collector's file exporter.
+    Writes happen on a background thread to keep file I/O off the request path."""
+    def __init__(self, path: str, service_name: str):
+        self._path = path
+        self._service_name = service_name
+        self._queue = ThreadQueue()
+        # anchor to convert monotonic stamps into wall clock time
+        self._wall_offset_ns = time.time_ns() - time.monotonic_ns()
+
+        t = Thread(target=self._write_loop, daemon=True)
+        t.start()
+
+    def export(self, trace: Trace, route: str, request_id: str, status: int):
+        self._queue.put((trace, route, request_id, status))
+
+    def _to_ns(self, stamp: float) -> str:
+        return str(int(stamp * 1e9) + self._wall_offset_ns)
+
+    def _spans(self, trace: Trace, route: str, request_id: str, status: int) -> List[dict]:
+        trace_id = os.urandom(16).hex()
+        root_id = os.urandom(8).hex()
+        end = trace.sent or trace.delivered or trace.received
+
+        spans = [{
+            "traceId": trace_id,
+            "spanId": root_id,
+            "name": f"POST {route}",
+            "kind": 2,
+            "startTimeUnixNano": self._to_ns(trace.received),
+            "endTimeUnixNano": self._to_ns(end),
+            "attributes": [
+                _attribute("http.route", route),
+                _attribute("potassium.request_id", request_id),
+                {"key": "http.status_code", "value": {"intValue": str(status)}},
+            ],
+        }]
+
+        start = trace.received
+        for stage, duration in trace.stage_durations().items():
+            spans.append({
+                "traceId": trace_id,
+                "spanId": os.urandom(8).hex(),
+                "parentSpanId": root_id,
+                "name": stage,
+                "kind": 1,
+                "startTimeUnixNano": self._to_ns(start),
+                "endTimeUnixNano": self._to_ns(start + duration),
+            })
+            start += duration
+        return spans
+
+    def _write_loop(self):
+        with open(self._path, "a") as f:
+            while True:
+                trace, route, request_id, status = self._queue.get()
+                export = {"resourceSpans": [{
+                    "resource": {"attributes": [_attribute("service.name", self._service_name)]},
+                    "scopeSpans": [{
+                        "scope": {"name": "potassium"},
+                        "spans": self._spans(trace, route, request_id, status),
+                    }],
+                }]}
+                f.write(json.dumps(export) + "\n")
+                f.flush()
@@ -1,22 +1,91 @@
-from dataclasses import dataclass
-from typing import Any, Callable, Dict, Generator, Optional, Union, Generator, Optional, Union
+from typing import Any, AsyncGenerator, BinaryIO, Callable, Dict, Generator, IO, Iterable, Optional, Tuple, Union
+import io
 import json as jsonlib
+import mmap
+import os
+import shutil
+import tempfile
+from types import MappingProxyType
+
+from .tracing import Trace
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+class JSONBackend():
+    "JSONBackend pairs a loads function taking bytes with a dumps function returning bytes"
+    def __init__(self, name: str, loads: Callable[[bytes], Any], dumps: Callable[[Any], bytes]):
+        self.name = name
+        self.loads = loads
+        self.dumps = dumps
+
+def _stdlib_dumps(obj) -> bytes:
+    return jsonlib.dumps(obj).encode("utf-8")
+
+def _orjson_dumps(obj) -> bytes:
+    assert orjson is not None
+    try:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+    except TypeError:
+        # orjson is stricter than the stdlib (e.g. ints over 64 bits), fall back
+        return _stdlib_dumps(obj)
+
+STDLIB_JSON_BACKEND = JSONBackend("json", jsonlib.loads, _stdlib_dumps)
+ORJSON_JSON_BACKEND = JSONBackend("orjson", orjson.loads, _orjson_dumps) if orjson is not None else None
+
+_json_backend = ORJSON_JSON_BACKEND or STDLIB_JSON_BACKEND
+
+def set_json_backend(backend: Union[str, JSONBackend] = "auto"):
+    """set_json_backend selects the JSON implementation used to parse requests and encode responses.
+    backend can be 'auto' (orjson if installed, otherwise the stdlib), 'orjson', 'json', or a custom JSONBackend
+    """
+    global _json_backend
+    if isinstance(backend, JSONBackend):
+        _json_backend = backend
+    elif backend == "auto":
+        _json_backend = ORJSON_JSON_BACKEND or STDLIB_JSON_BACKEND
+    elif backend == "orjson":
+        if ORJSON_JSON_BACKEND is None:
+            raise ValueError("orjson json backend requested but orjson is not installed")
+        _json_backend = ORJSON_JSON_BACKEND
+    elif backend == "json":
+        _json_backend = STDLIB_JSON_BACKEND
+    else:
+        raise ValueError("json backend must be one of the following:", ["auto", "orjson", "json"])
+
+def get_json_backend() -> JSONBackend:
+    return _json_backend
+
+def json_loads(data: bytes) -> Any:
+    return _json_backend.loads(data)
+
+def json_dumps(obj: Any) -> bytes:
+    return _json_backend.dumps(obj)
 
 class RequestHeaders():
-    def __init__(self, headers: Dict[str, str]):
-        self._headers = {}
-        for key in headers:
-            self._headers[self._normalize_key(key)] = headers[key]
+    __slots__ = ("_raw_headers", "_headers")
+
+    def __init__(self, headers: Union[Dict[str, str], Iterable[Tuple[str, str]]]):
+        # headers are only normalized on first lookup, most handlers never read them
+        self._raw_headers = headers
+        self._headers = None
 
     def _normalize_key(self, key):
         if not isinstance(key, str):
             raise KeyError(key)
         return key.upper().replace("-", "_")
 
+    def _normalized(self) -> Dict[str, str]:
+        if self._headers is None:
+            items = self._raw_headers.items() if isinstance(self._raw_headers, dict) else self._raw_headers
+            self._headers = {self._normalize_key(key): value for key, value in items}
+        return self._headers
+
     def __getitem__(self, key):
-        print(self._headers)
         key = self._normalize_key(key)
-        return self._headers[key]
+        return self._normalized()[key]
 
     def get(self, key, default=None):
         try:
@@ -24,45 +93,228 @@ class RequestHeaders():
         except KeyError:
             return default
 
-@dataclass
+    def __reduce__(self):
+        # only the raw headers are sent to process workers, normalization happens on demand there
+        return (RequestHeaders, (self._raw_headers,))
+
+DEFAULT_SPOOL_THRESHOLD = 1024 * 1024
+
+class RequestFile():
+    """RequestFile is a binary upload. Uploads up to the spool threshold are held in memory as bytes,
+    larger ones are spooled to a temporary file and memory mapped on access, so that only the file
+    path has to be sent to process workers.
+    """
+    __slots__ = ("filename", "content_type", "path", "_data", "_mmap")
+
+    def __init__(self, data: Optional[bytes] = None, path: Optional[str] = None, filename: Optional[str] = None, content_type: Optional[str] = None):
+        assert (data is None) != (path is None), "RequestFile must have exactly one of data or path set"
+        self.filename = filename
+        self.content_type = content_type
+        self.path = path
+        self._data = data
+        self._mmap = None
+
+    @staticmethod
+    def from_stream(stream: IO[bytes], spool_threshold: int = DEFAULT_SPOOL_THRESHOLD, filename: Optional[str] = None, content_type: Optional[str] = None) -> "RequestFile":
+        head = stream.read(spool_threshold + 1)
+        if len(head) <= spool_threshold:
+            return RequestFile(data=head, filename=filename, content_type=content_type)
+
+        with tempfile.NamedTemporaryFile(prefix="potassium-upload-", delete=False) as f:
+            f.write(head)
+            shutil.copyfileobj(stream, f)
+        return RequestFile(path=f.name, filename=filename, content_type=content_type)
+
+    @property
+    def size(self) -> int:
+        if self._data is not None:
+            return len(self._data)
+        assert self.path is not None
+        return os.path.getsize(self.path)
+
+    @property
+    def data(self) -> Union[bytes, memoryview]:
+        "data returns the upload as bytes, or as a memoryview over the spooled file"
+        if self._data is not None:
+            return self._data
+        if self._mmap is None:
+            assert self.path is not None
+            if self.size == 0:
+                return b""
+            with open(self.path, "rb") as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(self._mmap)
+
+    def open(self) -> BinaryIO:
+        "open returns the upload as a file-like object"
+        if self._data is not None:
+            return io.BytesIO(self._data)
+        assert self.path is not None
+        return open(self.path, "rb")
+
+    def close(self):
+        "close releases the spooled file, if any. It is called automatically once the request is handled"
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # a memoryview is still held by user code, let it be garbage collected
+                pass
+            self._mmap = None
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __reduce__(self):
+        return (RequestFile, (self._data, self.path, self.filename, self.content_type))
+
+# shared read-only default for requests without files or form fields
+_EMPTY_MAPPING = MappingProxyType({})
+
+# marks JSON that has not been decoded from the request body yet
+_NOT_DECODED = object()
+
+def _restore_request(id, headers, json, body, json_from_body, files, form, trace, stage_input=None, compress=True):
+    req = Request(id, headers, json=json, body=body, files=files, form=form)
+    req._trace = trace
+    req._stage_input = stage_input
+    req._compress = compress
+    if json_from_body:
+        req._json = _NOT_DECODED
+        req._json_from_body = True
+    return req
+
 class Request():
-    id: str
-    headers: RequestHeaders
-    json: Dict[str, Any]
+    __slots__ = ("id", "headers", "files", "form", "_body", "_json", "_json_from_body", "_trace", "_stage_input", "_compress")
+
+    def __init__(
+        self,
+        id: str,
+        headers: RequestHeaders,
+        json: Optional[Dict[str, Any]] = None,
+        body: Union[None, bytes, RequestFile] = None,
+        files: Optional[Dict[str, RequestFile]] = None,
+        form: Optional[Dict[str, str]] = None
+    ):
+        self.id = id
+        self.headers = headers
+        self.files = files if files is not None else _EMPTY_MAPPING
+        self.form = form if form is not None else _EMPTY_MAPPING
+        self._body = body
+        self._json = json
+        self._json_from_body = False
+        self._trace: Optional[Trace] = None
+        # the output of a staged handler's preprocess, which its infer stage gets instead of the request
+        self._stage_input: Any = None
+        # whether the response may be compressed per Accept-Encoding, which only requests from http clients are
+        self._compress = True
+
+    @staticmethod
+    def from_json_body(id: str, headers: RequestHeaders, body: bytes, json: Any = _NOT_DECODED) -> "Request":
+        "from_json_body creates a request whose json is decoded lazily from the raw body, unless already given"
+        req = Request(id, headers, body=body)
+        req._json = json
+        req._json_from_body = True
+        return req
+
+    @property
+    def json(self) -> Optional[Dict[str, Any]]:
+        if self._json is _NOT_DECODED:
+            assert isinstance(self._body, bytes)
+            self._json = json_loads(self._body)
+        return self._json
+
+    @json.setter
+    def json(self, json):
+        self._json = json
+        self._json_from_body = False
 
-ResponseBody = Union[bytes, Generator[bytes, None, None]]
+    @property
+    def body(self) -> Union[None, bytes, memoryview]:
+        "body returns the raw request body, as a memoryview if it was large enough to be spooled to disk"
+        if isinstance(self._body, RequestFile):
+            return self._body.data
+        return self._body
+
+    @property
+    def stream(self) -> BinaryIO:
+        "stream returns the raw request body as a file-like object"
+        if isinstance(self._body, RequestFile):
+            return self._body.open()
+        return io.BytesIO(self._body if self._body is not None else b"")
+
+    def close(self):
+        if isinstance(self._body, RequestFile):
+            self._body.close()
+        for f in self.files.values():
+            f.close()
+
+    def __reduce__(self):
+        # JSON requests are sent to process workers as their raw body and decoded lazily
+        # there, pickling bytes is far cheaper than pickling the decoded object
+        json = None if self._json_from_body else self._json
+        files = dict(self.files) if self.files else None
+        form = dict(self.form) if self.form else None
+        return (_restore_request, (self.id, self.headers, json, self._body, self._json_from_body, files, form, self._trace, self._stage_input, self._compress))
+
+ResponseBody = Union[bytes, Generator[bytes, None, None], AsyncGenerator[bytes, None]]
 RequestID = str
 
+# marks a response whose body was not set from json
+_NO_JSON = object()
+
 class Response():
+    __slots__ = ("status", "headers", "_body", "_json")
+
     def __init__(self, status: int = 200, json: Optional[dict] = None, headers: Optional[dict] = None, body: Optional[ResponseBody] = None):
         assert json == None or body == None, "Potassium Response object cannot have both json and body set"
 
 
         self.headers = headers if headers != None else {}
 
-        # convert json to body if not None
+        # json is only encoded into the body when the body is first read
         if json != None:
-            self.body = jsonlib.dumps(json).encode("utf-8")
+            self._json = json
+            self._body = None
             self.headers["Content-Type"] = "application/json"
         else:
-            self.body = body
+            self._json = _NO_JSON
+            self._body = body
 
         self.status = status
 
+    @property
+    def body(self) -> Optional[ResponseBody]:
+        if self._json is not _NO_JSON:
+            self._body = json_dumps(self._json)
+            self._json = _NO_JSON
+        return self._body
+
+    @body.setter
+    def body(self, body: Optional[ResponseBody]):
+        self._body = body
+        self._json = _NO_JSON
+
     @property
     def json(self):
-        if self.body == None:
+        if self._json is not _NO_JSON:
+            return self._json
+        if self._body == None:
             return None
-        if type(self.body) == bytes:
+        if type(self._body) == bytes:
             try:
-                return jsonlib.loads(self.body.decode("utf-8"))
+                return json_loads(self._body)
             except:
                 return None
         return None
             
     @json.setter
     def json(self, json):
-        self.body = jsonlib.dumps(json).encode("utf-8")
+        self._json = json
+        self._body = None
         self.headers["Content-Type"] = "application/json"
 
+    def __reduce__(self):
+        # encode json in the worker, never in the server process
+        return (Response, (self.status, None, self.headers, self.body))
+
 
@@ -0,0 +1,215 @@
+import base64
+import hashlib
+import socket
+import struct
+from queue import Queue as ThreadQueue, Empty
+from threading import Lock
+from typing import Callable, Optional, Union
+
+from .types import Request
+
+# RFC 6455
+_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+CLOSE_NORMAL = 1000
+CLOSE_GOING_AWAY = 1001
+CLOSE_PROTOCOL_ERROR = 1002
+CLOSE_INVALID_DATA = 1007
+CLOSE_TOO_BIG = 1009
+CLOSE_INTERNAL_ERROR = 1011
+
+# the largest message a client can send, in bytes
+MAX_MESSAGE_SIZE = 16 * 2**20
+
+Message = Union[str, bytes]
+
+class WebSocketClosed(Exception):
+    pass
+
+def accept_key(key: str) -> str:
+    "accept_key returns the Sec-WebSocket-Accept header for a client's Sec-WebSocket-Key"
+    return base64.b64encode(hashlib.sha1((key + _GUID).encode("ascii")).digest()).decode("ascii")
+
+def is_upgrade(headers) -> bool:
+    return (
+        "websocket" in headers.get("Upgrade", "").lower()
+        and "upgrade" in headers.get("Connection", "").lower()
+        and headers.get("Sec-WebSocket-Key") is not None
+        and headers.get("Sec-WebSocket-Version") == "13"
+    )
+
+def _unmask(payload: bytes, mask: bytes) -> bytes:
+    # xor as one big integer, much faster than byte by byte
+    if len(payload) == 0:
+        return payload
+    repeated = (mask * (len(payload) // 4 + 1))[:len(payload)]
+    return (int.from_bytes(payload, "big") ^ int.from_bytes(repeated, "big")).to_bytes(len(payload), "big")
+
+def encode_frame(opcode: int, payload: bytes, mask: Optional[bytes] = None) -> bytes:
+    "encode_frame encodes a single, final frame. Servers send unmasked frames, clients masked ones"
+    header = bytes([0x80 | opcode])
+    mask_bit = 0x80 if mask is not None else 0
+    length = len(payload)
+    if length < 126:
+        header += bytes([mask_bit | length])
+    elif length < 2**16:
+        header += bytes([mask_bit | 126]) + struct.pack("!H", length)
+    else:
+        header += bytes([mask_bit | 127]) + struct.pack("!Q", length)
+    if mask is not None:
+        return header + mask + _unmask(payload, mask)
+    return header + payload
+
+class WebSocketConnection():
+    """WebSocketConnection is the server's end of a websocket, on the raw socket of the http
+    connection it was upgraded from. Frames are sent from several threads, under a lock.
+    """
+    def __init__(self, sock: socket.socket, max_message_size: int = MAX_MESSAGE_SIZE):
+        self._sock = sock
+        self._max_message_size = max_message_size
+        self._send_lock = Lock()
+        self.close_sent = False
+
+    def accept(self, key: str):
+        self._sock.sendall((
+            "HTTP/1.1 101 Switching Protocols\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            f"Sec-WebSocket-Accept: {accept_key(key)}\r\n\r\n"
+        ).encode("ascii"))
+
+    def _recv_exactly(self, n: int) -> bytes:
+        chunks = []
+        while n > 0:
+            chunk = self._sock.recv(min(n, 2**20))
+            if len(chunk) == 0:
+                raise ConnectionError("connection closed")
+            chunks.append(chunk)
+            n -= len(chunk)
+        return b"".join(chunks)
+
+    def _read_frame(self):
+        b0, b1 = self._recv_exactly(2)
+        fin = b0 & 0x80 != 0
+        opcode = b0 & 0x0F
+        length = b1 & 0x7F
+        if length == 126:
+            length = struct.unpack("!H", self._recv_exactly(2))[0]
+        elif length == 127:
+            length = struct.unpack("!Q", self._recv_exactly(8))[0]
+        if b1 & 0x80 == 0:
+            # client frames must be masked
+            raise WebSocketClosed(CLOSE_PROTOCOL_ERROR)
+        if length > self._max_message_size:
+            raise WebSocketClosed(CLOSE_TOO_BIG)
+        mask = self._recv_exactly(4)
+        return fin, opcode, _unmask(self._recv_exactly(length), mask)
+
+    def receive(self) -> Optional[Message]:
+        "receive returns the next message from the client, or None once the connection is closed"
+        fragments = []
+        message_opcode = None
+        try:
+            while True:
+                fin, opcode, payload = self._read_frame()
+                if opcode == OP_PING:
+                    self.send_frame(OP_PONG, payload)
+                    continue
+                if opcode == OP_PONG:
+                    continue
+                if opcode == OP_CLOSE:
+                    code = struct.unpack("!H", payload[:2])[0] if len(payload) >= 2 else CLOSE_NORMAL
+                    self.close(code)
+                    return None
+                if opcode == OP_CONTINUATION:
+                    if message_opcode is None:
+                        raise WebSocketClosed(CLOSE_PROTOCOL_ERROR)
+                elif opcode in (OP_TEXT, OP_BINARY):
+                    if message_opcode is not None:
+                        raise WebSocketClosed(CLOSE_PROTOCOL_ERROR)
+                    message_opcode = opcode
+                else:
+                    raise WebSocketClosed(CLOSE_PROTOCOL_ERROR)
+
+                fragments.append(payload)
+                if sum(len(fragment) for fragment in fragments) > self._max_message_size:
+                    raise WebSocketClosed(CLOSE_TOO_BIG)
+                if fin:
+                    data = b"".join(fragments)
+                    if message_opcode == OP_BINARY:
+                        return data
+                    try:
+                        return data.decode("utf-8")
+                    except UnicodeDecodeError:
+                        raise WebSocketClosed(CLOSE_INVALID_DATA)
+        except WebSocketClosed as e:
+            self.close(e.args[0])
+            return None
+        except (ConnectionError, OSError):
+            return None
+
+    def send_frame(self, opcode: int, payload: bytes):
+        with self._send_lock:
+            if self.close_sent:
+                return
+            if opcode == OP_CLOSE:
+                self.close_sent = True
+            self._sock.sendall(encode_frame(opcode, payload))
+
+    def send(self, message: Message):
+        if isinstance(message, str):
+            self.send_frame(OP_TEXT, message.encode("utf-8"))
+        else:
+            self.send_frame(OP_BINARY, bytes(message))
+
+    def close(self, code: int = CLOSE_NORMAL):
+        try:
+            self.send_frame(OP_CLOSE, struct.pack("!H", code))
+        except OSError:
+            pass
+
+    def shutdown(self):
+        "shutdown closes the underlying connection, unblocking a receive() waiting on it"
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+class WebSocket():
+    """WebSocket is a websocket handler's end of the session with a client, on the worker running
+    the handler. Messages are str for text and bytes for binary frames.
+    receive() waits for the next message from the client, returning None once the client has closed
+    the connection. send() waits while the client is too far behind in reading what was sent.
+    """
+    def __init__(self, request: Request, inbound: "ThreadQueue[Optional[Message]]", send: Callable[[Message], None], on_receive: Callable[[int], None]):
+        self.request = request
+        self._inbound = inbound
+        self._send = send
+        self._on_receive = on_receive
+        self.closed = False
+
+    def receive(self, timeout: Optional[float] = None) -> Optional[Message]:
+        "receive returns the next message, None once the client is gone, raising TimeoutError after timeout seconds"
+        if self.closed:
+            return None
+        try:
+            message = self._inbound.get(timeout=timeout)
+        except Empty:
+            raise TimeoutError("no message received")
+        if message is None:
+            self.closed = True
+            return None
+        self._on_receive(len(message))
+        return message
+
+    def send(self, message: Message):
+        if not isinstance(message, (str, bytes)):
+            raise Exception("WebSocket messages must be str or bytes", type(message))
+        self._send(message)
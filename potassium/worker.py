@@ -1,15 +1,29 @@
+import asyncio
+from enum import Enum
 from multiprocessing import Queue
 import os
+import signal
 import threading
-from typing import Dict, Any, Generator
-from dataclasses import dataclass
-from flask import make_response, Response as FlaskResponse
+from typing import AsyncGenerator, Callable, Deque, Dict, Any, Generator, List, Optional, Set, Tuple
+import sys
+from collections import deque
+from types import AsyncGeneratorType
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue as ThreadQueue
 from termcolor import colored
 import traceback
 import inspect
+import functools
+import time
 
 from .status import StatusEvent
-from .types import Response
+from .types import Response, json_dumps
+from .profiling import start_profile_thread
+from .supervisor import WorkerTable, RecyclePolicy, IDLE
+from .models import LazyContext
+from .batching import BatchConfig, BatchSequence, ContinuousBatcher
+from .websocket import Message, WebSocket
 
 worker = None
 
@@ -43,20 +57,154 @@ class FDRedirect():
         t.start()
 
 
+class Reply(Enum):
+    "Reply is what a worker sends back to the server once a request is done"
+    # a Response, streamed if its body is a generator
+    RESPONSE = "RESPONSE"
+    # a background job's result, encoded as JSON
+    JOB_RESULT = "JOB_RESULT"
+    # whatever the function returned, for the server to finish, e.g. the infer stage of a staged handler
+    VALUE = "VALUE"
+    # the messages a websocket handler sends, streamed until the session ends
+    WEBSOCKET = "WEBSOCKET"
+
+class ControlCommand(Enum):
+    PROFILE = "PROFILE"
+    WARMUP = "WARMUP"
+    WEBSOCKET_MESSAGE = "WEBSOCKET_MESSAGE"
+
 @dataclass
 class Worker():
     worker_num: int
     total_workers: int
     context: Dict[Any, Any]
-    event_queue: Queue
+    # only set when status events are audited
+    event_queue: Optional[Queue]
     response_queue: Queue
+    control_queue: Queue
+    table: WorkerTable
     stderr_redirect: FDRedirect
     stdout_redirect: FDRedirect
+    # threads that have run requests, these are the threads sampled when profiling
+    thread_ids: Set[int]
+    recycle_policy: Optional[RecyclePolicy]
+    # with more than one slot, requests run on executor threads so that a worker can run several at once
+    slots_per_worker: int = 1
+    executor: Optional[ThreadPoolExecutor] = None
+    free_slots: Optional["ThreadQueue[int]"] = None
+    # per handler limits on how many of its requests run at once, and its requests waiting for one to finish
+    routes: Dict[Callable, "RouteQueue"] = field(default_factory=dict)
+    routes_cond: threading.Condition = field(default_factory=threading.Condition)
+    # entries of the worker table's admitted array that are free, and the entry of each request waiting for a slot
+    free_admissions: List[int] = field(default_factory=list)
+    admissions: Dict[str, int] = field(default_factory=dict)
+    # requests admitted to this worker that haven't finished, running or waiting
+    in_flight: int = 0
+    in_flight_cond: threading.Condition = field(default_factory=threading.Condition)
+    # runs async handlers, started on first use
+    loop: Optional[asyncio.AbstractEventLoop] = None
+    loop_lock: threading.Lock = field(default_factory=threading.Lock)
+    num_requests: int = 0
+    warmup_func: Optional[Callable] = None
+    # continuously batched routes' batchers, by step function, started on first use
+    batchers: Dict[Callable, ContinuousBatcher] = field(default_factory=dict)
+    batchers_lock: threading.Lock = field(default_factory=threading.Lock)
+    # messages from the client of each websocket session running on this worker, by internal id
+    sessions: Dict[str, ThreadQueue] = field(default_factory=dict)
+
+def _handle_profile(worker: Worker, reply_id, duration, interval, allocations):
+    def on_done(result):
+        result["worker"] = worker.worker_num
+        result["pid"] = os.getpid()
+        worker.response_queue.put((reply_id, result))
+
+    start_profile_thread(duration, interval, worker.thread_ids, allocations, on_done)
+
+def _warm_up(warmup_func, context) -> Tuple[float, Optional[str]]:
+    "_warm_up runs the app's warmup hook, returning how long it took and the traceback if it failed"
+    start = time.monotonic()
+    try:
+        warmup_func(context)
+    except Exception:
+        tb_str = traceback.format_exc()
+        print(colored(tb_str, "red"))
+        return time.monotonic() - start, tb_str
+    return time.monotonic() - start, None
+
+def _handle_warmup(worker: Worker, reply_id):
+    warmup_func = worker.warmup_func
+    assert warmup_func is not None
+
+    # runs on its own thread, like a profile, so the control loop goes on forwarding
+    # commands such as websocket messages while the hook runs
+    def run():
+        thread_id = threading.get_ident()
+        worker.thread_ids.add(thread_id)
+        try:
+            duration, error = _warm_up(warmup_func, worker.context)
+        finally:
+            worker.thread_ids.discard(thread_id)
+        worker.response_queue.put((reply_id, {
+            "worker": worker.worker_num,
+            "pid": os.getpid(),
+            "duration_ms": int(duration*1000),
+            "error": error,
+        }))
+
+    threading.Thread(target=run, daemon=True).start()
 
-def init_worker(index_queue, event_queue, response_queue, init_func, total_workers):
+def _handle_websocket_message(worker: Worker, internal_id, message):
+    # a session that has already ended drops what its client sent meanwhile
+    inbound = worker.sessions.get(internal_id)
+    if inbound is not None:
+        inbound.put(message)
+
+control_handlers = {
+    ControlCommand.PROFILE: _handle_profile,
+    ControlCommand.WARMUP: _handle_warmup,
+    ControlCommand.WEBSOCKET_MESSAGE: _handle_websocket_message,
+}
+
+def _control_loop(worker: Worker):
+    # commands sent to this specific worker by the server, as opposed to requests which
+    # go to whichever worker is free. This thread is blocked on the queue when idle
+    try:
+        while True:
+            command = worker.control_queue.get()
+            control_handlers[command[0]](worker, *command[1:])
+    except EOFError:
+        # queue closed, the server is shutting down
+        pass
+
+def _recycle(worker: Worker):
+    # if another worker is already being recycled, try again after the next request
+    if not worker.table.recycle_permit.acquire(block=False):
+        return
+
+    print(colored(f"Recycling worker after {worker.num_requests} requests", 'yellow'))
+    worker.table.recycling[worker.worker_num] = 1
+    # no new requests are taken while this waits, let the ones running on other threads finish
+    with worker.in_flight_cond:
+        while worker.in_flight > 0:
+            worker.in_flight_cond.wait()
+    # flush responses and events still buffered in this process before exiting
+    for queue in (worker.response_queue, worker.event_queue):
+        if queue is None:
+            continue
+        queue.close()
+        queue.join_thread()
+    # the pool starts a replacement process, which the supervisor initializes as this worker
+    sys.exit(0)
+
+def init_worker(index_queue, event_queue, response_queue, init_func, total_workers, control_queues, worker_table, recycle_policy=None, slots_per_worker=1, warmup_func=None, models=None, model_memory_budget=None):
     global worker
     worker_num = index_queue.get()
 
+    # process workers are forked from the server, which drains on SIGTERM. Workers must keep
+    # the default handler so the pool can still terminate them
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
     stdout_redirect = FDRedirect(1)
     stderr_redirect = FDRedirect(2)
 
@@ -79,7 +227,37 @@ def init_worker(index_queue, event_queue, response_queue, init_func, total_worke
     if not isinstance(context, dict):
         raise Exception("Potassium init() must return a dictionary")
 
-    event_queue.put((StatusEvent.WORKER_STARTED,))
+    # declared models are loaded on first use rather than here
+    if models:
+        def on_models_changed(num_loads, num_evictions, loaded_bytes):
+            worker_table.model_loads[worker_num] = num_loads
+            worker_table.model_evictions[worker_num] = num_evictions
+            worker_table.model_bytes[worker_num] = loaded_bytes
+
+        # a replacement worker starts with nothing loaded, but keeps counting from its predecessor
+        context = LazyContext(context, models, model_memory_budget, on_models_changed)
+        context.num_loads = worker_table.model_loads[worker_num]
+        context.num_evictions = worker_table.model_evictions[worker_num]
+        worker_table.model_bytes[worker_num] = 0
+
+    # warm up before the worker counts as started, so its first request runs at steady-state latency.
+    # A failed warmup only makes the first requests slower, the worker still starts
+    if warmup_func is not None:
+        print(colored("Running warmup()", 'yellow'))
+        duration, error = _warm_up(warmup_func, context)
+        if error is None:
+            print(colored(f"Warmed up in {duration:.2f}s", 'yellow'))
+
+    worker_table.worker_started_at[worker_num] = time.time()
+    worker_table.pids[worker_num] = os.getpid()
+    worker_table.status_changed.release()
+    if event_queue is not None:
+        event_queue.put((StatusEvent.WORKER_STARTED,))
+
+    # this worker replaces one that was recycled, let the next one go
+    if worker_table.recycling[worker_num] == 1:
+        worker_table.recycling[worker_num] = 0
+        worker_table.recycle_permit.release()
 
     worker = Worker(
         worker_num,
@@ -87,58 +265,426 @@ def init_worker(index_queue, event_queue, response_queue, init_func, total_worke
         context,
         event_queue,
         response_queue,
+        control_queues[worker_num],
+        worker_table,
         stdout_redirect,
-        stderr_redirect
+        stderr_redirect,
+        {threading.get_ident()},
+        recycle_policy,
+        slots_per_worker,
+        warmup_func=warmup_func
     )
+    if slots_per_worker > 1:
+        worker.executor = ThreadPoolExecutor(slots_per_worker, thread_name_prefix="potassium-slot")
+        worker.free_slots = ThreadQueue()
+        for slot in range(slots_per_worker):
+            worker.free_slots.put(slot)
+            worker.free_admissions.append(worker_num * slots_per_worker + slot)
 
-def run_worker(func, request, internal_id, use_response=False):
+    t = threading.Thread(target=_control_loop, args=(worker,), daemon=True)
+    t.start()
+
+def _event_loop(worker: Worker) -> asyncio.AbstractEventLoop:
+    "_event_loop returns the worker's event loop for async handlers, starting it on first use"
+    with worker.loop_lock:
+        if worker.loop is None:
+            loop = asyncio.new_event_loop()
+            started = threading.Event()
+
+            def run():
+                asyncio.set_event_loop(loop)
+                worker.thread_ids.add(threading.get_ident())
+                loop.call_soon(started.set)
+                loop.run_forever()
+
+            t = threading.Thread(target=run, daemon=True)
+            t.start()
+            started.wait()
+            worker.loop = loop
+        return worker.loop
+
+def _iterate_async(worker: Worker, generator: AsyncGenerator) -> Generator:
+    "_iterate_async iterates an async generator from a synchronous thread, on the worker's event loop"
+    loop = _event_loop(worker)
+    while True:
+        try:
+            yield asyncio.run_coroutine_threadsafe(generator.__anext__(), loop).result()
+        except StopAsyncIteration:
+            return
+
+def run_worker(func, request, internal_id, reply=Reply.JOB_RESULT, concurrency=1, batch: Optional[BatchConfig] = None):
     assert worker is not None, "worker is not initialized"
-    
-    if worker.total_workers > 1:
-        prefix = f"[worker {worker.worker_num}, requestID {request.id}] "
+
+    is_async = inspect.iscoroutinefunction(func)
+    if batch is not None:
+        _start_sequence(worker, func, request, internal_id, batch)
+    elif worker.slots_per_worker == 1:
+        if is_async:
+            coro = _run_request_async(worker, func, request, internal_id, reply, 0)
+            asyncio.run_coroutine_threadsafe(coro, _event_loop(worker)).result()
+        else:
+            _run_request(worker, func, request, internal_id, reply, 0)
+    else:
+        _start_request(worker, func, request, internal_id, reply, concurrency, is_async)
+
+    worker.num_requests += 1
+    if worker.recycle_policy is not None and worker.recycle_policy.should_recycle(worker.num_requests):
+        _recycle(worker)
+
+class RouteQueue():
+    "RouteQueue admits a handler's requests on a worker: how many of them hold a slot, and the ones waiting for one"
+    def __init__(self, concurrency: int):
+        self.concurrency = concurrency
+        self.running = 0
+        # each waiting request's start function, called with the slot it's handed
+        self.waiting: "Deque[Callable[[int], None]]" = deque()
+
+def _admit(worker: Worker, func, concurrency, internal_id, start: Callable[[int], None]):
+    """_admit calls start(slot) once func is below its concurrency and the worker has a free slot. start must not
+    block, and the request calls _release once it's done. A request to a handler at its limit waits in the
+    handler's queue, to be handed the slot of the first of its requests to finish, so the pool's thread goes
+    on taking requests for the worker's other handlers. The pool's thread blocks while every slot is taken,
+    or while as many requests are waiting as the worker has slots, leaving the next ones to other workers.
+    """
+    free_slots = worker.free_slots
+    assert free_slots is not None
+    with worker.in_flight_cond:
+        worker.in_flight += 1
+    with worker.routes_cond:
+        # until it's running, the request is recorded in the worker table's admitted array instead,
+        # so that if this worker dies the supervisor fails it along with the running ones
+        admission = worker.free_admissions.pop()
+        worker.admissions[internal_id] = admission
+        worker.table.admitted[admission] = int(internal_id)
+        route = worker.routes.get(func)
+        if route is None:
+            route = worker.routes[func] = RouteQueue(concurrency)
+        waiting = route.running >= route.concurrency
+        if waiting:
+            route.waiting.append(start)
+        else:
+            route.running += 1
+    if not waiting:
+        start(free_slots.get())
+    # the pool's next request is only taken once there's an entry to record it in
+    with worker.routes_cond:
+        while not worker.free_admissions:
+            worker.routes_cond.wait()
+
+def _admitted(worker: Worker, internal_id):
+    "_admitted frees the admitted entry of a request that's now recorded as running"
+    with worker.routes_cond:
+        admission = worker.admissions.pop(internal_id, None)
+        if admission is None:
+            return
+        worker.table.admitted[admission] = IDLE
+        worker.free_admissions.append(admission)
+        worker.routes_cond.notify_all()
+
+def _release(worker: Worker, func, slot: int):
+    "_release frees the slot of one of func's requests, handing it to the next request waiting for func if there is one"
+    free_slots = worker.free_slots
+    assert free_slots is not None
+    with worker.routes_cond:
+        route = worker.routes[func]
+        next_start = route.waiting.popleft() if route.waiting else None
+        if next_start is None:
+            route.running -= 1
+    with worker.in_flight_cond:
+        worker.in_flight -= 1
+        worker.in_flight_cond.notify_all()
+    if next_start is not None:
+        next_start(slot)
     else:
-        prefix = f"[requestID {request.id}] "
+        free_slots.put(slot)
+
+def _start_request(worker: Worker, func, request, internal_id, reply, concurrency, is_async):
+    executor = worker.executor
+    assert executor is not None
+
+    def start(slot):
+        if is_async:
+            # async handlers run as tasks on the worker's event loop rather than on a thread each
+            coro = _run_request_async(worker, func, request, internal_id, reply, slot)
+            asyncio.run_coroutine_threadsafe(coro, _event_loop(worker)).add_done_callback(lambda _: _release(worker, func, slot))
+            return
+
+        def run():
+            try:
+                _run_request(worker, func, request, internal_id, reply, slot)
+            finally:
+                _release(worker, func, slot)
+
+        executor.submit(run)
+
+    _admit(worker, func, concurrency, internal_id, start)
+
+def _start_sequence(worker: Worker, step, request, internal_id, batch: BatchConfig):
+    # a sequence holds a slot for as long as it's in the batch, with a single slot there's
+    # no one to release it, so the pool's thread waits for the sequence instead
+    if worker.slots_per_worker == 1:
+        done = threading.Event()
+        _begin_sequence(worker, step, request, internal_id, batch, 0, done.set)
+        done.wait()
+    else:
+        _admit(worker, step, batch.max_batch_size, internal_id, lambda slot: _begin_sequence(worker, step, request, internal_id, batch, slot, functools.partial(_release, worker, step, slot)))
+
+def _begin_sequence(worker: Worker, step, request, internal_id, batch: BatchConfig, slot: int, release: Callable[[], None]):
+    batcher = _batcher(worker, step, batch)
+    running_index = _begin_request(worker, request, internal_id, slot)
+    stream_id = 'stream-' + internal_id
+    trace = request._trace
+    if trace is not None:
+        trace.executed = trace.serialized = time.monotonic()
+    # the response is sent before the first step, its body is streamed as the sequence emits chunks
+    worker.table.streams.start(running_index, internal_id)
+    worker.response_queue.put((internal_id, (Response(status=200, headers=dict(batch.headers)), (stream_id, running_index), trace)))
 
+    def on_chunk(chunk):
+        # buffered bytes are counted, but a slow client doesn't pause the step, which would stall the whole batch
+        _send_chunk(worker, stream_id, running_index, chunk)
 
-    worker.stderr_redirect.set_prefix(prefix)
-    worker.stdout_redirect.set_prefix(prefix)
+    def on_end(error):
+        worker.response_queue.put((stream_id, Exception(error) if error is not None else None))
+        _finish_request(worker, request, internal_id, running_index)
+        release()
 
-    resp = None
-    worker.event_queue.put((StatusEvent.INFERENCE_START, internal_id))
+    batcher.admit(BatchSequence(request, on_chunk, on_end))
 
+def _batcher(worker: Worker, step, batch: BatchConfig) -> ContinuousBatcher:
+    "_batcher returns the batcher running step, starting it on first use"
+    with worker.batchers_lock:
+        batcher = worker.batchers.get(step)
+        if batcher is None:
+            batcher = worker.batchers[step] = ContinuousBatcher(step, worker.context, batch.max_batch_size)
+            batcher.start()
+            assert batcher.thread.ident is not None
+            worker.thread_ids.add(batcher.thread.ident)
+        return batcher
+
+def current_worker() -> Optional[Worker]:
+    "current_worker returns this process's worker if the calling thread is one of its threads, e.g. a handler's"
+    if worker is not None and threading.get_ident() in worker.thread_ids:
+        return worker
+    return None
+
+def run_inline(worker: Worker, func, request, batch: Optional[BatchConfig] = None):
+    """run_inline runs a route's handler on the calling thread, one of a worker's, returning what it returned.
+    The request is passed as is rather than serialized, and runs within the caller's slot"""
+    if batch is not None:
+        return _run_sequence_inline(worker, func, request, batch)
+    if not inspect.iscoroutinefunction(func):
+        return func(worker.context, request)
     try:
-        resp = func(worker.context, request)
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run_coroutine_threadsafe(func(worker.context, request), _event_loop(worker)).result()
+    # waiting here would block the very loop the handler needs to run on
+    raise Exception("async routes can't be called from async handlers")
+
+def _run_sequence_inline(worker: Worker, step, request, batch: BatchConfig) -> Response:
+    batcher = _batcher(worker, step, batch)
+    if threading.get_ident() == batcher.thread.ident:
+        raise Exception("a continuously batched route can't call itself")
+    chunks: ThreadQueue = ThreadQueue()
+
+    def on_end(error):
+        chunks.put(Exception(error) if error is not None else None)
+
+    batcher.admit(BatchSequence(request, chunks.put, on_end))
+
+    def body():
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    return Response(status=200, headers=dict(batch.headers), body=body())
+
+def iterate_body(worker: Worker, body) -> Generator:
+    "iterate_body iterates a response body's chunks, from a synchronous thread"
+    if isinstance(body, AsyncGeneratorType):
+        yield from _iterate_async(worker, body)
+    elif inspect.isgenerator(body):
+        yield from body
+    elif body:
+        yield body
+
+def _begin_request(worker: Worker, request, internal_id, slot) -> int:
+    "_begin_request marks the request as running in slot, returning its index in the worker table"
+    worker.thread_ids.add(threading.get_ident())
+
+    # output prefixes are per process, with concurrent requests only the worker prefix is set
+    if worker.slots_per_worker == 1:
+        if worker.total_workers > 1:
+            prefix = f"[worker {worker.worker_num}, requestID {request.id}] "
+        else:
+            prefix = f"[requestID {request.id}] "
+
+        worker.stderr_redirect.set_prefix(prefix)
+        worker.stdout_redirect.set_prefix(prefix)
+
+    # status is read from the worker table, events are only sent for the optional audit log
+    running_index = worker.worker_num * worker.slots_per_worker + slot
+    worker.table.started_at[running_index] = time.time()
+    worker.table.running[running_index] = int(internal_id)
+    if worker.slots_per_worker > 1:
+        _admitted(worker, internal_id)
+    if worker.event_queue is not None:
+        worker.event_queue.put((StatusEvent.INFERENCE_START, internal_id))
+
+    if request._trace is not None:
+        request._trace.worker_start = time.monotonic()
+    return running_index
+
+def _error_response():
+    tb_str = traceback.format_exc()
+    print(colored(tb_str, "red"))
+    resp = Response(
+        status=500,
+        body=tb_str.encode("utf-8"),
+        headers={
+            "Content-Type": "text/plain"
+        }
+    )
+    return resp, tb_str
+
+def _send_response(worker: Worker, resp, internal_id, trace, running_index) -> Optional[Tuple[str, Any]]:
+    "_send_response sends resp to the server, returning the stream id and body if the body still has to be streamed"
+    stream = None
+    body = resp.body
+    if inspect.isgenerator(body) or inspect.isasyncgen(body):
+        stream = ('stream-' + internal_id, body)
+        resp.body = None
+        worker.table.streams.start(running_index, internal_id)
+    if trace is not None:
+        trace.serialized = time.monotonic()
+    # the server credits what it reads from the stream to the slot it's streamed from
+    worker.response_queue.put((internal_id, (resp, (stream[0], running_index) if stream else None, trace)))
+    return stream
+
+def _send_chunk(worker: Worker, stream_id, running_index, chunk) -> bool:
+    "_send_chunk sends a chunk of a streamed response, returning whether the client has fallen behind"
+    worker.response_queue.put((stream_id, chunk))
+    return worker.table.streams.sent_chunk(running_index, len(chunk))
+
+def _send_background_result(worker: Worker, internal_id, resp, error):
+    # background jobs are tracked by the server, send it the job's result, encoded here so that
+    # a result that can't be serialized fails the job instead of being lost
+    result = None
+    if error is None and resp is not None:
+        try:
+            result = json_dumps(resp)
+        except Exception:
+            error = "background job result must be JSON serializable:\n" + traceback.format_exc()
+    worker.response_queue.put((internal_id, (result, error)))
+
+def _send_value(worker: Worker, internal_id, value, error, trace):
+    if trace is not None:
+        trace.serialized = time.monotonic()
+    worker.response_queue.put((internal_id, (value if error is None else None, error, trace)))
+
+def _finish_request(worker: Worker, request, internal_id, running_index):
+    # remove any uploads spooled to disk
+    request.close()
+
+    if worker.total_workers == 1 and worker.slots_per_worker == 1:
+        worker.stderr_redirect.set_prefix("")
+        worker.stdout_redirect.set_prefix("")
+
+    worker.table.running[running_index] = IDLE
+    worker.table.ended_at[running_index] = time.time()
+    worker.table.completed[running_index] += 1
+    worker.table.status_changed.release()
+    if worker.event_queue is not None:
+        worker.event_queue.put((StatusEvent.INFERENCE_END, internal_id))
+
+def _run_session(worker: Worker, func, request, internal_id, running_index):
+    "_run_session runs a websocket handler for as long as its session lasts"
+    inbound: "ThreadQueue[Optional[Message]]" = ThreadQueue()
+    worker.sessions[internal_id] = inbound
+    stream_id = 'stream-' + internal_id
+    worker.table.streams.start(running_index, internal_id)
+    # tells the server where to send the client's messages, and where to credit them
+    worker.response_queue.put((internal_id, (worker.worker_num, running_index)))
+
+    def send(message):
+        if _send_chunk(worker, stream_id, running_index, message):
+            worker.table.streams.wait_for_reader(running_index)
+
+    on_receive = functools.partial(worker.table.websocket_inbound.read_chunk, running_index, internal_id)
+    end = None
+    try:
+        func(worker.context, WebSocket(request, inbound, send, on_receive))
     except:
         tb_str = traceback.format_exc()
         print(colored(tb_str, "red"))
-        resp = Response(
-            status=500,
-            body=tb_str.encode("utf-8"),
-            headers={
-                "Content-Type": "text/plain"
-            }
-        )
-
-    if use_response:
-        generator = None
-        stream_id = None
-        if inspect.isgenerator(resp.body):
-            stream_id = 'stream-' + internal_id
-            generator = resp.body
-            resp.body = None
-        worker.response_queue.put((internal_id, (resp, stream_id)))
+        end = Exception(tb_str)
+    finally:
+        del worker.sessions[internal_id]
+    worker.response_queue.put((stream_id, end))
+
+def _run_request(worker: Worker, func, request, internal_id, reply, slot):
+    running_index = _begin_request(worker, request, internal_id, slot)
+
+    if reply == Reply.WEBSOCKET:
+        _run_session(worker, func, request, internal_id, running_index)
+        _finish_request(worker, request, internal_id, running_index)
+        return
 
+    error = None
+    try:
+        resp = func(worker.context, request)
+    except:
+        resp, error = _error_response()
+
+    if reply == Reply.RESPONSE:
+        stream = _send_response(worker, resp, internal_id, request._trace, running_index)
         # if the response is a generator, we need to iterate through it
-        if stream_id:
-            assert generator is not None
-            for chunk in generator:
-                worker.response_queue.put((stream_id, chunk))
+        if stream is not None:
+            stream_id, body = stream
+            chunks = body if inspect.isgenerator(body) else _iterate_async(worker, body)
+            for chunk in chunks:
+                # stop generating while the client is behind
+                if _send_chunk(worker, stream_id, running_index, chunk):
+                    worker.table.streams.wait_for_reader(running_index)
             worker.response_queue.put((stream_id, None))
+    elif reply == Reply.JOB_RESULT:
+        _send_background_result(worker, internal_id, resp, error)
+    else:
+        _send_value(worker, internal_id, resp, error, request._trace)
 
+    _finish_request(worker, request, internal_id, running_index)
 
-    if worker.total_workers == 1:
-        worker.stderr_redirect.set_prefix("")
-        worker.stdout_redirect.set_prefix("")
+async def _run_request_async(worker: Worker, func, request, internal_id, reply, slot):
+    running_index = _begin_request(worker, request, internal_id, slot)
 
-    worker.event_queue.put((StatusEvent.INFERENCE_END, internal_id))
+    error = None
+    try:
+        resp = await func(worker.context, request)
+    except:
+        resp, error = _error_response()
+
+    if reply == Reply.RESPONSE:
+        stream = _send_response(worker, resp, internal_id, request._trace, running_index)
+        if stream is not None:
+            stream_id, body = stream
+            if inspect.isasyncgen(body):
+                async for chunk in body:
+                    if _send_chunk(worker, stream_id, running_index, chunk):
+                        # wait off the event loop, other requests' tasks keep running
+                        await asyncio.get_running_loop().run_in_executor(None, worker.table.streams.wait_for_reader, running_index)
+            else:
+                # a synchronous generator blocks the event loop between chunks
+                for chunk in body:
+                    if _send_chunk(worker, stream_id, running_index, chunk):
+                        worker.table.streams.wait_for_reader(running_index)
+            worker.response_queue.put((stream_id, None))
+    elif reply == Reply.JOB_RESULT:
+        _send_background_result(worker, internal_id, resp, error)
+    else:
+        _send_value(worker, internal_id, resp, error, request._trace)
 
+    _finish_request(worker, request, internal_id, running_index)
@@ -1,4 +1,4 @@
-from distutils.core import setup
+from setuptools import setup
 from pathlib import Path
 
 this_directory = Path(__file__).parent
@@ -18,6 +18,9 @@ setup(
     url='https://www.banana.dev',
     keywords=['Banana server', 'HTTP server', 'Banana', 'Framework'],
     setup_requires=['wheel'],
+    entry_points={
+        'console_scripts': ['potassium=potassium.__main__:main'],
+    },
     install_requires=[
         "Flask",
         "requests",
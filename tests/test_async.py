@@ -0,0 +1,106 @@
+import asyncio
+import gzip
+import queue
+import threading
+import time
+import potassium
+
+def test_async_handlers():
+    app = potassium.Potassium("my_app")
+
+    @app.init
+    def init():
+        return {"greeting": "hello"}
+
+    @app.handler("/")
+    async def handler(context: dict, request: potassium.Request) -> potassium.Response:
+        await asyncio.sleep(0.01)
+        return potassium.Response(json={"hello": context["greeting"], "n": request.json["n"]}, status=200)
+
+    @app.handler("/stream")
+    async def stream(context: dict, request: potassium.Request) -> potassium.Response:
+        async def tokens():
+            for token in ["a", "b", "c"]:
+                await asyncio.sleep(0.01)
+                yield token.encode("utf-8")
+
+        return potassium.Response(body=tokens(), status=200, headers={"Content-Type": "text/plain"})
+
+    @app.handler("/sync_handler_async_stream")
+    def sync_handler(context: dict, request: potassium.Request) -> potassium.Response:
+        async def tokens():
+            yield b"x"
+            yield b"y"
+
+        return potassium.Response(body=tokens(), status=200, headers={"Content-Type": "application/octet-stream"})
+
+    @app.handler("/compressed_stream")
+    async def compressed_stream(context: dict, request: potassium.Request) -> potassium.Response:
+        async def lines():
+            for i in range(100):
+                yield f'{{"line": {i}}}\n'.encode("utf-8")
+
+        return potassium.Response(body=lines(), status=200, headers={"Content-Type": "application/x-ndjson"})
+
+    @app.handler("/error")
+    async def error(context: dict, request: potassium.Request) -> potassium.Response:
+        raise ValueError("async failure")
+
+    @app.background("/background")
+    async def background(context: dict, request: potassium.Request):
+        await asyncio.sleep(0.01)
+        return {"done": request.json["n"]}
+
+    client = app.test_client()
+
+    res = client.post("/", json={"n": 1})
+    assert res.status_code == 200
+    assert res.json == {"hello": "hello", "n": 1}
+
+    res = client.post("/stream", json={})
+    assert res.status_code == 200
+    assert res.data == b"abc"
+
+    res = client.post("/sync_handler_async_stream", json={})
+    assert res.data == b"xy"
+
+    res = client.post("/compressed_stream", json={}, headers={"Accept-Encoding": "gzip"})
+    assert res.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(res.data) == b"".join(f'{{"line": {i}}}\n'.encode("utf-8") for i in range(100))
+
+    res = client.post("/error", json={})
+    assert res.status_code == 500
+    assert b"async failure" in res.data
+
+    job_id = client.post("/background", json={"n": 2}).json["job_id"]
+    job = client.get(f"/_k/jobs/{job_id}?wait=5").json
+    assert job["status"] == "done"
+    assert job["result"] == {"done": 2}
+
+def test_async_handlers_overlap():
+    app = potassium.Potassium("my_app")
+
+    @app.handler("/remote", concurrency=4)
+    async def remote(context: dict, request: potassium.Request) -> potassium.Response:
+        # e.g. waiting on a remote model
+        await asyncio.sleep(0.5)
+        return potassium.Response(json={"thread": threading.get_ident()}, status=200)
+
+    client = app.test_client()
+
+    responses = queue.Queue()
+    threads = [threading.Thread(target=lambda: responses.put(client.post("/remote", json={}))) for _ in range(4)]
+    start = time.monotonic()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    # all four requests wait at the same time, on the worker's single event loop thread
+    assert time.monotonic() - start < 1.5
+    thread_ids = set()
+    for _ in range(4):
+        res = responses.get()
+        assert res.status_code == 200
+        thread_ids.add(res.json["thread"])
+    assert len(thread_ids) == 1
@@ -0,0 +1,105 @@
+import threading
+import time
+import pytest
+import potassium
+from potassium.batching import BatchSequence, ContinuousBatcher
+
+def test_batcher_admits_between_steps():
+    batch_sizes = []
+    step_started = threading.Event()
+
+    def step(context, batch):
+        batch_sizes.append(len(batch))
+        step_started.set()
+        time.sleep(0.01)
+        for sequence in batch:
+            sequence.emit(str(sequence.steps).encode())
+            if sequence.steps == sequence.request.json["length"] - 1:
+                sequence.finish()
+
+    batcher = ContinuousBatcher(step, {}, max_batch_size=4)
+    batcher.start()
+
+    outputs = {}
+    done = {}
+    def admit(name, length):
+        outputs[name] = []
+        done[name] = threading.Event()
+        request = potassium.Request(id=name, headers=potassium.types.RequestHeaders({}), json={"length": length})
+        batcher.admit(BatchSequence(request, outputs[name].append, lambda error: done[name].set()))
+
+    admit("long", 10)
+    step_started.wait(5)
+    # joins the running batch rather than waiting for the long sequence to finish
+    admit("short", 2)
+    assert done["short"].wait(5)
+    assert not done["long"].is_set()
+    assert done["long"].wait(5)
+
+    assert outputs["long"] == [str(n).encode() for n in range(10)]
+    assert outputs["short"] == [b"0", b"1"]
+    assert max(batch_sizes) == 2
+    assert batch_sizes[-1] == 1
+
+def test_continuous_batching():
+    app = potassium.Potassium("my_app")
+
+    release = threading.Event()
+    batch_sizes = []
+
+    @app.continuous_batching("/generate", max_batch_size=4, headers={"Content-Type": "text/plain"})
+    def generate(context: dict, batch):
+        batch_sizes.append(len(batch))
+        for sequence in batch:
+            if sequence.steps == 0:
+                sequence.state["words"] = sequence.request.json["prompt"].split()
+            words = sequence.state["words"]
+            sequence.emit(words.pop(0).encode() + b" ")
+            if sequence.request.json.get("wait"):
+                release.wait(5)
+            if len(words) == 0:
+                sequence.finish()
+
+    client = app.test_client()
+
+    res = client.post("/generate", json={"prompt": "one two three"})
+    assert res.status_code == 200
+    assert res.headers["Content-Type"] == "text/plain"
+    assert res.data == b"one two three "
+
+    # a second request is served while the first is still generating
+    results = {}
+    def post(name, json):
+        results[name] = client.post("/generate", json=json).data
+    thread = threading.Thread(target=post, args=("slow", {"prompt": "a b c", "wait": True}))
+    thread.start()
+    time.sleep(0.1)
+    status = client.get("/_k/status").json
+    assert status["gpu_available"] == True
+
+    post_thread = threading.Thread(target=post, args=("fast", {"prompt": "x y"}))
+    post_thread.start()
+    time.sleep(0.1)
+    release.set()
+    thread.join()
+    post_thread.join()
+
+    assert results == {"slow": b"a b c ", "fast": b"x y "}
+    assert max(batch_sizes) == 2
+
+def test_continuous_batching_error():
+    app = potassium.Potassium("my_app")
+
+    @app.continuous_batching("/generate")
+    def generate(context: dict, batch):
+        for sequence in batch:
+            sequence.emit(b"partial")
+        raise ValueError("out of memory")
+
+    client = app.test_client()
+
+    # the failure can only end the stream early, the status was already sent
+    res = client.post("/generate", json={}, buffered=False)
+    assert res.status_code == 200
+    with pytest.raises(Exception):
+        b"".join(res.response)
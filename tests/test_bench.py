@@ -0,0 +1,30 @@
+import pytest
+import potassium
+from potassium.bench import BenchConfig, percentile, run_benchmark
+
+def test_percentile():
+    values = [float(i) for i in range(1, 101)]
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile(values, 100) == 100
+    assert percentile([], 50) == 0
+    assert percentile([3.0], 99) == 3.0
+
+@pytest.mark.parametrize("mode", ["closed", "open"])
+def test_run_benchmark(mode):
+    app = potassium.Potassium("my_app")
+
+    @app.init
+    def init():
+        return {}
+
+    @app.handler()
+    def handler(context: dict, request: potassium.Request) -> potassium.Response:
+        return potassium.Response(json={"hello": "root"}, status=200)
+
+    summary = run_benchmark(app, BenchConfig(mode=mode, concurrency=2, rate=50, duration=0.3, warmup=0))
+
+    assert summary["requests"] > 0
+    assert summary["errors"] == 0
+    assert summary["rps"] > 0
+    assert summary["latency_ms"]["p99"] >= summary["latency_ms"]["p50"] > 0
@@ -0,0 +1,155 @@
+import gzip
+import json
+import os
+import threading
+import pytest
+import potassium
+from potassium.exceptions import RouteNotFoundException
+
+def test_call_from_handler():
+    app = potassium.Potassium("my_app")
+
+    @app.init
+    def init():
+        return {"weights": [1, 2]}
+
+    seen = {}
+
+    @app.handler("/a")
+    def a(context: dict, request: potassium.Request) -> potassium.Response:
+        seen["payload"] = request.json
+        seen["context"] = context
+        seen["thread"] = threading.get_ident()
+        return potassium.Response(json={"score": request.json["x"] * context["weights"][0]}, status=200)
+
+    @app.handler("/b")
+    def b(context: dict, request: potassium.Request) -> potassium.Response:
+        return potassium.Response(json={"score": request.json["x"] * context["weights"][1]}, status=200)
+
+    @app.handler("/ensemble")
+    def ensemble(context: dict, request: potassium.Request) -> potassium.Response:
+        payload = {"x": request.json["x"]}
+        scores = [app.call(route, payload).json["score"] for route in ("/a", "b")]
+        # run right here, with the same objects rather than copies
+        assert seen["payload"] is payload
+        assert seen["context"] is context
+        assert seen["thread"] == threading.get_ident()
+        return potassium.Response(json={"scores": scores}, status=200)
+
+    client = app.test_client()
+    res = client.post("/ensemble", json={"x": 3})
+    assert res.status_code == 200
+    assert res.json == {"scores": [3, 6]}
+
+    # outside of a handler, the call is scheduled on a worker
+    res = app.call("/b", {"x": 2})
+    assert res.status == 200
+    assert res.json == {"score": 4}
+    assert seen["thread"] != threading.get_ident()
+
+    with pytest.raises(RouteNotFoundException):
+        app.call("/missing", {})
+
+def test_call_not_compressed():
+    app = potassium.Potassium("my_app")
+
+    @app.handler("/model")
+    def model(context: dict, request: potassium.Request) -> potassium.Response:
+        return potassium.Response(json={"text": "x" * 2000}, status=200)
+
+    @app.handler("/proxy")
+    def proxy(context: dict, request: potassium.Request) -> potassium.Response:
+        # the client's request, passed on as is
+        res = app.call("/model", request)
+        assert "Content-Encoding" not in res.headers
+        return potassium.Response(json=res.json, status=200)
+
+    client = app.test_client()
+    res = client.post("/proxy", json={}, headers={"Accept-Encoding": "gzip"})
+    assert res.status_code == 200
+    # only the response to the http client is compressed
+    assert res.headers["Content-Encoding"] == "gzip"
+    assert json.loads(gzip.decompress(res.data)) == {"text": "x" * 2000}
+
+    request = potassium.Request("abc", potassium.types.RequestHeaders({"Accept-Encoding": "gzip"}), json={})
+    res = app.call("/model", request)
+    assert "Content-Encoding" not in res.headers
+    assert res.json == {"text": "x" * 2000}
+
+def test_call_stream():
+    app = potassium.Potassium("my_app")
+
+    @app.handler("/words")
+    def words(context: dict, request: potassium.Request) -> potassium.Response:
+        def chunks():
+            for word in request.json["text"].split():
+                yield word.encode() + b"\n"
+        return potassium.Response(body=chunks(), status=200)
+
+    @app.handler("/async_words")
+    async def async_words(context: dict, request: potassium.Request) -> potassium.Response:
+        async def chunks():
+            for word in request.json["text"].split():
+                yield word.upper().encode() + b"\n"
+        return potassium.Response(body=chunks(), status=200)
+
+    @app.continuous_batching("/generate")
+    def generate(context: dict, batch):
+        for sequence in batch:
+            sequence.emit(str(sequence.steps).encode())
+            if sequence.steps == 2:
+                sequence.finish()
+
+    @app.handler("/relay")
+    def relay(context: dict, request: potassium.Request) -> potassium.Response:
+        resp = app.call_stream(request.json["route"], {"text": "one two"})
+        return potassium.Response(body=resp.body, status=resp.status)
+
+    client = app.test_client()
+    assert client.post("/relay", json={"route": "/words"}).data == b"one\ntwo\n"
+    assert client.post("/relay", json={"route": "/async_words"}).data == b"ONE\nTWO\n"
+    assert client.post("/relay", json={"route": "/generate"}).data == b"012"
+
+    resp = app.call_stream("/words", {"text": "a b c"})
+    assert list(resp.body) == [b"a\n", b"b\n", b"c\n"]
+    assert app.call("/words", {"text": "a b c"}).body == b"a\nb\nc\n"
+
+def test_call_staged_and_errors():
+    app = potassium.Potassium("my_app")
+
+    @app.handler("/staged", preprocess=lambda request: request.json["n"] + 1, postprocess=lambda request, output: potassium.Response(json={"n": output}, status=200))
+    def staged(context: dict, n: int):
+        return n * 2
+
+    @app.handler("/fail")
+    def fail(context: dict, request: potassium.Request) -> potassium.Response:
+        raise ValueError("oops")
+
+    @app.handler("/both")
+    def both(context: dict, request: potassium.Request) -> potassium.Response:
+        staged = app.call("/staged", {"n": 1})
+        failed = app.call("/fail", {})
+        return potassium.Response(json={"staged": staged.json["n"], "failed": failed.status}, status=200)
+
+    client = app.test_client()
+    assert client.post("/both", json={}).json == {"staged": 4, "failed": 500}
+    assert app.call("/staged", {"n": 2}).json == {"n": 6}
+    assert app.call("/fail", {}).status == 500
+
+# handlers run on process workers have to be importable
+process_app = potassium.Potassium("process_app", experimental_num_workers=2)
+
+@process_app.handler("/pid")
+def pid(context: dict, request: potassium.Request) -> potassium.Response:
+    return potassium.Response(json={"pid": os.getpid()}, status=200)
+
+@process_app.handler("/caller")
+def caller(context: dict, request: potassium.Request) -> potassium.Response:
+    return potassium.Response(json={"caller": os.getpid(), "callee": process_app.call("/pid").json["pid"]}, status=200)
+
+def test_call_on_process_worker():
+    client = process_app.test_client()
+    res = client.post("/caller", json={}).json
+    # stays on the calling worker
+    assert res["caller"] == res["callee"]
+    assert res["caller"] != os.getpid()
@@ -0,0 +1,46 @@
+import pytest
+from potassium.compression import negotiate_encoding, is_compressible, compress, StreamCompressor
+import zlib
+
+@pytest.mark.parametrize("accept_encoding,expected", [
+    (None, None),
+    ("", None),
+    ("gzip", "gzip"),
+    ("GZIP", "gzip"),
+    ("deflate, gzip;q=0.5", "gzip"),
+    ("gzip;q=0", None),
+    ("*", "gzip"),
+    ("*, gzip;q=0", None),
+    ("identity", None),
+])
+def test_negotiate_encoding(accept_encoding, expected):
+    assert negotiate_encoding(accept_encoding, ["gzip"]) == expected
+
+def test_negotiate_encoding_prefers_quality():
+    assert negotiate_encoding("gzip;q=0.5, zstd", ["zstd", "gzip"]) == "zstd"
+    assert negotiate_encoding("gzip, zstd;q=0.5", ["zstd", "gzip"]) == "gzip"
+    # ties are broken by server preference
+    assert negotiate_encoding("gzip, zstd", ["zstd", "gzip"]) == "zstd"
+
+@pytest.mark.parametrize("content_type,expected", [
+    ("application/json", True),
+    ("text/plain; charset=utf-8", True),
+    ("application/vnd.api+json", True),
+    ("application/octet-stream", False),
+    ("image/png", False),
+    (None, False),
+])
+def test_is_compressible(content_type, expected):
+    assert is_compressible(content_type) == expected
+
+def test_stream_compressor_flushes_every_chunk():
+    compressor = StreamCompressor("gzip", 5)
+    decompressor = zlib.decompressobj(31)
+
+    assert decompressor.decompress(compressor.compress(b"hello ")) == b"hello "
+    assert decompressor.decompress(compressor.compress(b"world")) == b"world"
+    decompressor.decompress(compressor.finish())
+    assert decompressor.eof
+
+def test_compress():
+    assert zlib.decompress(compress(b"a" * 100, "gzip", 5), 31) == b"a" * 100
@@ -1,3 +1,4 @@
+import json
 import queue
 import threading
 import time
@@ -52,6 +53,15 @@ def test_handler():
             status=200
         )
 
+    @app.handler("/some_raw_body_request")
+    def handler6(context: dict, request: potassium.Request) -> potassium.Response:
+        assert request.json is None
+        return potassium.Response(
+            body=request.stream.read()[::-1],
+            status=200,
+            headers={"Content-Type": "application/octet-stream"}
+        )
+
     @app.handler("/some_headers_request")
     def handler5(context: dict, request: potassium.Request) -> potassium.Response:
         assert request.headers["A"] == "a"
@@ -87,6 +97,10 @@ def test_handler():
     assert res.status_code == 200
     assert res.json == {"hello": "some_path/child_path"}
 
+    res = client.post("/some_raw_body_request", data=b"\x00\x01\x02", content_type="application/octet-stream")
+    assert res.status_code == 200
+    assert res.data == b"\x02\x01\x00"
+
     # note the capitalization of ID, we're testing that it's case insensitive
     headers = {"A": "a", "B": "b", "X-Banana-Request-ID": "123"} 
     res = client.post("/some_headers_request", json={}, headers=headers)
@@ -283,3 +297,408 @@ def test_warmup():
     assert res.json is not None
     assert res.json["gpu_available"] == True
     assert res.json["sequence_number"] == 1
+
+def test_warmup_hook():
+    app = potassium.Potassium("my_app")
+
+    @app.init
+    def init():
+        return {"warmups": 0}
+
+    @app.warmup
+    def warmup(context):
+        context["warmups"] += 1
+
+    @app.handler()
+    def handler(context: dict, request: potassium.Request) -> potassium.Response:
+        return potassium.Response(json={"warmups": context["warmups"]}, status=200)
+
+    client = app.test_client()
+
+    # workers warm up before they take requests
+    res = client.post("/", json={})
+    assert res.json["warmups"] == 1
+
+    res = client.post("/_k/warmup", json={})
+    assert res.status_code == 200
+    assert res.json["warm"] == True
+    assert len(res.json["workers"]) == 1
+    assert res.json["workers"][0]["duration_ms"] >= 0
+    assert res.json["workers"][0]["error"] is None
+
+    res = client.post("/", json={})
+    assert res.json["warmups"] == 2
+
+def test_warmup_hook_error():
+    app = potassium.Potassium("my_app")
+
+    @app.warmup
+    def warmup(context):
+        raise ValueError("no gpu")
+
+    client = app.test_client()
+
+    # a failed warmup is reported, but doesn't stop the worker from serving
+    res = client.post("/_k/warmup", json={})
+    assert res.status_code == 200
+    assert res.json["warm"] == False
+    assert "ValueError: no gpu" in res.json["workers"][0]["error"]
+
+def test_binary_uploads():
+    app = potassium.Potassium("my_app", upload_spool_threshold=8)
+
+    @app.init
+    def init():
+        return {}
+
+    @app.handler("/octet_stream")
+    def octet_stream(context: dict, request: potassium.Request) -> potassium.Response:
+        assert isinstance(request.body, memoryview)
+        return potassium.Response(
+            json={"size": len(request.body), "head": bytes(request.body[:4]).decode()},
+            status=200
+        )
+
+    @app.handler("/multipart")
+    def multipart(context: dict, request: potassium.Request) -> potassium.Response:
+        small = request.files["small"]
+        large = request.files["large"]
+        assert small.path is None
+        assert large.path is not None
+        return potassium.Response(
+            json={
+                "small": bytes(small.data).decode(),
+                "large": bytes(large.data).decode(),
+                "large_filename": large.filename,
+                "field": request.form["field"],
+            },
+            status=200
+        )
+
+    client = app.test_client()
+
+    res = client.post("/octet_stream", data=b"abcd" * 100, content_type="application/octet-stream")
+    assert res.status_code == 200
+    assert res.json == {"size": 400, "head": "abcd"}
+
+    import io
+    res = client.post("/multipart", data={
+        "small": (io.BytesIO(b"tiny"), "small.bin"),
+        "large": (io.BytesIO(b"x" * 100), "large.bin"),
+        "field": "value",
+    }, content_type="multipart/form-data")
+    assert res.status_code == 200
+    assert res.json == {"small": "tiny", "large": "x" * 100, "large_filename": "large.bin", "field": "value"}
+
+def test_compression():
+    import gzip
+    app = potassium.Potassium("my_app")
+
+    @app.init
+    def init():
+        return {}
+
+    @app.handler("/large")
+    def large(context: dict, request: potassium.Request) -> potassium.Response:
+        return potassium.Response(json={"embedding": [0.5] * 1000}, status=200)
+
+    @app.handler("/small")
+    def small(context: dict, request: potassium.Request) -> potassium.Response:
+        return potassium.Response(json={"hello": "world"}, status=200)
+
+    @app.handler("/uncompressed", compression=False)
+    def uncompressed(context: dict, request: potassium.Request) -> potassium.Response:
+        return potassium.Response(json={"embedding": [0.5] * 1000}, status=200)
+
+    @app.handler("/stream", compression=potassium.Compression(level=1))
+    def stream(context: dict, request: potassium.Request) -> potassium.Response:
+        def gen():
+            yield b"hello "
+            yield b"world"
+        return potassium.Response(body=gen(), status=200, headers={"Content-Type": "text/plain"})
+
+    client = app.test_client()
+
+    res = client.post("/large", json={}, headers={"Accept-Encoding": "gzip"})
+    assert res.status_code == 200
+    assert res.headers["Content-Encoding"] == "gzip"
+    assert len(res.data) < 1000
+    assert gzip.decompress(res.data) == potassium.Response(json={"embedding": [0.5] * 1000}).body
+
+    res = client.post("/large", json={})
+    assert "Content-Encoding" not in res.headers
+    assert res.json == {"embedding": [0.5] * 1000}
+
+    res = client.post("/small", json={}, headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in res.headers
+
+    res = client.post("/uncompressed", json={}, headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in res.headers
+
+    res = client.post("/stream", json={}, headers={"Accept-Encoding": "gzip, br;q=0"})
+    assert res.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(res.data) == b"hello world"
+
+def test_drain():
+    app = potassium.Potassium("my_app")
+
+    started = threading.Event()
+
+    @app.handler("/slow")
+    def slow(context: dict, request: potassium.Request) -> potassium.Response:
+        started.set()
+        time.sleep(0.5)
+        return potassium.Response(json={"done": True}, status=200)
+
+    client = app.test_client()
+
+    responses = queue.Queue()
+    t = threading.Thread(target=lambda: responses.put(client.post("/slow", json={})))
+    t.start()
+    assert started.wait(5)
+
+    drained = queue.Queue()
+    d = threading.Thread(target=lambda: drained.put(app.drain(timeout=10)))
+    d.start()
+
+    # wait for the status event to be processed
+    time.sleep(0.1)
+    status = client.get("/_k/status").json
+    assert status["draining"] == True
+    assert status["gpu_available"] == False
+
+    # new requests are turned away while in-flight ones finish
+    res = client.post("/slow", json={})
+    assert res.status_code == 503
+    assert res.headers["Retry-After"] == "1"
+
+    t.join()
+    res = responses.get()
+    assert res.status_code == 200
+    assert res.json == {"done": True}
+    res.close()
+
+    d.join()
+    assert drained.get() == True
+
+def test_drain_timeout():
+    app = potassium.Potassium("my_app")
+
+    started = threading.Event()
+
+    @app.handler("/stuck")
+    def stuck(context: dict, request: potassium.Request) -> potassium.Response:
+        started.set()
+        time.sleep(5)
+        return potassium.Response(json={}, status=200)
+
+    client = app.test_client()
+
+    responses = queue.Queue()
+    t = threading.Thread(target=lambda: responses.put(client.post("/stuck", json={})))
+    t.start()
+    assert started.wait(5)
+
+    assert app.drain(timeout=0.2) == False
+
+    # the request that didn't finish in time is answered rather than left hanging
+    t.join(5)
+    res = responses.get(timeout=1)
+    assert res.status_code == 500
+
+def test_handler_concurrency():
+    app = potassium.Potassium("my_app")
+
+    lock = threading.Lock()
+    running = {"io": 0, "exclusive": 0}
+    max_running = {"io": 0, "exclusive": 0}
+    release = threading.Event()
+
+    def track(route):
+        with lock:
+            running[route] += 1
+            max_running[route] = max(max_running[route], running[route])
+        release.wait(5)
+        with lock:
+            running[route] -= 1
+
+    @app.handler("/io", concurrency=3)
+    def io(context: dict, request: potassium.Request) -> potassium.Response:
+        track("io")
+        return potassium.Response(json={"route": "io"}, status=200)
+
+    @app.handler("/exclusive")
+    def exclusive(context: dict, request: potassium.Request) -> potassium.Response:
+        track("exclusive")
+        return potassium.Response(json={"route": "exclusive"}, status=200)
+
+    with pytest.raises(ValueError):
+        app.handler("/invalid", concurrency=0)
+
+    client = app.test_client()
+
+    responses = queue.Queue()
+    def post(route):
+        responses.put(client.post(route, json={}))
+
+    threads = [threading.Thread(target=post, args=("/io",)) for _ in range(4)]
+    threads += [threading.Thread(target=post, args=("/exclusive",)) for _ in range(2)]
+    for t in threads:
+        t.start()
+
+    # one worker runs up to 3 requests at once, the other requests wait for a free slot
+    time.sleep(0.3)
+    with lock:
+        assert running["io"] + running["exclusive"] == 3
+        assert running["exclusive"] <= 1
+    status = client.get("/_k/status").json
+    assert status["gpu_available"] == False
+
+    release.set()
+    for t in threads:
+        t.join()
+    for _ in range(6):
+        res = responses.get()
+        assert res.status_code == 200
+
+    assert max_running["io"] <= 3
+    assert max_running["exclusive"] == 1
+
+    time.sleep(0.1)
+    assert client.get("/_k/status").json["gpu_available"] == True
+
+def test_handler_at_limit_doesnt_hold_up_others():
+    app = potassium.Potassium("my_app")
+
+    gpu_started = threading.Event()
+    release = threading.Event()
+
+    @app.handler("/gpu")
+    def gpu(context: dict, request: potassium.Request) -> potassium.Response:
+        gpu_started.set()
+        release.wait(5)
+        return potassium.Response(json={"route": "gpu"}, status=200)
+
+    @app.handler("/io", concurrency=4)
+    def io(context: dict, request: potassium.Request) -> potassium.Response:
+        return potassium.Response(json={"route": "io"}, status=200)
+
+    client = app.test_client()
+
+    responses = queue.Queue()
+    threads = [threading.Thread(target=lambda: responses.put(client.post("/gpu", json={}))) for _ in range(2)]
+    for t in threads:
+        t.start()
+    assert gpu_started.wait(5)
+    time.sleep(0.1)
+
+    # the second /gpu request waits in its route's queue, while /io goes on using the free slots
+    start = time.time()
+    res = client.post("/io", json={})
+    assert res.status_code == 200
+    assert time.time() - start < 1
+
+    release.set()
+    for t in threads:
+        t.join()
+    for _ in range(2):
+        assert responses.get().status_code == 200
+
+def test_status_audit_log(tmp_path):
+    import json
+
+    path = tmp_path / "status.jsonl"
+    app = potassium.Potassium("my_app", status_audit_path=str(path))
+
+    @app.handler("/")
+    def handler(context: dict, request: potassium.Request) -> potassium.Response:
+        return potassium.Response(json={}, status=200)
+
+    client = app.test_client()
+    assert client.post("/", json={}).status_code == 200
+
+    events = []
+    for _ in range(50):
+        events = [json.loads(line) for line in path.read_text().splitlines()] if path.exists() else []
+        if len(events) == 4:
+            break
+        time.sleep(0.05)
+    assert [e["event"] for e in events] == ["WORKER_STARTED", "INFERENCE_REQUEST_RECEIVED", "INFERENCE_START", "INFERENCE_END"]
+    assert events[-1]["requests_in_progress"] == 0
+
+def test_status_long_poll():
+    app = potassium.Potassium("my_app")
+
+    release = threading.Event()
+
+    @app.handler("/")
+    def handler(context: dict, request: potassium.Request) -> potassium.Response:
+        release.wait(5)
+        return potassium.Response(json={}, status=200)
+
+    client = app.test_client()
+
+    # nothing changes, so it waits out the timeout
+    start = time.monotonic()
+    res = client.get("/_k/status?wait=0.2&gpu_available=true")
+    assert time.monotonic() - start >= 0.2
+    assert res.json["gpu_available"] == True
+
+    thread = threading.Thread(target=client.post, args=("/",), kwargs={"json": {}})
+    thread.start()
+    res = client.get("/_k/status?wait=5&gpu_available=true")
+    assert res.json["gpu_available"] == False
+    sequence_number = res.json["sequence_number"]
+
+    # returns as soon as the request finishes
+    threading.Timer(0.2, release.set).start()
+    start = time.monotonic()
+    res = client.get("/__status__?wait=10&gpu_available=false")
+    assert time.monotonic() - start < 5
+    assert res.json["gpu_available"] == True
+    thread.join()
+
+    res = client.get(f"/_k/status?wait=0&sequence_number={sequence_number}")
+    assert res.status_code == 200
+    assert client.get("/_k/status?wait=abc").status_code == 400
+
+def test_status_stream():
+    app = potassium.Potassium("my_app")
+
+    release = threading.Event()
+
+    @app.handler("/")
+    def handler(context: dict, request: potassium.Request) -> potassium.Response:
+        release.wait(5)
+        return potassium.Response(json={}, status=200)
+
+    client = app.test_client()
+
+    res = client.get("/_k/status/stream", buffered=False)
+    assert res.status_code == 200
+    assert res.mimetype == "text/event-stream"
+    events = iter(res.response)
+
+    def next_status():
+        event = next(events)
+        if isinstance(event, bytes):
+            event = event.decode("utf-8")
+        assert event.startswith("data: ")
+        return json.loads(event[len("data: "):])
+
+    def wait_for_gpu_available(gpu_available):
+        # other transitions, e.g. the sequence number going up, can come first
+        for _ in range(10):
+            if next_status()["gpu_available"] == gpu_available:
+                return
+        raise AssertionError(f"gpu_available never became {gpu_available}")
+
+    assert next_status()["gpu_available"] == True
+
+    thread = threading.Thread(target=client.post, args=("/",), kwargs={"json": {}})
+    thread.start()
+    wait_for_gpu_available(False)
+    release.set()
+    thread.join()
+    wait_for_gpu_available(True)
+    res.close()
@@ -0,0 +1,23 @@
+import subprocess
+import sys
+
+# only imported once the app is served, or a Store or webhook is first used
+LAZY_MODULES = ["flask", "werkzeug", "redis", "boto3", "requests", "multiprocessing.pool"]
+# importing potassium takes ~150ms on a laptop, it took ~500ms with every dependency imported up front
+IMPORT_BUDGET_MS = 300
+
+def test_import_time():
+    # a fresh interpreter, so that nothing is imported already
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", "import potassium"], capture_output=True, text=True, check=True).stderr
+
+    # lines are "import time: self [us] | cumulative | imported package"
+    cumulative = {}
+    for line in out.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, total, name = line[len("import time:"):].split("|")
+        cumulative[name.strip()] = int(total)
+
+    for name in LAZY_MODULES:
+        assert name not in cumulative, f"importing potassium imported {name}"
+    assert cumulative["potassium"] / 1000 < IMPORT_BUDGET_MS
@@ -0,0 +1,269 @@
+import queue
+import threading
+import time
+import pytest
+import potassium
+from potassium.potassium import ResponseMailbox
+from potassium.jobs import BackgroundQueue, JobJournal, JobStatus, ResultStore, MAX_ATTEMPTS
+from potassium.types import Request, RequestHeaders
+
+def _request(n):
+    return Request(id=f"request-{n}", headers=RequestHeaders({}), json={"n": n})
+
+def _wait_for_status(app, job_id, status, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = app.get_job(job_id)
+        if job is not None and job["status"] == status:
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f"job {job_id} never reached {status}: {app.get_job(job_id)}")
+
+def test_journal(tmp_path):
+    journal = JobJournal(str(tmp_path / "jobs.sqlite"))
+    for n in range(3):
+        journal.add(f"job-{n}", "/background", _request(n))
+
+    assert journal.count(JobStatus.QUEUED) == 3
+
+    # oldest first
+    jobs = journal.claim(2)
+    assert [job.id for job in jobs] == ["job-0", "job-1"]
+    assert jobs[0].request.json == {"n": 0}
+    assert jobs[0].attempts == 1
+    assert journal.get("job-0")["status"] == "running"
+
+    journal.finish("job-0", JobStatus.DONE)
+    journal.finish("job-1", JobStatus.FAILED, "boom")
+    assert journal.get("job-0")["status"] == "done"
+    assert journal.get("job-1")["error"] == "boom"
+    assert journal.get("missing") is None
+
+    # a job left running by a crashed server is picked up again after a restart
+    assert journal.claim(5)[0].id == "job-2"
+    journal.close()
+
+    journal = JobJournal(str(tmp_path / "jobs.sqlite"))
+    assert journal.recover() == 1
+    jobs = journal.claim(5)
+    assert [job.id for job in jobs] == ["job-2"]
+    assert jobs[0].attempts == 2
+
+def test_journal_retention(tmp_path):
+    journal = JobJournal(str(tmp_path / "jobs.sqlite"), retention=0)
+    journal.add("job-0", "/background", _request(0))
+    journal.add("job-1", "/background", _request(1))
+    journal.claim(2)
+    journal.finish("job-0", JobStatus.DONE)
+    time.sleep(0.01)
+    journal.finish("job-1", JobStatus.DONE)
+    # finished jobs past their retention are pruned
+    assert journal.get("job-0") is None
+
+def test_background_jobs():
+    app = potassium.Potassium("my_app", background_concurrency=1)
+
+    lock = threading.Lock()
+    running = []
+    max_running = []
+    done = []
+
+    @app.background("/work")
+    def work(context: dict, request: potassium.Request):
+        with lock:
+            running.append(request.json["n"])
+            max_running.append(len(running))
+        time.sleep(0.01)
+        with lock:
+            running.remove(request.json["n"])
+            done.append(request.json["n"])
+
+    @app.background("/fail")
+    def fail(context: dict, request: potassium.Request):
+        raise ValueError("boom")
+
+    client = app.test_client()
+
+    job_ids = []
+    for n in range(20):
+        res = client.post("/work", json={"n": n})
+        assert res.status_code == 200
+        assert res.json["started"] == True
+        job_ids.append(res.json["job_id"])
+
+    for job_id in job_ids:
+        job = _wait_for_status(app, job_id, "done")
+        assert job["route"] == "/work"
+        assert job["attempts"] == 1
+
+    # jobs run in submission order, one at a time
+    assert done == list(range(20))
+    assert max(max_running) == 1
+
+    res = client.post("/fail", json={})
+    job = _wait_for_status(app, res.json["job_id"], "failed")
+    assert "ValueError: boom" in job["error"]
+
+    assert app.get_job("missing") is None
+
+def test_background_jobs_survive_restart(tmp_path):
+    path = str(tmp_path / "jobs.sqlite")
+
+    # jobs queued by a server that stopped before running them
+    journal = JobJournal(path)
+    journal.add("interrupted", "/work", _request(1))
+    journal.claim(1)
+    journal.add("queued", "/work", _request(0))
+    journal.add("removed", "/old_route", _request(2))
+    journal.close()
+
+    app = potassium.Potassium("my_app", background_journal_path=path)
+
+    done = []
+
+    @app.background("/work")
+    def work(context: dict, request: potassium.Request):
+        done.append(request.json["n"])
+
+    app.test_client()
+
+    _wait_for_status(app, "queued", "done")
+    assert _wait_for_status(app, "interrupted", "done")["attempts"] == 2
+    assert "no background handler" in _wait_for_status(app, "removed", "failed")["error"]
+    assert sorted(done) == [0, 1]
+
+def test_background_queue_retries():
+    dispatched = queue.Queue()
+    background_queue = BackgroundQueue(None, 1, dispatched.put)
+    background_queue.start()
+    background_queue.submit("job", "/work", _request(0))
+
+    # a job that never finishes, e.g. because its worker died, is requeued until it runs out of attempts
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        job = dispatched.get(timeout=5)
+        assert job.attempts == attempt
+        background_queue.retry(job, "worker died")
+
+    job = background_queue.get("job")
+    assert job is not None
+    assert job["status"] == "failed"
+    assert job["error"] == f"worker died ({MAX_ATTEMPTS} attempts)"
+    assert dispatched.empty()
+
+    background_queue.close()
+
+def test_result_store():
+    results = ResultStore(max_entries=2, ttl=60)
+    results.put("a", {"n": 1})
+    results.put("b", None)
+    assert results.get("a") == (True, {"n": 1})
+    assert results.get("b") == (True, None)
+
+    # oldest evicted beyond max_entries
+    results.put("c", 3)
+    assert results.get("a") == (False, None)
+    assert results.get("c") == (True, 3)
+
+    results = ResultStore(ttl=0)
+    results.put("a", 1)
+    assert results.get("a") == (False, None)
+
+class _DictStore():
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, ttl=600):
+        self.values[key] = value
+
+def test_result_store_persistence():
+    store = _DictStore()
+    results = ResultStore(max_entries=1, store=store)
+    results.put("a", [1])
+    results.put("b", [2])
+    results.flush()
+
+    # evicted from memory, but still in the store
+    assert results.get("a") == (True, [1])
+    assert ResultStore(store=store).get("b") == (True, [2])
+
+class _FailingStore():
+    def get(self, key):
+        return None
+
+    def set(self, key, value, ttl=600):
+        raise ConnectionError("redis is down")
+
+def test_result_store_failure():
+    app = potassium.Potassium("my_app", job_results_store=_FailingStore())
+
+    @app.background("/job")
+    def job(context: dict, request: potassium.Request):
+        return {"n": request.json["n"]}
+
+    @app.handler("/")
+    def handler(context: dict, request: potassium.Request) -> potassium.Response:
+        return potassium.Response(json={}, status=200)
+
+    client = app.test_client()
+    job_id = client.post("/job", json={"n": 1}).json["job_id"]
+    # the job completes with its result kept in memory, and requests are still answered
+    job = client.get(f"/_k/jobs/{job_id}?wait=5").json
+    assert job["status"] == "done"
+    assert job["result"] == {"n": 1}
+    assert client.post("/", json={}).status_code == 200
+
+def test_job_results():
+    app = potassium.Potassium("my_app")
+
+    release = threading.Event()
+
+    @app.background("/embed")
+    def embed(context: dict, request: potassium.Request):
+        release.wait(5)
+        return {"embedding": [request.json["n"]] * 3}
+
+    @app.background("/unserializable")
+    def unserializable(context: dict, request: potassium.Request):
+        return object()
+
+    client = app.test_client()
+
+    job_id = client.post("/embed", json={"n": 2}).json["job_id"]
+
+    res = client.get(f"/_k/jobs/{job_id}")
+    assert res.status_code == 200
+    assert res.json["status"] in ["queued", "running"]
+    assert "result" not in res.json
+
+    # a long-poll returns as soon as the job finishes
+    threading.Timer(0.2, release.set).start()
+    start = time.monotonic()
+    res = client.get(f"/_k/jobs/{job_id}?wait=10")
+    assert time.monotonic() - start < 5
+    assert res.status_code == 200
+    assert res.json["status"] == "done"
+    assert res.json["result"] == {"embedding": [2, 2, 2]}
+    assert app.get_job(job_id)["result"] == {"embedding": [2, 2, 2]}
+
+    job_id = client.post("/unserializable", json={}).json["job_id"]
+    res = client.get(f"/_k/jobs/{job_id}?wait=10")
+    assert res.json["status"] == "failed"
+    assert "JSON serializable" in res.json["error"]
+
+    assert client.get("/_k/jobs/missing").status_code == 404
+    assert client.get("/_k/jobs/missing?wait=abc").status_code == 400
+
+def test_failing_callback_keeps_mailbox_running():
+    responses = queue.Queue()
+    mailbox = ResponseMailbox(responses)
+
+    def callback(payload):
+        raise ValueError("journal closed")
+    mailbox.on_response("job", callback)
+    responses.put(("job", None))
+    # responses are still delivered after a callback raised
+    responses.put(("request", "response"))
+    assert mailbox.get("request", timeout=5) == "response"
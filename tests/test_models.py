@@ -0,0 +1,96 @@
+import pytest
+import potassium
+from potassium.models import LazyContext, Model
+
+def _models(loaded, unloaded, sizes):
+    def loader(name):
+        def load():
+            loaded.append(name)
+            return f"{name} weights"
+        return load
+    return {name: Model(name, loader(name), size, unloaded.append) for name, size in sizes.items()}
+
+def test_lazy_loading():
+    loaded = []
+    context = LazyContext({"tokenizer": "tok"}, _models(loaded, [], {"a": 10, "b": 10}))
+
+    # nothing is loaded until it's used
+    assert loaded == []
+    assert "a" in context
+    assert not context.is_loaded("a")
+    assert context["tokenizer"] == "tok"
+
+    assert context["a"] == "a weights"
+    assert context.get("a") == "a weights"
+    assert context.get("missing", 1) == 1
+    assert loaded == ["a"]
+    assert context.loaded_bytes == 10
+
+    with pytest.raises(KeyError):
+        context["missing"]
+
+def test_eviction():
+    loaded = []
+    unloaded = []
+    changes = []
+    models = _models(loaded, unloaded, {"a": 40, "b": 40, "c": 40})
+    context = LazyContext({}, models, memory_budget=100, on_change=lambda *counts: changes.append(counts))
+
+    context["a"]
+    context["b"]
+    # a was used more recently than b, so b is evicted to make room for c
+    context["a"]
+    context["c"]
+    assert unloaded == ["b weights"]
+    assert not context.is_loaded("b")
+    assert context.is_loaded("a") and context.is_loaded("c")
+    assert context.loaded_bytes == 80
+
+    # loaded again on next use
+    context["b"]
+    assert loaded == ["a", "b", "c", "b"]
+    assert context.num_loads == 4
+    assert context.num_evictions == 2
+    assert changes[-1] == (4, 2, 80)
+
+def test_init_collision():
+    with pytest.raises(Exception):
+        LazyContext({"a": 1}, _models([], [], {"a": 10}))
+
+def test_app_models():
+    app = potassium.Potassium("my_app", model_memory_budget=100)
+
+    loads = []
+
+    @app.model("small", size=60)
+    def load_small():
+        loads.append("small")
+        return lambda text: text.lower()
+
+    @app.model("large", size=60)
+    def load_large():
+        loads.append("large")
+        return lambda text: text.upper()
+
+    @app.handler("/")
+    def handler(context: dict, request: potassium.Request) -> potassium.Response:
+        model = context[request.json["model"]]
+        return potassium.Response(json={"output": model(request.json["text"])}, status=200)
+
+    with pytest.raises(ValueError):
+        app.model("huge", size=101)(lambda: None)
+
+    client = app.test_client()
+    assert loads == []
+
+    for model in ["small", "small", "large", "small"]:
+        res = client.post("/", json={"model": model, "text": "Hi"})
+        assert res.status_code == 200
+    assert res.json["output"] == "hi"
+
+    # the two models don't fit together, so they are swapped in and out
+    assert loads == ["small", "large", "small"]
+    status = client.get("/_k/status").json
+    assert status["model_loads"] == 3
+    assert status["model_evictions"] == 2
+    assert client.get("/_k/metrics").json["models"]["loaded_bytes"] == 60
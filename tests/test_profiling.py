@@ -0,0 +1,89 @@
+import threading
+import time
+import potassium
+from potassium.profiling import profile
+
+def busy_loop(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+def test_profile_samples_threads():
+    stop = threading.Event()
+    t = threading.Thread(target=busy_loop, args=(stop,))
+    t.start()
+    try:
+        assert t.ident is not None
+        result = profile(0.2, 0.01, [t.ident], allocations=True)
+    finally:
+        stop.set()
+        t.join()
+
+    assert result["samples"] > 0
+    assert any("busy_loop" in stack for stack in result["stacks"])
+    assert result["collapsed"].splitlines()[0].rsplit(" ", 1)[1].isdigit()
+    assert isinstance(result["allocations"], list)
+
+def test_profile_endpoint():
+    app = potassium.Potassium("my_app", profiling_token="secret")
+
+    @app.init
+    def init():
+        return {}
+
+    @app.background("/background")
+    def background(context: dict, request: potassium.Request):
+        deadline = time.time() + 0.5
+        while time.time() < deadline:
+            sum(range(1000))
+
+    client = app.test_client()
+
+    res = client.post("/_k/profile", json={"duration": 0.1})
+    assert res.status_code == 403
+
+    res = client.post("/background", json={})
+    assert res.status_code == 200
+
+    res = client.post("/_k/profile", json={"duration": 0.2}, headers={"X-Potassium-Profiling-Token": "secret"})
+    assert res.status_code == 200
+    assert res.json["timed_out"] == 0
+    workers = res.json["workers"]
+    assert len(workers) == 1
+    assert workers[0]["worker"] == 0
+    assert any("background" in stack for stack in workers[0]["stacks"])
+
+def test_profile_endpoint_disabled():
+    app = potassium.Potassium("my_app")
+
+    @app.init
+    def init():
+        return {}
+
+    client = app.test_client()
+    res = client.post("/_k/profile", json={}, headers={"X-Potassium-Profiling-Token": "secret"})
+    assert res.status_code == 404
+
+def test_profile_during_warmup():
+    app = potassium.Potassium("my_app", profiling_token="secret")
+    warming = threading.Event()
+    release = threading.Event()
+
+    @app.warmup
+    def warmup(context):
+        if warming.is_set():
+            release.wait(5)
+        warming.set()
+
+    client = app.test_client()
+
+    # a running warmup hook doesn't hold up the worker's other control commands
+    t = threading.Thread(target=lambda: client.post("/_k/warmup", json={}))
+    t.start()
+    try:
+        time.sleep(0.1)
+        res = client.post("/_k/profile", json={"duration": 0.1}, headers={"X-Potassium-Profiling-Token": "secret"})
+        assert res.json["timed_out"] == 0
+        assert any("warmup" in stack for stack in res.json["workers"][0]["stacks"])
+    finally:
+        release.set()
+        t.join()
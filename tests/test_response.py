@@ -32,3 +32,72 @@ def test_body_response():
     
 
 
+@pytest.mark.parametrize("backend", ["json", "orjson"])
+def test_json_backends(backend):
+    pytest.importorskip(backend)
+    potassium.set_json_backend(backend)
+    try:
+        response = potassium.Response(
+            status=200,
+            json={"key": [1, 2.5, None, "value"]}
+        )
+        assert response.json == {"key": [1, 2.5, None, "value"]}
+    finally:
+        potassium.set_json_backend("auto")
+
+def test_invalid_json_backend():
+    with pytest.raises(ValueError):
+        potassium.set_json_backend("not_a_backend")
+
+def test_request_headers_lazy():
+    headers = potassium.types.RequestHeaders([("Content-Type", "application/json"), ("X-Banana-Request-Id", "123")])
+    assert headers._headers is None
+    assert headers["content-type"] == "application/json"
+    assert headers.get("X_BANANA_REQUEST_ID") == "123"
+    assert headers.get("missing") is None
+
+def test_request_file_spooling():
+    import io
+    import os
+    import pickle
+
+    small = potassium.types.RequestFile.from_stream(io.BytesIO(b"abc"), spool_threshold=3)
+    assert small.path is None
+    assert small.data == b"abc"
+
+    large = potassium.types.RequestFile.from_stream(io.BytesIO(b"abcd"), spool_threshold=3)
+    assert large.path is not None
+    assert bytes(large.data) == b"abcd"
+
+    # only the path is pickled for process workers
+    copy = pickle.loads(pickle.dumps(large))
+    assert copy._data is None
+    assert copy.open().read() == b"abcd"
+
+    copy.close()
+    large.close()
+    assert not os.path.exists(large.path)
+
+def test_request_pickling_decodes_json_lazily():
+    import pickle
+
+    headers = potassium.types.RequestHeaders([("Content-Type", "application/json")])
+    req = potassium.Request.from_json_body("id", headers, b'{"key": "value"}', json={"key": "value"})
+    copy = pickle.loads(pickle.dumps(req))
+
+    assert copy._json is potassium.types._NOT_DECODED
+    assert copy.json == {"key": "value"}
+    assert copy.headers["content-type"] == "application/json"
+    assert copy.files == {}
+
+def test_response_json_encoded_lazily():
+    import pickle
+
+    response = potassium.Response(status=201, json={"key": "value"})
+    assert response._body is None
+
+    copy = pickle.loads(pickle.dumps(response))
+    assert copy.status == 201
+    assert type(copy.body) == bytes
+    assert copy.json == {"key": "value"}
+    assert copy.headers["Content-Type"] == "application/json"
@@ -0,0 +1,143 @@
+import os
+import threading
+import time
+import potassium
+
+def test_staged_handler():
+    app = potassium.Potassium("my_app")
+
+    threads = {}
+
+    def tokenize(request: potassium.Request):
+        threads["preprocess"] = threading.current_thread().name
+        return request.json["text"].split()
+
+    def format(request: potassium.Request, tokens) -> potassium.Response:
+        threads["postprocess"] = threading.current_thread().name
+        return potassium.Response(json={"id": request.id, "tokens": tokens}, status=200)
+
+    @app.handler("/", preprocess=tokenize, postprocess=format)
+    def handler(context: dict, tokens):
+        threads["infer"] = threading.current_thread().name
+        return [token.upper() for token in tokens]
+
+    @app.handler("/post_only", postprocess=lambda request, n: potassium.Response(json={"n": n}, status=200))
+    def post_only(context: dict, request: potassium.Request):
+        return len(request.json)
+
+    client = app.test_client()
+
+    res = client.post("/", json={"text": "hello staged world"}, headers={"X-Banana-Request-Id": "abc"})
+    assert res.status_code == 200
+    assert res.json == {"id": "abc", "tokens": ["HELLO", "STAGED", "WORLD"]}
+    # the CPU stages run on the stage pool, not on the worker
+    assert threads["preprocess"].startswith("potassium-stage")
+    assert threads["postprocess"].startswith("potassium-stage")
+    assert not threads["infer"].startswith("potassium-stage")
+
+    res = client.post("/post_only", json={"a": 1, "b": 2})
+    assert res.json == {"n": 2}
+
+    status = client.get("/_k/status?wait=5&gpu_available=false").json
+    assert status["gpu_available"] == True
+    assert status["sequence_number"] == 2
+
+def test_staged_handler_errors():
+    app = potassium.Potassium("my_app")
+
+    def preprocess(request: potassium.Request):
+        if request.json["fail"] == "preprocess":
+            raise ValueError("bad input")
+        return request.json["fail"]
+
+    def postprocess(request: potassium.Request, output):
+        if output == "postprocess":
+            raise ValueError("bad output")
+        return output
+
+    @app.handler("/", preprocess=preprocess, postprocess=postprocess)
+    def handler(context: dict, fail):
+        if fail == "infer":
+            raise ValueError("bad model")
+        return fail
+
+    client = app.test_client()
+
+    for stage in ["preprocess", "infer", "postprocess"]:
+        res = client.post("/", json={"fail": stage})
+        assert res.status_code == 500
+        assert "ValueError: bad" in res.text
+
+    # the handler's result must still end up a Response
+    res = client.post("/", json={"fail": "none"})
+    assert res.status_code == 500
+    assert "Potassium Response object not returned" in res.text
+
+    # the worker frees its slot just after replying
+    status = client.get("/_k/status?wait=5&gpu_available=false").json
+    assert status["gpu_available"] == True
+
+def test_stage_queue_bound():
+    app = potassium.Potassium("my_app", stage_queue_size=2)
+
+    lock = threading.Lock()
+    ahead = []
+    max_ahead = []
+
+    def preprocess(request: potassium.Request):
+        with lock:
+            ahead.append(request.json["n"])
+            max_ahead.append(len(ahead))
+        return request.json["n"]
+
+    def postprocess(request: potassium.Request, n) -> potassium.Response:
+        return potassium.Response(json={"n": n}, status=200)
+
+    @app.handler("/", preprocess=preprocess, postprocess=postprocess)
+    def handler(context: dict, n):
+        time.sleep(0.02)
+        with lock:
+            ahead.remove(n)
+        return n
+
+    client = app.test_client()
+
+    results = []
+    def post(n):
+        results.append(client.post("/", json={"n": n}).json["n"])
+
+    threads = [threading.Thread(target=post, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(results) == list(range(8))
+    # no more than stage_queue_size requests are preprocessed ahead of the worker
+    assert max(max_ahead) <= 2
+
+def test_staged_handler_releases_uploads():
+    app = potassium.Potassium("my_app", upload_spool_threshold=10)
+
+    paths = []
+
+    def preprocess(request: potassium.Request):
+        assert request._body.path is not None
+        paths.append(request._body.path)
+        if bytes(request.body[:4]) == b"fail":
+            raise ValueError("bad input")
+        return len(request.body)
+
+    @app.handler("/", preprocess=preprocess, postprocess=lambda request, n: potassium.Response(json={"n": n}, status=200))
+    def handler(context: dict, n):
+        return n
+
+    client = app.test_client()
+
+    # the spooled upload is removed once the request is handled, whether or not it reached a worker
+    res = client.post("/", data=b"x" * 100, content_type="application/octet-stream")
+    assert res.json == {"n": 100}
+    res = client.post("/", data=b"fail" * 25, content_type="application/octet-stream")
+    assert res.status_code == 500
+    assert len(paths) == 2
+    assert not any(os.path.exists(path) for path in paths)
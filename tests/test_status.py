@@ -144,7 +144,7 @@ def test_inference_requests_multiple_workers():
         num_workers_started=1,
         idle_start_timestamp=0,
         in_flight_request_start_times=[]
-    ), time.time()),
+    ), None),
     (PotassiumStatus(
         num_started_inference_requests=1,
         num_completed_inference_requests=0,
@@ -171,10 +171,14 @@ def test_inference_requests_multiple_workers():
         num_workers_started=4,
         idle_start_timestamp=0,
         in_flight_request_start_times=[]
-    ), time.time()),
+    ), None),
 ])
 def test_idle_time(status_result_tuple):
     status, result = status_result_tuple
+    # None means "idle since the epoch", resolved here rather than at collection time so
+    # the expectation doesn't drift with however long the rest of the suite takes to run
+    if result is None:
+        result = time.time()
     delta = abs(status.idle_time - result)
     ALLOWED_DELTA = 1
     assert delta < ALLOWED_DELTA
@@ -205,3 +209,70 @@ def test_longest_inference_time():
 
 
 
+
+def test_worker_slots():
+    status = PotassiumStatus.initial(2, slots_per_worker=2)
+    status = status.update((StatusEvent.WORKER_STARTED,))
+    status = status.update((StatusEvent.WORKER_STARTED,))
+
+    for i in range(3):
+        status = status.update((StatusEvent.INFERENCE_REQUEST_RECEIVED,))
+        status = status.update((StatusEvent.INFERENCE_START, i))
+    assert status.gpu_available == True
+
+    status = status.update((StatusEvent.INFERENCE_REQUEST_RECEIVED,))
+    assert status.gpu_available == False
+
+    status = status.update((StatusEvent.INFERENCE_END, 0))
+    assert status.gpu_available == True
+
+def test_read_status():
+    from potassium.status import ServerCounters, read_status
+    from potassium.supervisor import WorkerTable, IDLE
+
+    table = WorkerTable(2, slots_per_worker=2)
+    counters = ServerCounters()
+
+    status = read_status(table, counters, 2)
+    assert status.num_workers_started == 0
+    assert status.gpu_available == False
+
+    # workers write their pid once init() is done
+    table.pids[0] = 100
+    table.pids[1] = 101
+    assert read_status(table, counters, 2).gpu_available == True
+
+    for _ in range(4):
+        counters.request_received()
+    now = time.time()
+    for i in range(4):
+        table.started_at[i] = now - 1
+        table.running[i] = i
+    status = read_status(table, counters, 2)
+    assert status.requests_in_progress == 4
+    assert status.gpu_available == False
+    assert status.longest_inference_time >= 1
+    assert status.idle_time == 0
+
+    # slot 3 finishes
+    table.running[3] = IDLE
+    table.ended_at[3] = time.time()
+    table.completed[3] += 1
+    status = read_status(table, counters, 2)
+    assert status.requests_in_progress == 3
+    assert status.gpu_available == True
+    assert sorted(request_id for request_id, _ in status.in_flight_request_start_times) == ["0", "1", "2"]
+
+    counters.bad_request_received()
+    assert read_status(table, counters, 2).sequence_number == 5
+
+    # requests failed by the server, e.g. because their worker died, count as completed
+    for i in range(3):
+        table.running[i] = IDLE
+    counters.requests_completed(3)
+    status = read_status(table, counters, 2)
+    assert status.requests_in_progress == 0
+    assert status.idle_time >= 0
+
+    counters.drain_started()
+    assert read_status(table, counters, 2).gpu_available == False
@@ -0,0 +1,49 @@
+import pytest
+import redis
+from potassium.store import Store, RedisConfig
+
+def test_redis_pool_is_recreated_per_process(monkeypatch):
+    store = Store(backend="redis", config=RedisConfig(host="localhost", port="6379"))
+
+    client = store._redis_client
+    assert store._redis_client is client
+
+    # simulate a forked worker process
+    import potassium.store
+    monkeypatch.setattr(potassium.store.os, "getpid", lambda: -1)
+    assert store._redis_client is not client
+    assert store.pool_stats()["pid"] == -1
+
+def test_redis_pool_config():
+    store = Store(backend="redis", config=RedisConfig(
+        host="localhost",
+        port="6379",
+        max_connections=4,
+        socket_timeout=1,
+        socket_keepalive=True
+    ))
+
+    pool = store._redis_client.connection_pool
+    assert isinstance(pool, redis.BlockingConnectionPool)
+    assert pool.connection_kwargs["socket_timeout"] == 1
+    assert pool.connection_kwargs["socket_keepalive"] == True
+
+    stats = store.pool_stats()
+    assert stats["max_connections"] == 4
+    assert stats["created_connections"] == 0
+    assert stats["in_use_connections"] == 0
+
+def test_redis_unix_socket_config():
+    store = Store(backend="redis", config=RedisConfig(
+        host="localhost",
+        port="6379",
+        unix_socket_path="/tmp/redis.sock"
+    ))
+
+    pool = store._redis_client.connection_pool
+    assert pool.connection_class == redis.UnixDomainSocketConnection
+    assert pool.connection_kwargs["path"] == "/tmp/redis.sock"
+
+def test_redis_invalid_max_connections():
+    with pytest.raises(ValueError):
+        RedisConfig(host="localhost", port="6379", max_connections=0)
@@ -0,0 +1,96 @@
+import threading
+import time
+import pytest
+import potassium
+from potassium.streams import StreamBuffers
+
+def test_stream_buffers():
+    streams = StreamBuffers(2, high_watermark=100, low_watermark=20)
+    streams.start(0, "7")
+    assert not streams.sent_chunk(0, 100)
+    assert streams.sent_chunk(0, 1)
+    assert streams.snapshot()["buffered_bytes"] == {"7": 101}
+
+    resumed = threading.Event()
+    def wait():
+        streams.wait_for_reader(0)
+        resumed.set()
+    threading.Thread(target=wait).start()
+    time.sleep(0.05)
+    assert streams.snapshot()["num_paused"] == 1
+
+    # reads credited to another stream don't count
+    streams.read_chunk(0, "6", 100)
+    streams.read_chunk(0, "7", 50)
+    assert not resumed.wait(0.05)
+    streams.read_chunk(0, "7", 31)
+    assert resumed.wait(1)
+    assert streams.buffered(0) == 20
+    assert streams.snapshot()["num_pauses"] == 1
+
+    # the slot's next stream starts with nothing buffered, and an abandoned one never waits
+    streams.start(0, "8")
+    assert streams.buffered(0) == 0
+    streams.abandon(0, "8")
+    assert not streams.sent_chunk(0, 1000)
+    assert streams.snapshot()["buffered_bytes"] == {}
+
+    with pytest.raises(ValueError):
+        StreamBuffers(1, high_watermark=10, low_watermark=20)
+
+def test_slow_client_flow_control():
+    app = potassium.Potassium("my_app", stream_high_watermark=100, stream_low_watermark=50)
+
+    produced = []
+
+    @app.handler("/stream", compression=False)
+    def stream(context: dict, request: potassium.Request) -> potassium.Response:
+        def chunks():
+            for n in range(100):
+                produced.append(n)
+                yield b"0123456789"
+        return potassium.Response(body=chunks(), status=200)
+
+    client = app.test_client()
+
+    res = client.post("/stream", json={}, buffered=False)
+    body = iter(res.response)
+    data = next(body)
+
+    # the client isn't reading, so the worker stops just past the high watermark
+    time.sleep(0.2)
+    assert len(produced) <= 13
+    streams = client.get("/_k/metrics").json["streams"]
+    assert streams["num_paused"] == 1
+    assert streams["total_buffered_bytes"] >= 100
+
+    data += b"".join(body)
+    assert data == b"0123456789" * 100
+    assert len(produced) == 100
+    res.close()
+
+    streams = client.get("/_k/metrics").json["streams"]
+    assert streams["total_buffered_bytes"] == 0
+    assert streams["num_pauses"] >= 1
+
+def test_unread_stream_releases_worker():
+    app = potassium.Potassium("my_app", stream_high_watermark=100, stream_low_watermark=50)
+
+    done = threading.Event()
+
+    @app.handler("/stream", compression=False)
+    def stream(context: dict, request: potassium.Request) -> potassium.Response:
+        def chunks():
+            for _ in range(100):
+                yield b"0123456789"
+            done.set()
+        return potassium.Response(body=chunks(), status=200)
+
+    client = app.test_client()
+
+    # the client goes away without reading the stream
+    res = client.post("/stream", json={}, buffered=False)
+    time.sleep(0.1)
+    assert not done.is_set()
+    res.close()
+    assert done.wait(5)
@@ -0,0 +1,164 @@
+import os
+import signal
+import time
+import potassium
+
+# process workers unpickle handlers by reference, so this app lives at module level
+app = potassium.Potassium("supervised_app", experimental_num_workers=2)
+
+@app.init
+def init():
+    return {}
+
+@app.handler("/crash")
+def crash(context: dict, request: potassium.Request) -> potassium.Response:
+    os.kill(os.getpid(), signal.SIGKILL)
+    return potassium.Response(json={}, status=200)
+
+@app.handler("/pid")
+def pid(context: dict, request: potassium.Request) -> potassium.Response:
+    return potassium.Response(json={"pid": os.getpid()}, status=200)
+
+def test_worker_respawn():
+    client = app.test_client()
+
+    res = client.post("/pid", json={})
+    assert res.status_code == 200
+
+    # the crashed request fails fast instead of hanging
+    res = client.post("/crash", json={})
+    assert res.status_code == 500
+    assert b"died" in res.data
+
+    # the worker is restarted and re-initialized
+    for _ in range(50):
+        metrics = client.get("/_k/metrics").json
+        if metrics["workers"]["num_workers_started"] == 2:
+            break
+        time.sleep(0.1)
+    assert metrics["workers"]["num_restarts"] == 1
+    assert metrics["workers"]["num_workers_started"] == 2
+
+    for _ in range(4):
+        res = client.post("/pid", json={})
+        assert res.status_code == 200
+
+    res = client.get("/_k/status")
+    assert res.json["gpu_available"] == True
+
+recycling_app = potassium.Potassium(
+    "recycling_app",
+    experimental_num_workers=2,
+    experimental_recycle_policy=potassium.RecyclePolicy(max_requests=2)
+)
+
+@recycling_app.init
+def recycling_init():
+    return {}
+
+@recycling_app.handler("/pid")
+def recycling_pid(context: dict, request: potassium.Request) -> potassium.Response:
+    return potassium.Response(json={"pid": os.getpid()}, status=200)
+
+def _wait_for_workers(client):
+    # give the supervisor time to notice an exited worker, then wait for its replacement
+    time.sleep(0.3)
+    for _ in range(50):
+        metrics = client.get("/_k/metrics").json
+        if metrics["workers"]["num_workers_started"] == 2:
+            return metrics
+        time.sleep(0.1)
+    return metrics
+
+def test_worker_recycling():
+    client = recycling_app.test_client()
+
+    pids = set()
+    for _ in range(8):
+        res = client.post("/pid", json={})
+        assert res.status_code == 200
+        pids.add(res.json["pid"])
+        metrics = _wait_for_workers(client)
+
+    # every worker process serves at most 2 requests
+    assert len(pids) >= 4
+    assert metrics["workers"]["num_restarts"] == 0
+    assert metrics["workers"]["num_recycles"] >= 3
+    assert metrics["workers"]["num_workers_started"] == 2
+
+def test_recycle_policy():
+    policy = potassium.RecyclePolicy(max_requests=3)
+    assert not policy.should_recycle(2)
+    assert policy.should_recycle(3)
+
+    policy = potassium.RecyclePolicy(max_memory=100, memory_probe=lambda: 101)
+    assert policy.should_recycle(1)
+    assert not potassium.RecyclePolicy(max_memory=2**62).should_recycle(1)
+
+warmup_app = potassium.Potassium("warmup_app", experimental_num_workers=2)
+
+@warmup_app.init
+def warmup_init():
+    return {"warmed_up_by": None}
+
+@warmup_app.warmup
+def warmup(context):
+    context["warmed_up_by"] = os.getpid()
+
+@warmup_app.handler("/warmed_up_by")
+def warmed_up_by(context: dict, request: potassium.Request) -> potassium.Response:
+    return potassium.Response(json={"pid": os.getpid(), "warmed_up_by": context["warmed_up_by"]}, status=200)
+
+def test_warmup_every_worker():
+    client = warmup_app.test_client()
+
+    # every worker process warms itself up before taking requests
+    for _ in range(4):
+        res = client.post("/warmed_up_by", json={})
+        assert res.json["warmed_up_by"] == res.json["pid"]
+
+    res = client.post("/_k/warmup", json={})
+    assert res.json["warm"] == True
+    workers = res.json["workers"]
+    assert sorted(worker["worker"] for worker in workers) == [0, 1]
+    assert len(set(worker["pid"] for worker in workers)) == 2
+
+queued_app = potassium.Potassium("queued_app", experimental_num_workers=2)
+
+@queued_app.handler("/crash")
+def queued_crash(context: dict, request: potassium.Request) -> potassium.Response:
+    time.sleep(0.2)
+    os.kill(os.getpid(), signal.SIGKILL)
+    return potassium.Response(json={}, status=200)
+
+@queued_app.handler("/io", concurrency=4)
+def queued_io(context: dict, request: potassium.Request) -> potassium.Response:
+    return potassium.Response(json={}, status=200)
+
+def test_worker_crash_fails_queued_requests():
+    import threading
+    client = queued_app.test_client()
+
+    # with 4 slots per worker, /crash requests wait on a worker for the one running to finish
+    responses = []
+    def post():
+        responses.append(client.post("/crash", json={}).status_code)
+    threads = [threading.Thread(target=post) for _ in range(6)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(20)
+
+    # every request is answered, those waiting on a crashed worker included
+    assert len(responses) == 6
+    assert all(status == 500 for status in responses)
+    for _ in range(50):
+        metrics = client.get("/_k/metrics").json
+        if metrics["workers"]["num_workers_started"] == 2:
+            break
+        time.sleep(0.1)
+    # nothing is left counted as in progress, so the replica can look idle again
+    time.sleep(0.1)
+    status = client.get("/_k/status").json
+    assert status["gpu_available"] == True
+    assert status["idle_time"] > 0
@@ -0,0 +1,56 @@
+import json
+import time
+import potassium
+from potassium.tracing import Trace, STAGES, parse_server_timing
+
+def test_trace_stage_durations():
+    trace = Trace(1.0)
+    trace.parsed = 1.5
+    trace.worker_start = 2.0
+    trace.executed = 4.0
+    assert trace.stage_durations() == {"parse": 0.5, "queue": 0.5, "execute": 2.0}
+
+    trace.serialized = 4.5
+    trace.delivered = 5.0
+    trace.sent = 6.0
+    assert list(trace.stage_durations().keys()) == STAGES
+    assert parse_server_timing(trace.server_timing())["total"] == 5000
+
+def test_server_timing_and_export(tmp_path):
+    export_path = tmp_path / "spans.jsonl"
+    app = potassium.Potassium("my_app", server_timing=True, trace_export_path=str(export_path))
+
+    @app.init
+    def init():
+        return {}
+
+    @app.handler()
+    def handler(context: dict, request: potassium.Request) -> potassium.Response:
+        time.sleep(0.01)
+        return potassium.Response(json={}, status=200)
+
+    client = app.test_client()
+
+    res = client.post("/", json={})
+    assert res.status_code == 200
+    durations = parse_server_timing(res.headers["Server-Timing"])
+    assert list(durations.keys()) == ["parse", "queue", "execute", "serialize", "dispatch", "total"]
+    assert durations["execute"] >= 10
+    # the send stage ends when the server closes the response
+    res.close()
+
+    res = client.get("/_k/metrics")
+    assert res.status_code == 200
+    assert res.json["stages"]["execute"]["count"] == 1
+    assert res.json["stages"]["send"]["count"] == 1
+
+    # spans are written on a background thread
+    for _ in range(20):
+        if export_path.exists() and export_path.read_text() != "":
+            break
+        time.sleep(0.05)
+    export = json.loads(export_path.read_text().splitlines()[0])
+    spans = export["resourceSpans"][0]["scopeSpans"][0]["spans"]
+    assert spans[0]["name"] == "POST /"
+    assert [span["name"] for span in spans[1:]] == STAGES
+    assert all(span["parentSpanId"] == spans[0]["spanId"] for span in spans[1:])
@@ -0,0 +1,167 @@
+import base64
+import os
+import socket
+import struct
+import time
+import potassium
+from potassium.bench import start_app
+from potassium.websocket import accept_key, encode_frame, OP_TEXT, OP_BINARY, OP_CLOSE
+
+class Client():
+    "a minimal websocket client, over a raw socket"
+    def __init__(self, port, route):
+        self.sock = socket.create_connection(("127.0.0.1", port), timeout=5)
+        key = base64.b64encode(os.urandom(16)).decode()
+        self.sock.sendall((
+            f"GET {route} HTTP/1.1\r\n"
+            "Host: localhost\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            f"Sec-WebSocket-Key: {key}\r\n"
+            "Sec-WebSocket-Version: 13\r\n\r\n"
+        ).encode())
+        head = b""
+        while b"\r\n\r\n" not in head:
+            head += self.sock.recv(1)
+        self.status = int(head.split(b" ")[1])
+        if self.status == 101:
+            assert accept_key(key).encode() in head
+
+    def _recv_exactly(self, n):
+        data = b""
+        while len(data) < n:
+            chunk = self.sock.recv(n - len(data))
+            assert len(chunk) > 0
+            data += chunk
+        return data
+
+    def send(self, opcode, payload):
+        self.sock.sendall(encode_frame(opcode, payload, mask=os.urandom(4)))
+
+    def receive(self):
+        b0, b1 = self._recv_exactly(2)
+        length = b1 & 0x7F
+        if length == 126:
+            length = struct.unpack("!H", self._recv_exactly(2))[0]
+        elif length == 127:
+            length = struct.unpack("!Q", self._recv_exactly(8))[0]
+        return b0 & 0x0F, self._recv_exactly(length)
+
+def close_code(payload):
+    return struct.unpack("!H", payload)[0]
+
+def test_websocket_echo():
+    app = potassium.Potassium("my_app")
+
+    @app.init
+    def init():
+        return {"prefix": "echo: "}
+
+    @app.websocket("/ws")
+    def echo(context: dict, ws):
+        assert ws.request.headers["Upgrade"] == "websocket"
+        while True:
+            message = ws.receive()
+            if message is None:
+                break
+            if isinstance(message, str):
+                ws.send(context["prefix"] + message)
+            else:
+                ws.send(message[::-1])
+
+    server = start_app(app)
+    try:
+        client = Client(server.server_port, "/ws")
+        assert client.status == 101
+
+        client.send(OP_TEXT, "hello".encode())
+        assert client.receive() == (OP_TEXT, b"echo: hello")
+        client.send(OP_BINARY, b"\x00\x01\x02")
+        assert client.receive() == (OP_BINARY, b"\x02\x01\x00")
+        big = os.urandom(100000)
+        client.send(OP_BINARY, big)
+        assert client.receive() == (OP_BINARY, big[::-1])
+
+        # the server answers the client's close, and the session ends
+        client.send(OP_CLOSE, struct.pack("!H", 1000))
+        opcode, payload = client.receive()
+        assert opcode == OP_CLOSE
+        assert close_code(payload) == 1000
+        assert client.sock.recv(1) == b""
+
+        # plain requests to websocket routes are refused
+        assert Client(server.server_port, "/missing").status == 404
+        client = app.test_client()
+        assert client.post("/ws", json={}).status_code == 405
+        # the test client can't upgrade a connection
+        assert client.get("/ws", headers={"Upgrade": "websocket", "Connection": "Upgrade", "Sec-WebSocket-Key": "x", "Sec-WebSocket-Version": "13"}).status_code == 501
+        assert client.get("/ws").status_code == 405
+    finally:
+        server.shutdown()
+
+def test_websocket_handler_ends_session():
+    app = potassium.Potassium("my_app")
+
+    @app.websocket("/count")
+    def count(context: dict, ws):
+        n = int(ws.receive())
+        for i in range(n):
+            ws.send(str(i))
+
+    @app.websocket("/fail")
+    def fail(context: dict, ws):
+        ws.send("starting")
+        raise ValueError("oops")
+
+    server = start_app(app)
+    try:
+        client = Client(server.server_port, "/count")
+        client.send(OP_TEXT, b"3")
+        assert [client.receive() for _ in range(3)] == [(OP_TEXT, b"0"), (OP_TEXT, b"1"), (OP_TEXT, b"2")]
+        opcode, payload = client.receive()
+        assert opcode == OP_CLOSE
+        assert close_code(payload) == 1000
+        client.send(OP_CLOSE, payload)
+        assert client.sock.recv(1) == b""
+
+        client = Client(server.server_port, "/fail")
+        assert client.receive() == (OP_TEXT, b"starting")
+        opcode, payload = client.receive()
+        assert opcode == OP_CLOSE
+        assert close_code(payload) == 1011
+        client.send(OP_CLOSE, payload)
+        assert client.sock.recv(1) == b""
+
+        # the worker is free again once the session has ended
+        for _ in range(50):
+            if app.test_client().get("/_k/status").json["gpu_available"]:
+                break
+            time.sleep(0.02)
+        assert app.test_client().get("/_k/status").json["gpu_available"] == True
+    finally:
+        server.shutdown()
+
+def upper(context: dict, ws):
+    while True:
+        message = ws.receive()
+        if message is None:
+            break
+        ws.send(message.upper())
+
+def test_websocket_process_workers():
+    app = potassium.Potassium("my_app")
+    app.websocket("/ws")(upper)
+
+    server = start_app(app, num_workers=2)
+    try:
+        # each session is bound to one worker, its messages are forwarded there
+        clients = [Client(server.server_port, "/ws") for _ in range(2)]
+        for n, client in enumerate(clients):
+            client.send(OP_TEXT, f"hello {n}".encode())
+        for n, client in enumerate(clients):
+            assert client.receive() == (OP_TEXT, f"HELLO {n}".encode())
+        for client in clients:
+            client.send(OP_CLOSE, struct.pack("!H", 1000))
+            assert client.receive()[0] == OP_CLOSE
+    finally:
+        server.shutdown()